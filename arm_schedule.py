@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+
+DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+class ArmSchedule:
+    """
+    The weekly windows in which motion triggers the camera.
+
+    The windows are expanded once into a table with one entry per minute
+    of the week, so checking a trigger is a single lookup. A window ending
+    before it starts runs past midnight into the next day.
+
+    ...
+
+    Methods
+    -------
+    armed(timestamp):
+        Tells if the schedule is armed at a time.
+    """
+
+    def __init__(self, config):
+        """
+        Initializes the schedule.
+
+        Parameters
+        ----------
+        config : dict
+            The `motion` configuration dictionary. `schedule` is a list of
+            windows with `start` and `end` as [hour, minute] and optional
+            `days` ("mon" to "sun", every day by default). Without it, the
+            single `time_start` to `time_end` window applies to every day.
+        """
+        windows = config.get("schedule")
+        if not windows:
+            windows = [{"start": config["time_start"], "end": config["time_end"]}]
+
+        self.table = bytearray(MINUTES_PER_WEEK)
+        for window in windows:
+            start = window["start"][0] * 60 + window["start"][1]
+            end = window["end"][0] * 60 + window["end"][1]
+            length = (end - start) % MINUTES_PER_DAY or MINUTES_PER_DAY
+            for day in window.get("days", DAYS):
+                first = DAYS.index(day) * MINUTES_PER_DAY + start
+                for minute in range(first, first + length):
+                    self.table[minute % MINUTES_PER_WEEK] = 1
+
+    def armed(self, timestamp):
+        """Tells if the schedule is armed at a time.
+
+        Parameters
+        ----------
+        timestamp : float
+            The time in seconds since the epoch.
+
+        Returns
+        -------
+        bool
+            True if the local time falls into one of the windows.
+        """
+        local = time.localtime(timestamp)
+        return bool(
+            self.table[
+                local.tm_wday * MINUTES_PER_DAY + local.tm_hour * 60 + local.tm_min
+            ]
+        )
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Logging for the services without waiting on the SD card. The logging
+    calls only put records on a queue, a background writer formats them
+    and appends them to a size-capped, rotated file in batches. The writer
+    keeps the recent lines in a ring buffer, mirrored to a tmpfs file so
+    `/logs` can show the lines of every service, and applies the levels
+    set with `/loglevel` from a tmpfs file, without a restart.
+"""
+
+import os
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from collections import deque
+
+FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "critical": logging.CRITICAL,
+}
+
+LOG_FOLDER = os.path.join(os.path.dirname(os.path.realpath(__file__)), "log")
+
+_writer = None
+
+
+class LogWriter:
+    """
+    Formats queued log records and writes them in batches.
+
+    ...
+
+    Methods
+    -------
+    configure(log_config):
+        Applies the `logging` configuration.
+    start():
+        Starts the writer thread.
+    stop():
+        Writes the remaining records and stops the thread.
+    """
+
+    def __init__(self, service, path, fmt=FORMAT):
+        """
+        Initializes the writer.
+
+        Parameters
+        ----------
+        service : str
+            The service name, used for the ring buffer file and the levels.
+        path : str
+            The log file.
+        fmt : str, optional
+            The record format.
+        """
+        self.service = service
+        self.path = path
+        self.formatter = logging.Formatter(fmt)
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+
+        self.max_bytes = 1024 * 1024
+        self.backups = 3
+        self.flush_interval = 5.0
+        self.ring = deque(maxlen=200)
+        self.ring_dir = "/dev/shm/sentinel/log"
+        self.default_level = "error"
+        self.levels_mtime = None
+
+        try:
+            self.size = os.path.getsize(path)
+        except OSError:
+            self.size = 0
+
+    def configure(self, log_config):
+        """Applies the `logging` configuration dictionary."""
+        self.max_bytes = log_config.get("max_kb", 1024) * 1024
+        self.backups = log_config.get("backups", 3)
+        self.flush_interval = log_config.get("flush_interval", 5)
+        self.ring = deque(self.ring, maxlen=log_config.get("ring_size", 200))
+        self.ring_dir = log_config.get("ring_dir", self.ring_dir)
+        self.default_level = log_config.get("levels", {}).get(self.service, "error")
+        logging.getLogger().setLevel(LEVELS.get(self.default_level, logging.ERROR))
+        # levels changed at runtime win over the configuration
+        self.levels_mtime = None
+        self.apply_levels()
+
+    def start(self):
+        """Starts the writer thread."""
+        self.thread.start()
+
+    def stop(self):
+        """Writes the remaining records and stops the thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=2)
+
+    def run(self):
+        while True:
+            lines = []
+            urgent = False
+            deadline = time.monotonic() + self.flush_interval
+            while not urgent:
+                try:
+                    record = self.queue.get(
+                        timeout=max(0.0, deadline - time.monotonic())
+                    )
+                except queue.Empty:
+                    break
+                if record is None:
+                    self.write(lines)
+                    return
+                try:
+                    lines.append(self.formatter.format(record))
+                except Exception:  # pylint: disable=broad-exception-caught
+                    continue
+                # a crash may follow, do not hold it back
+                urgent = record.levelno >= logging.CRITICAL
+
+            self.write(lines)
+            self.apply_levels()
+
+    def write(self, lines):
+        if not lines:
+            return
+        self.ring.extend(lines)
+        data = ("\n".join(lines) + "\n").encode()
+        try:
+            if self.size > 0 and self.size + len(data) > self.max_bytes:
+                self.rotate()
+            with open(self.path, "ab") as log_file:
+                log_file.write(data)
+            self.size += len(data)
+        except OSError:
+            # nowhere to report it, the lines stay in the ring buffer
+            pass
+        self.mirror()
+
+    def rotate(self):
+        for idx in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{idx}"):
+                os.replace(f"{self.path}.{idx}", f"{self.path}.{idx + 1}")
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.size = 0
+
+    def mirror(self):
+        if not self.ring_dir:
+            return
+        path = os.path.join(self.ring_dir, self.service + ".log")
+        try:
+            os.makedirs(self.ring_dir, exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as ring_file:
+                ring_file.write("\n".join(self.ring) + "\n")
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
+
+    def apply_levels(self):
+        if not self.ring_dir:
+            return
+        path = os.path.join(self.ring_dir, "levels.json")
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime == self.levels_mtime:
+                return
+            with open(path, "r", encoding="utf-8") as levels_file:
+                levels = json.load(levels_file)
+        except (OSError, ValueError):
+            return
+        self.levels_mtime = mtime
+        level = levels.get(self.service, levels.get("all", self.default_level))
+        logging.getLogger().setLevel(LEVELS.get(level, logging.ERROR))
+
+
+def setup(service, filename, fmt=FORMAT):
+    """Sends the records of this process to a background writer.
+
+    Only the first call of a process counts, so the all-in-one runtime
+    keeps its own log when it imports the services.
+
+    Parameters
+    ----------
+    service : str
+        The service name, "camera", "bot", "motion", "telegram" or
+        "sentinel".
+    filename : str
+        The log file name in the log folder.
+    fmt : str, optional
+        The record format.
+    """
+    global _writer  # pylint: disable=global-statement
+    if _writer is not None:
+        return
+    os.makedirs(LOG_FOLDER, exist_ok=True)
+    _writer = LogWriter(service, os.path.join(LOG_FOLDER, filename), fmt)
+
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(_writer.queue))
+    root.setLevel(logging.ERROR)
+    _writer.start()
+    atexit.register(_writer.stop)
+
+
+def configure(config):
+    """Applies the "logging" configuration options to this process.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary.
+    """
+    if _writer is not None:
+        _writer.configure(config.get("logging", {}))
+
+
+def flush():
+    """Writes the queued records before the process exits abruptly."""
+    if _writer is not None:
+        _writer.stop()
+
+
+def recent(config, service="", count=30):
+    """Returns the recent log lines of the services.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary.
+    service : str, optional
+        Only the lines of this service, by default of every service.
+    count : int, optional
+        The number of lines per service.
+
+    Returns
+    -------
+    dict
+        The lines per service name.
+    """
+    ring_dir = config.get("logging", {}).get("ring_dir", "/dev/shm/sentinel/log")
+    result = {}
+    try:
+        names = sorted(os.listdir(ring_dir))
+    except OSError:
+        return result
+    for name in names:
+        if not name.endswith(".log") or (service and name != service + ".log"):
+            continue
+        try:
+            with open(os.path.join(ring_dir, name), "r", encoding="utf-8") as ring:
+                lines = ring.read().splitlines()
+        except OSError:
+            continue
+        result[name[: -len(".log")]] = lines[-count:]
+    return result
+
+
+def set_level(config, service, level):
+    """Changes the log level of a running service, or of "all" services.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary.
+    service : str
+        The service name, or "all".
+    level : str
+        One of `LEVELS`.
+
+    Raises
+    ------
+    ValueError
+        If the level is unknown.
+    """
+    if level not in LEVELS:
+        raise ValueError("Unknown log level " + level)
+    ring_dir = config.get("logging", {}).get("ring_dir", "/dev/shm/sentinel/log")
+    path = os.path.join(ring_dir, "levels.json")
+    try:
+        with open(path, "r", encoding="utf-8") as levels_file:
+            levels = json.load(levels_file)
+    except (OSError, ValueError):
+        levels = {}
+    if service == "all":
+        levels = {}
+    levels[service] = level
+
+    os.makedirs(ring_dir, exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as levels_file:
+        json.dump(levels, levels_file)
+    os.replace(path + ".tmp", path)
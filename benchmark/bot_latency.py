@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Measures the per-message latency of the Telegram bot, opening a new
+    session for every message (the old behavior) versus keeping one pooled
+    session alive.
+
+    Usage: python3 benchmark/bot_latency.py -c config.json -n 20 -g 10
+"""
+
+import os
+import sys
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from telegram import Bot
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from sentinel_message_bot import MessageBot  # pylint: disable=wrong-import-position
+
+
+def summary(name, samples):
+    """Prints the latency percentiles of a run, in milliseconds."""
+    samples_ms = sorted(sample * 1000 for sample in samples)
+    percentiles = statistics.quantiles(samples_ms, n=20)
+    print(
+        f"{name:<12} n={len(samples_ms)} "
+        f"mean={statistics.mean(samples_ms):.0f} "
+        f"p50={statistics.median(samples_ms):.0f} "
+        f"p95={percentiles[18]:.0f} ms"
+    )
+
+
+async def per_message_session(config, count, gap):
+    """Sends messages, opening and closing the bot session for each one."""
+    # like MessageBot.create_bot, a local Bot API server when configured
+    api_url = config["bot"].get("api_url")
+    if api_url:
+        bot = Bot(config["bot"]["bot_token"], base_url=api_url)
+    else:
+        bot = Bot(config["bot"]["bot_token"])
+    samples = []
+    for idx in range(0, count):
+        start = time.perf_counter()
+        async with bot:
+            await bot.sendMessage(
+                chat_id=config["bot"]["chat_id"], text="latency test " + str(idx)
+            )
+        samples.append(time.perf_counter() - start)
+        await asyncio.sleep(gap)
+    return samples
+
+
+async def persistent_session(config, count, gap):
+    """Sends messages through the long-lived MessageBot session."""
+    my_bot = MessageBot(config)
+    # the service creates the bot in run(), once its intake is up
+    my_bot.bot = my_bot.create_bot()
+    async with my_bot.bot:
+        for idx in range(0, count):
+            await my_bot.call(
+                my_bot.bot.sendMessage,
+                chat_id=my_bot.chat_id,
+                text="latency test " + str(idx),
+            )
+            await asyncio.sleep(gap)
+    return list(my_bot.latency)
+
+
+async def main():
+    """Main function"""
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "-c", "--conf", required=True, help="path to the JSON configuration file"
+    )
+    ap.add_argument("-n", "--count", type=int, default=20, help="messages per run")
+    ap.add_argument(
+        "-g", "--gap", type=float, default=10, help="seconds between messages"
+    )
+    args = vars(ap.parse_args())
+    with open(args["conf"], "r", encoding="utf-8") as read_file:
+        config = json.load(read_file)
+
+    count, gap = args["count"], args["gap"]
+    summary("per-message", await per_message_session(config, count, gap))
+    summary("persistent", await persistent_session(config, count, gap))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Compares how fast `/photo` reaches the camera with polling and with a
+    webhook. The real command handler runs against fake_telegram.py, which
+    hands the commands to long polls, or posts them to the webhook like
+    Telegram does. The time from the command reaching "Telegram" to the
+    camera receiving it is measured, along with the getUpdates requests
+    sent while nothing happens. The network itself is not simulated.
+
+    Usage: python3 benchmark/command_latency.py -c config.json -n 20
+"""
+
+import os
+import sys
+import argparse
+import asyncio
+import copy
+import json
+import socket
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+import ipc
+from fake_telegram import FakeTelegram
+from sentinel_telegram_handler import build_application, update_options
+
+
+def free_port():
+    """Returns a free local TCP port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def post(url, update):
+    """Posts an update to the webhook, as Telegram does."""
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(update).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        response.read()
+
+
+async def measure(name, base_config, updates_config, args):
+    """Sends commands in one update mode and returns the results."""
+    fake = FakeTelegram(latency=0)
+    config = copy.deepcopy(base_config)
+    config["ipc"] = dict(config.get("ipc", {}), transport="inproc")
+    config["bot"]["api_url"] = fake.start()
+    config["bot"]["updates"] = updates_config
+    chat_id = config["bot"]["chat_id"]
+
+    # the camera only notes when each command arrives
+    arrivals = []
+    ipc.register("camera", lambda msg: arrivals.append(time.perf_counter()))
+
+    mode, options = update_options(config)
+    application = build_application(config)
+    latencies = []
+    async with application:
+        await application.start()
+        if mode == "webhook":
+            await application.updater.start_webhook(**options)
+        else:
+            await application.updater.start_polling(**options)
+
+        # the idle traffic, once the first poll is out
+        await asyncio.sleep(1)
+        polls = fake.stats()["polls"]
+        await asyncio.sleep(args["idle"])
+        idle_polls = fake.stats()["polls"] - polls
+
+        for _ in range(0, args["count"]):
+            expected = len(arrivals) + 1
+            start = time.perf_counter()
+            if mode == "webhook":
+                await asyncio.to_thread(
+                    post, options["webhook_url"], fake.make_update("/photo", chat_id)
+                )
+            else:
+                fake.push_command("/photo", chat_id)
+            deadline = start + args["timeout"]
+            while len(arrivals) < expected and time.perf_counter() < deadline:
+                await asyncio.sleep(0.001)
+            if len(arrivals) >= expected:
+                latencies.append(arrivals[expected - 1] - start)
+            await asyncio.sleep(args["pause"])
+
+        await application.updater.stop()
+        await application.stop()
+    fake.stop()
+
+    latencies = sorted(latencies) or [0.0]
+    return {
+        "mode": name,
+        "commands": args["count"],
+        "received": len(arrivals),
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p95_ms": 1000 * latencies[int(0.95 * (len(latencies) - 1))],
+        "max_ms": 1000 * latencies[-1],
+        "idle_polls_per_min": idle_polls * 60 / args["idle"],
+    }
+
+
+async def run(config, args):
+    """Measures every mode."""
+    port = free_port()
+    modes = {
+        "long polling": {
+            "mode": "polling",
+            "poll_interval": 0.0,
+            "poll_timeout": args["poll_timeout"],
+        },
+        "short polling": {
+            "mode": "polling",
+            "poll_interval": args["poll_interval"],
+            "poll_timeout": 0,
+        },
+        "webhook": {
+            "mode": "webhook",
+            "listen": "127.0.0.1",
+            "port": port,
+            "url_path": "sentinel",
+            "webhook_url": f"http://127.0.0.1:{port}/sentinel",
+        },
+    }
+    for name, updates_config in modes.items():
+        try:
+            result = await measure(name, config, updates_config, args)
+        except Exception as exp:  # pylint: disable=broad-exception-caught
+            # the webhook server needs python-telegram-bot[webhooks]
+            print(f"{name:<14} failed: {exp}")
+            continue
+        print(
+            f"{result['mode']:<14} {result['received']:>3}/{result['commands']:<3} "
+            f"p50={result['p50_ms']:.1f} p95={result['p95_ms']:.1f} "
+            f"max={result['max_ms']:.1f} ms  "
+            f"idle getUpdates/min={result['idle_polls_per_min']:.1f}"
+        )
+
+
+def main():
+    """Main function"""
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "-c",
+        "--conf",
+        default=os.path.join(ROOT, "config.json"),
+        help="path to the JSON configuration file",
+    )
+    ap.add_argument("-n", "--count", type=int, default=20, help="commands per mode")
+    ap.add_argument("--pause", type=float, default=0.3, help="seconds between commands")
+    ap.add_argument(
+        "--idle", type=float, default=10, help="seconds of idle traffic to count"
+    )
+    ap.add_argument("--poll-timeout", type=float, default=10, help="long poll timeout")
+    ap.add_argument(
+        "--poll-interval", type=float, default=1.0, help="short poll interval"
+    )
+    ap.add_argument("-t", "--timeout", type=float, default=15, help="seconds")
+    args = vars(ap.parse_args())
+
+    with open(args["conf"], "r", encoding="utf-8") as read_file:
+        config = json.load(read_file)
+    asyncio.run(run(config, args))
+
+
+if __name__ == "__main__":
+    main()
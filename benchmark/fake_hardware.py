@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Stand-ins for the Picamera2 and gpiozero APIs used by the services, so
+    the real Camera and Motion code runs without a Pi. `install()` puts
+    them into sys.modules before the services import them. The camera
+    renders synthetic frames with a moving square at the configured frame
+    rate, and the PIR sensor replays a scripted list of edges.
+"""
+
+import os
+import io
+import sys
+import threading
+import time
+import types
+from collections import deque
+
+import numpy as np
+
+
+class Preview:
+    """The preview types, only NULL is used."""
+
+    NULL = 0
+
+
+class FakeRequest:
+    """A completed request holding the arrays of every stream."""
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+
+class MappedArray:
+    """Maps a stream of a request, like picamera2.MappedArray."""
+
+    def __init__(self, request, stream):
+        self.array = request.arrays[stream]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class Picamera2:
+    """A camera producing synthetic frames at the configured frame rate."""
+
+    def __init__(self):
+        self.config = self.create_still_configuration()
+        self.post_callback = None
+        self.encoders = {}
+        self.running = False
+        self.frame_count = 0
+        self.latest = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def create_still_configuration():
+        return {"main": {"size": (1280, 720)}, "lores": None, "controls": {}}
+
+    @staticmethod
+    def create_video_configuration(main=None, lores=None, controls=None):
+        return {"main": main, "lores": lores, "controls": controls or {}}
+
+    def configure(self, config):
+        self.config = config
+
+    def start_preview(self, preview):  # pylint: disable=unused-argument
+        return
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        threading.Thread(
+            target=self.render_loop, name="fake-camera", daemon=True
+        ).start()
+
+    def stop(self):
+        self.running = False
+
+    def render_loop(self):
+        width, height = self.config["main"]["size"]
+        lores = self.config.get("lores")
+        fps = self.config["controls"].get("FrameRate", 30)
+
+        # a gradient background with a square crossing it
+        base = np.zeros((height, width, 3), dtype=np.uint8)
+        base[:, :, 1] = np.linspace(0, 200, width, dtype=np.uint8)
+        main = np.empty_like(base)
+        lores_array = None
+        if lores is not None:
+            lores_w, lores_h = lores["size"]
+            lores_array = np.zeros((lores_h * 3 // 2, lores_w), dtype=np.uint8)
+
+        size = height // 6
+        next_frame = time.perf_counter()
+        while self.running:
+            x_pos = (self.frame_count * 8) % (width - size)
+            np.copyto(main, base)
+            main[height // 3 : height // 3 + size, x_pos : x_pos + size] = 255
+            arrays = {"main": main}
+            if lores_array is not None:
+                lores_array.fill(64)
+                lores_x = x_pos * lores_w // width
+                lores_size = size * lores_w // width
+                lores_array[
+                    lores_h // 3 : lores_h // 3 + lores_size,
+                    lores_x : lores_x + lores_size,
+                ] = 255
+                arrays["lores"] = lores_array
+
+            if self.post_callback is not None:
+                self.post_callback(FakeRequest(arrays))
+            with self.lock:
+                self.latest = main.copy()
+            for encoder, (outputs, stream) in list(self.encoders.items()):
+                frame = encoder.encode(arrays.get(stream, main))
+                for output in outputs:
+                    output.outputframe(frame, True, time.monotonic_ns() // 1000)
+            self.frame_count += 1
+
+            next_frame += 1.0 / fps
+            time.sleep(max(0.0, next_frame - time.perf_counter()))
+
+    def capture_array(self, stream="main"):  # pylint: disable=unused-argument
+        while True:
+            with self.lock:
+                if self.latest is not None:
+                    return self.latest.copy()
+            time.sleep(0.01)
+
+    def start_encoder(self, encoder, output, name="main"):
+        outputs = output if isinstance(output, list) else [output]
+        for each in outputs:
+            each.start()
+        self.encoders[encoder] = (outputs, name)
+
+    def stop_encoder(self, encoders=None):
+        if encoders is None:
+            encoders = list(self.encoders)
+        elif not isinstance(encoders, list):
+            encoders = [encoders]
+        for encoder in encoders:
+            outputs, _ = self.encoders.pop(encoder, ([], None))
+            for output in outputs:
+                output.stop()
+
+    def start_and_capture_file(self, name, delay=1, show_preview=False):
+        # pylint: disable=unused-argument
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+
+        self.start()
+        frame = self.capture_array()
+        Image.fromarray(frame[:, :, ::-1]).save(name, format="JPEG", quality=90)
+
+    def start_and_record_video(self, output, duration=0, **kwargs):
+        # pylint: disable=unused-argument
+        file_output = FileOutput(output)
+        self.start_encoder(H264Encoder(), file_output)
+        time.sleep(duration)
+        self.stop_encoder()
+
+
+class H264Encoder:
+    """The hardware encoder, frames are encoded as fixed-size chunks."""
+
+    CHUNK = b"\x00\x00\x00\x01" + bytes(4096)
+
+    def __init__(self, bitrate=2000000, repeat=False, iperiod=30):
+        self.bitrate = bitrate
+        self.repeat = repeat
+        self.iperiod = iperiod
+
+    def encode(self, array):  # pylint: disable=unused-argument
+        return self.CHUNK
+
+
+class MJPEGEncoder:
+    """The hardware JPEG encoder, encoding the luma of YUV420 frames."""
+
+    def __init__(self, bitrate=4000000):
+        self.bitrate = bitrate
+
+    @staticmethod
+    def encode(array):
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+
+        if array.ndim == 2:
+            array = array[0 : array.shape[0] * 2 // 3]
+        jpeg = io.BytesIO()
+        Image.fromarray(array).save(jpeg, format="JPEG", quality=70)
+        return jpeg.getvalue()
+
+
+class FileOutput:
+    """Writes every encoded frame to a file."""
+
+    def __init__(self, file=None):
+        self.fileoutput = file
+        self.handle = None
+
+    def start(self):
+        if self.fileoutput is not None:
+            self.handle = open(self.fileoutput, "wb")  # pylint: disable=R1732
+
+    def outputframe(self, frame, keyframe=True, timestamp=None):
+        # pylint: disable=unused-argument
+        if self.handle is not None:
+            self.handle.write(frame)
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+class CircularOutput(FileOutput):
+    """Keeps encoding in memory and writes out from start() to stop()."""
+
+    def __init__(self, buffersize=150, file=None):
+        super().__init__(file)
+        self.buffer = deque(maxlen=buffersize)
+
+    def start(self):
+        super().start()
+        if self.handle is not None:
+            self.handle.write(b"".join(self.buffer))
+
+    def outputframe(self, frame, keyframe=True, timestamp=None):
+        self.buffer.append(frame)
+        super().outputframe(frame, keyframe, timestamp)
+
+
+class FfmpegOutput(FileOutput):
+    """Counts the frames ffmpeg would cut into segments."""
+
+    def __init__(self, output_filename, audio=False):
+        super().__init__()
+        self.output_filename = output_filename
+        self.audio = audio
+        self.frames = 0
+
+    def outputframe(self, frame, keyframe=True, timestamp=None):
+        self.frames += 1
+
+
+class FakePinFactory:
+    """Ticks in microseconds, like the lgpio pin factory."""
+
+    @staticmethod
+    def ticks():
+        return int(time.monotonic() * 1e6)
+
+    @staticmethod
+    def ticks_diff(later, earlier):
+        return (later - earlier) / 1e6
+
+
+class FakePin:
+    """A pin whose edges are driven by a script."""
+
+    def __init__(self):
+        self.state = False
+        self.when_changed = None
+
+    def drive(self, state):
+        self.state = state
+        if self.when_changed is not None:
+            self.when_changed(FakePinFactory.ticks(), state)
+
+
+class DigitalInputDevice:
+    """An input device on a scripted pin."""
+
+    pins = {}
+
+    def __init__(self, pin, **kwargs):  # pylint: disable=unused-argument
+        self.pin = DigitalInputDevice.pins.setdefault(pin, FakePin())
+        self.pin_factory = FakePinFactory()
+
+    def close(self):
+        self.pin.when_changed = None
+
+    @property
+    def value(self):
+        return int(self.pin.state)
+
+
+def play_pir(pin, edges):
+    """Replays PIR edges on a pin from a background thread.
+
+    Parameters
+    ----------
+    pin : int
+        The pin number used by the Motion service.
+    edges : list
+        (seconds since the start, level) tuples, in time order.
+
+    Returns
+    -------
+    threading.Thread
+        The running player.
+    """
+    fake_pin = DigitalInputDevice.pins.setdefault(pin, FakePin())
+
+    def play():
+        start = time.perf_counter()
+        for at_time, level in edges:
+            time.sleep(max(0.0, start + at_time - time.perf_counter()))
+            fake_pin.drive(level)
+
+    thread = threading.Thread(target=play, name="fake-pir", daemon=True)
+    thread.start()
+    return thread
+
+
+def install():
+    """Registers the fake picamera2 and gpiozero modules."""
+    picamera2 = types.ModuleType("picamera2")
+    picamera2.Picamera2 = Picamera2
+    picamera2.MappedArray = MappedArray
+    picamera2.Preview = Preview
+    encoders = types.ModuleType("picamera2.encoders")
+    encoders.H264Encoder = H264Encoder
+    encoders.MJPEGEncoder = MJPEGEncoder
+    outputs = types.ModuleType("picamera2.outputs")
+    outputs.FileOutput = FileOutput
+    outputs.CircularOutput = CircularOutput
+    outputs.FfmpegOutput = FfmpegOutput
+    picamera2.encoders = encoders
+    picamera2.outputs = outputs
+
+    gpiozero = types.ModuleType("gpiozero")
+    gpiozero.DigitalInputDevice = DigitalInputDevice
+
+    sys.modules.update(
+        {
+            "picamera2": picamera2,
+            "picamera2.encoders": encoders,
+            "picamera2.outputs": outputs,
+            "gpiozero": gpiozero,
+        }
+    )
+
+
+def rss_kb():
+    """Returns the resident memory of this process in kB."""
+    with open(f"/proc/{os.getpid()}/status", "r", encoding="utf-8") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    A local stand-in for the Telegram Bot API. It answers the methods used
+    by the bot with minimal valid results, and simulates the round trip
+    latency, an uplink shared by all uploads and 429 rate limits. Point the
+    bot at it with `"api_url": "http://127.0.0.1:<port>/bot"`. Commands
+    pushed with `push_command` are served to long polls.
+"""
+
+import json
+import threading
+import time
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeTelegram:
+    """
+    Runs the fake Bot API on a background thread.
+
+    ...
+
+    Methods
+    -------
+    start():
+        Starts serving and returns the base URL for the bot.
+    stop():
+        Stops serving.
+    stats():
+        Returns the counters of the served requests.
+    make_update(text, chat_id):
+        Returns a Telegram update carrying a command.
+    push_command(text, chat_id):
+        Queues a command for the next getUpdates.
+    """
+
+    def __init__(
+        self, latency=0.05, bandwidth_kbps=0, rate_limit_every=0, retry_after=1
+    ):
+        """
+        Initializes the server.
+
+        Parameters
+        ----------
+        latency : float, optional
+            The round trip time added to every request, in seconds.
+        bandwidth_kbps : float, optional
+            The uplink shared by all requests in kbit/s, 0 for unlimited.
+        rate_limit_every : int, optional
+            Answer every n-th request with 429, 0 to never rate limit.
+        retry_after : int, optional
+            The retry-after of the 429 answers, in seconds.
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth_kbps * 1000 / 8
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+
+        self.lock = threading.Lock()
+        self.uplink = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.photos = 0
+        self.messages = 0
+        self.videos = 0
+        self.uploaded_bytes = 0
+        self.uploads = []
+        self.deliveries = []
+        self.server = None
+
+        self.updates = []
+        self.update_id = 0
+        self.polls = 0
+        self.new_update = threading.Condition()
+
+    def start(self):
+        """Starts serving and returns the base URL for the bot."""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Answers Bot API calls."""
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, result = fake.handle(self.path.rsplit("/", 1)[-1], body)
+                data = json.dumps(result).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                return
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(
+            target=self.server.serve_forever, name="fake-telegram", daemon=True
+        ).start()
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot"
+
+    def stop(self):
+        """Stops serving."""
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def handle(self, method, body):
+        """Simulates the network and returns the status and the answer."""
+        if self.bandwidth > 0:
+            # uploads share one uplink, so they are serialized
+            with self.uplink:
+                time.sleep(len(body) / self.bandwidth)
+        time.sleep(self.latency)
+
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self.get_updates(body)}
+        if method in ("setWebhook", "deleteWebhook"):
+            return 200, {"ok": True, "result": True}
+
+        with self.lock:
+            self.requests += 1
+            if method in ("sendPhoto", "sendVideo", "sendDocument"):
+                # every attempt, also the rate limited ones
+                self.uploads.append((method, len(body)))
+            if self.rate_limit_every and self.requests % self.rate_limit_every == 0:
+                self.rate_limited += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests: retry after "
+                    + str(self.retry_after),
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            self.uploaded_bytes += len(body)
+
+            if method == "getMe":
+                return 200, {
+                    "ok": True,
+                    "result": {
+                        "id": 1,
+                        "is_bot": True,
+                        "first_name": "Sentinel",
+                        "username": "sentinel_bench_bot",
+                    },
+                }
+
+            message = {
+                "message_id": self.requests,
+                "date": int(time.time()),
+                "chat": {"id": 0, "type": "private"},
+            }
+            if method == "sendMediaGroup":
+                count = body.count(b"attach://")
+                self.photos += count
+                self.deliveries.append((time.time(), count))
+                return 200, {"ok": True, "result": [message] * count}
+            if method == "sendPhoto":
+                self.photos += 1
+                self.deliveries.append((time.time(), 1))
+            elif method in ("sendVideo", "sendDocument"):
+                self.videos += 1
+            elif method == "sendMessage":
+                self.messages += 1
+            return 200, {"ok": True, "result": message}
+
+    @staticmethod
+    def parameters(body):
+        try:
+            return json.loads(body)
+        except ValueError:
+            # form encoded, with JSON encoded values
+            return {
+                key: values[0] for key, values in parse_qs(body.decode()).items()
+            }
+
+    def get_updates(self, body):
+        """Answers a long poll with the queued updates, waiting for one."""
+        params = self.parameters(body) if body else {}
+        offset = int(params.get("offset", 0))
+        timeout = float(params.get("timeout", 0))
+        with self.new_update:
+            self.polls += 1
+            self.updates = [
+                update for update in self.updates if update["update_id"] >= offset
+            ]
+            self.new_update.wait_for(lambda: self.updates, timeout=timeout)
+            return list(self.updates)
+
+    def make_update(self, text, chat_id):
+        """Returns a Telegram update carrying a command."""
+        with self.new_update:
+            self.update_id += 1
+            update_id = self.update_id
+        command = text.split()[0]
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": chat_id, "is_bot": False, "first_name": "User"},
+                "text": text,
+                "entities": [
+                    {"type": "bot_command", "offset": 0, "length": len(command)}
+                ],
+            },
+        }
+
+    def push_command(self, text, chat_id):
+        """Queues a command for the next getUpdates."""
+        update = self.make_update(text, chat_id)
+        with self.new_update:
+            self.updates.append(update)
+            self.new_update.notify_all()
+        return update
+
+    def stats(self):
+        """Returns the counters of the served requests."""
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "polls": self.polls,
+                "rate_limited": self.rate_limited,
+                "photos": self.photos,
+                "messages": self.messages,
+                "videos": self.videos,
+                "uploaded_mb": self.uploaded_bytes / 1024 / 1024,
+            }
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Measures the cost of scoring burst frames per frame for several
+    strides, and checks that the best frames are picked from a synthetic
+    burst of empty, blurred and sharp frames. Run it on the Pi to get the
+    numbers of its CPU, `--cpu 0` keeps it on one core like the camera
+    service on a Pi Zero.
+
+    Usage: python3 benchmark/frame_ranking.py -n 10 -k 3 --cpu 0
+"""
+
+import os
+import sys
+import argparse
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+from frame_ranker import FrameRanker
+
+
+def blur(region, radius):
+    """Box blurs a region horizontally in place, like motion blur."""
+    padded = np.pad(region.astype(np.float32), ((0, 0), (radius, radius), (0, 0)))
+    blurred = np.zeros(region.shape, dtype=np.float32)
+    for shift in range(0, 2 * radius + 1):
+        blurred += padded[:, shift : shift + region.shape[1]]
+    region[:] = blurred / (2 * radius + 1)
+
+
+def make_burst(count, size, seed=1):
+    """Returns a burst of RGB888 frames and the indices of the good ones.
+
+    A third of the frames show only the scene, a third show a moving
+    subject with motion blur and a third show it sharp.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    scene = rng.integers(0, 160, (height // 8, width // 8, 3), dtype=np.uint8)
+    scene = np.repeat(np.repeat(scene, 8, axis=0), 8, axis=1)
+
+    frames = []
+    good = []
+    for idx in range(0, count):
+        frame = scene.copy()
+        kind = idx % 3
+        if kind > 0:
+            x_pos = width // 4 + idx * width // (2 * count)
+            subject = frame[height // 3 : 2 * height // 3, x_pos : x_pos + 96]
+            subject[:] = 255
+            subject[::6] = 0
+            subject[:, ::6] = 0
+            if kind == 1:
+                blur(frame[height // 3 : 2 * height // 3, x_pos - 16 : x_pos + 112], 12)
+            else:
+                good.append(idx)
+        # sensor noise
+        frame = np.clip(
+            frame.astype(np.int16) + rng.integers(-4, 5, frame.shape), 0, 255
+        ).astype(np.uint8)
+        frames.append(frame)
+    return frames, good
+
+
+def main():
+    """Main function"""
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", "--count", type=int, default=9, help="frames per burst")
+    ap.add_argument("-k", "--top-k", type=int, default=3, help="frames kept")
+    ap.add_argument(
+        "-s", "--strides", type=int, nargs="+", default=[2, 4, 8], help="strides"
+    )
+    ap.add_argument("--size", type=int, nargs=2, default=[1280, 720], help="w h")
+    ap.add_argument("-r", "--repeat", type=int, default=5, help="bursts to time")
+    ap.add_argument("--cpu", type=int, default=None, help="pin to this core")
+    args = vars(ap.parse_args())
+
+    if args["cpu"] is not None:
+        os.sched_setaffinity(0, {args["cpu"]})
+
+    frames, good = make_burst(args["count"], tuple(args["size"]))
+    print(
+        f"{args['count']} frames of {args['size'][0]}x{args['size'][1]}, "
+        f"sharp with a subject: {good}"
+    )
+    for stride in args["strides"]:
+        ranker = FrameRanker({"stride": stride})
+        luma_time = 0.0
+        rank_time = 0.0
+        for _ in range(0, args["repeat"]):
+            start = time.perf_counter()
+            lumas = [ranker.luma(frame) for frame in frames]
+            luma_time += time.perf_counter() - start
+            start = time.perf_counter()
+            selected, _ = ranker.rank(lumas, args["top_k"])
+            rank_time += time.perf_counter() - start
+
+        scored = args["repeat"] * len(frames)
+        picked = len(set(selected) & set(good))
+        print(
+            f"stride {stride}: luma {1000 * luma_time / scored:.2f} ms + "
+            f"score {1000 * rank_time / scored:.2f} ms per frame, "
+            f"picked {selected} ({picked}/{min(args['top_k'], len(good))} good)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Compares the JSON/UDP path with the framed Unix socket IPC: throughput,
+    one-way latency and lost messages, with a receiver that takes
+    `--work` milliseconds per message to simulate a busy service.
+
+    Usage: python3 benchmark/ipc_benchmark.py -n 20000 -w 0
+"""
+
+import os
+import sys
+import argparse
+import json
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import ipc  # pylint: disable=wrong-import-position
+
+
+def message(idx):
+    """Returns a typical send_photo message stamped with the send time."""
+    return {
+        "cmd": "send_photo",
+        "file_type": "JPG",
+        "handle": "2024-01-01_12-00-00_photo" + str(idx) + ".jpg",
+        "extension": ".jpg",
+        "date": "2024-01-01",
+        "time": "12-00-00",
+        "server": "telegram",
+        "sent": time.perf_counter(),
+    }
+
+
+class Receiver:
+    """Collects latencies until the expected number of messages arrived."""
+
+    def __init__(self, count, work):
+        self.count = count
+        self.work = work
+        self.latencies = []
+        self.done = threading.Event()
+
+    def handle(self, msg):
+        self.latencies.append(time.perf_counter() - msg["sent"])
+        if self.work:
+            time.sleep(self.work)
+        if len(self.latencies) >= self.count:
+            self.done.set()
+
+
+def run_udp(count, work):
+    """Sends the messages as JSON datagrams, like the original services."""
+    receiver = Receiver(count, work)
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    server.settimeout(1)
+    port = server.getsockname()[1]
+
+    def receive_loop():
+        while not receiver.done.is_set():
+            try:
+                data, _ = server.recvfrom(4096)
+            except socket.timeout:
+                return
+            receiver.handle(json.loads(data.decode()))
+
+    thread = threading.Thread(target=receive_loop, daemon=True)
+    thread.start()
+
+    client = ipc.UdpClient(port)
+    start = time.perf_counter()
+    for idx in range(0, count):
+        client.send(message(idx))
+    thread.join()
+    return receiver, time.perf_counter() - start
+
+
+def run_unix(count, work):
+    """Sends the messages through the acknowledged Unix socket IPC."""
+    receiver = Receiver(count, work)
+    path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+    ipc.IpcServer(path, receiver.handle).start()
+
+    client = ipc.IpcClient(path)
+    start = time.perf_counter()
+    for idx in range(0, count):
+        client.send(message(idx), timeout=60)
+    receiver.done.wait(timeout=60)
+    return receiver, time.perf_counter() - start
+
+
+def summary(name, count, receiver, duration):
+    """Prints throughput, latency percentiles and losses of a run."""
+    latencies_ms = sorted(latency * 1000 for latency in receiver.latencies)
+    if len(latencies_ms) < 2:
+        print(f"{name:<6} received {len(latencies_ms)} of {count}")
+        return
+    percentiles = statistics.quantiles(latencies_ms, n=100)
+    print(
+        f"{name:<6} {len(latencies_ms) / duration:>9.0f} msg/s  "
+        f"p50={percentiles[49]:.3f} p95={percentiles[94]:.3f} "
+        f"p99={percentiles[98]:.3f} ms  "
+        f"lost={count - len(latencies_ms)}"
+    )
+
+
+def main():
+    """Main function"""
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", "--count", type=int, default=20000, help="messages")
+    ap.add_argument(
+        "-w", "--work", type=float, default=0, help="receiver ms per message"
+    )
+    args = vars(ap.parse_args())
+    count, work = args["count"], args["work"] / 1000
+
+    print("encoded size: json", len(json.dumps(message(0))), "bytes, ipc", end=" ")
+    print(len(ipc.encode(message(0))), "bytes")
+    summary("udp", count, *run_udp(count, work))
+    summary("unix", count, *run_unix(count, work))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Watches the live view of the real Camera code on fake_hardware.py with
+    fast viewers and slow viewers at once. Reports the frame rate each
+    viewer receives and the frames it lost, next to the frame rate of the
+    camera, which must stay at the configured rate however slow the
+    viewers are.
+
+    Usage: python3 benchmark/live_view_benchmark.py -c config.json -f 4 -s 2
+"""
+
+import os
+import sys
+import argparse
+import copy
+import http.client
+import json
+import socket
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+import fake_hardware
+
+
+def watch(port, delay, duration, results):
+    """Reads the MJPEG stream like a viewer taking `delay` s per frame."""
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+    connection.connect()
+    # like a phone on a weak link, not a loopback buffer of megabytes
+    connection.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 32 * 1024)
+    connection.request("GET", "/stream.mjpg")
+    response = connection.getresponse()
+    frames = 0
+    first = None
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        length = 0
+        while True:
+            line = response.fp.readline()
+            if not line:
+                deadline = 0
+                break
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+            elif line == b"\r\n" and length:
+                break
+        if not length:
+            break
+        response.fp.read(length + 2)
+        frames += 1
+        first = first or time.perf_counter()
+        time.sleep(delay)
+    elapsed = time.perf_counter() - (first or time.perf_counter())
+    connection.close()
+    results.append((delay, frames / elapsed if elapsed > 0 else 0.0))
+
+
+def main():
+    """Main function"""
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "-c",
+        "--conf",
+        default=os.path.join(ROOT, "config.json"),
+        help="path to the JSON configuration file",
+    )
+    ap.add_argument("-f", "--fast", type=int, default=4, help="fast viewers")
+    ap.add_argument("-s", "--slow", type=int, default=2, help="slow viewers")
+    ap.add_argument(
+        "--slow-delay", type=float, default=0.25, help="seconds per frame when slow"
+    )
+    ap.add_argument("-d", "--duration", type=float, default=10, help="seconds")
+    args = vars(ap.parse_args())
+
+    with open(args["conf"], "r", encoding="utf-8") as read_file:
+        config = copy.deepcopy(json.load(read_file))
+
+    folder = tempfile.mkdtemp(prefix="sentinel-live-")
+    config["photo_path"] = os.path.join(folder, "photos")
+    config["video_path"] = os.path.join(folder, "videos")
+    config["profile_startup"] = False
+    config["ipc"] = dict(config.get("ipc", {}), transport="inproc")
+    stream_config = config["camera"].setdefault("stream", {})
+    stream_config["enabled"] = True
+    stream_config["video"] = dict(stream_config.get("video", {}), circular=False)
+    stream_config["live"] = dict(
+        stream_config.get("live", {}),
+        enabled=True,
+        listen="127.0.0.1",
+        port=0,
+        token="",
+        max_viewers=args["fast"] + args["slow"],
+    )
+    fps = stream_config["video"].get("fps", 30)
+
+    fake_hardware.install()
+    from sentinel_camera import Camera  # pylint: disable=import-outside-toplevel
+
+    camera = Camera(config)
+    camera.open_camera()
+    port = camera.live_server.port
+
+    results = []
+    viewers = [
+        threading.Thread(
+            target=watch, args=(port, 0.0, args["duration"], results), daemon=True
+        )
+        for _ in range(0, args["fast"])
+    ] + [
+        threading.Thread(
+            target=watch,
+            args=(port, args["slow_delay"], args["duration"], results),
+            daemon=True,
+        )
+        for _ in range(0, args["slow"])
+    ]
+    start_frames = camera.picam2.frame_count
+    start = time.perf_counter()
+    for viewer in viewers:
+        viewer.start()
+    # the viewers are counted before they hang up
+    time.sleep(args["duration"] * 0.9)
+    stats = camera.live_broadcaster.stats()
+    for viewer in viewers:
+        viewer.join()
+    camera_fps = (camera.picam2.frame_count - start_frames) / (
+        time.perf_counter() - start
+    )
+    camera.picam2.stop()
+
+    print(f"camera {camera_fps:.1f} fps (configured {fps})")
+    print(
+        f"encoded {stats['frames']} frames, "
+        f"{stats['dropped']} dropped for slow viewers"
+    )
+    for delay, viewer_fps in sorted(results):
+        kind = "slow" if delay else "fast"
+        print(f"    {kind} viewer {viewer_fps:5.1f} fps")
+    for idx, viewer in enumerate(stats["viewers"]):
+        print(f"    viewer {idx}: sent {viewer['sent']} dropped {viewer['dropped']}")
+
+
+if __name__ == "__main__":
+    main()
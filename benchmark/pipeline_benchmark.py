@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Runs the real Motion, Camera and MessageBot code without a Pi: the
+    camera and the PIR sensor are replaced by fake_hardware.py and the Bot
+    API by fake_telegram.py. Each scenario replays a fixed PIR script in a
+    fresh process and reports delivered events per second, the latency
+    from the PIR edge to Telegram, dropped events and the RSS.
+
+    Usage: python3 benchmark/pipeline_benchmark.py -c config.json -s steady burst
+"""
+
+import os
+import sys
+import argparse
+import asyncio
+import copy
+import json
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+import fake_hardware
+from fake_telegram import FakeTelegram
+
+SCENARIOS = {
+    # one event per second on a fast link
+    "steady": {"events": 30, "period": 1.0},
+    # events as fast as the PIR debounce and release allow
+    "burst": {"events": 30, "period": 0.4},
+    # a slow mobile uplink
+    "slow_uplink": {
+        "events": 10,
+        "period": 1.0,
+        "latency": 0.3,
+        "bandwidth_kbps": 2000,
+    },
+    # every fifth call answered with 429
+    "rate_limited": {"events": 20, "period": 0.5, "rate_limit_every": 5},
+}
+
+# the PIR output stays high for this long per event
+PULSE = 0.2
+
+
+def build_config(base, folder, api_url, events):
+    """Points a configuration at temporary folders and the fake Bot API."""
+    config = copy.deepcopy(base)
+    config["photo_path"] = os.path.join(folder, "photos")
+    config["video_path"] = os.path.join(folder, "videos")
+    config["profile_startup"] = False
+    config["ipc"] = dict(config.get("ipc", {}), transport="inproc")
+    config["media_transport"] = {
+        "type": "shm",
+        "path": os.path.join(folder, "shm"),
+        "max_mb": 64,
+    }
+
+    bot_config = config["bot"]
+    bot_config["api_url"] = api_url
+    bot_config.setdefault("session", {})["keepalive_interval"] = 0
+    bot_config["outbox"] = dict(
+        bot_config.get("outbox", {}), path=os.path.join(folder, "outbox.db")
+    )
+    bot_config["metrics"] = {"enabled": False, "window": max(200, events)}
+
+    motion_config = config["motion"]
+    motion_config["interval"] = 0
+    motion_config["debounce"] = 0.05
+    motion_config["release"] = 0.1
+    motion_config["schedule"] = [{"start": [0, 0], "end": [0, 0]}]
+
+    camera_config = config["camera"]
+    camera_config.setdefault("stream", {})["enabled"] = True
+    camera_config["stream"]["video"] = dict(
+        camera_config["stream"].get("video", {}), circular=False
+    )
+    camera_config["motion_confirm"] = dict(
+        camera_config.get("motion_confirm", {}), enabled=False
+    )
+    return config
+
+
+def percentile(values, fraction):
+    """Returns a percentile of a list of values, None if it is empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(fraction * (len(values) - 1))]
+
+
+async def run_scenario(name, base_config, timeout):
+    """Runs one scenario in this process and returns its results."""
+    fake_hardware.install()
+    # pylint: disable=import-outside-toplevel
+    from sentinel_camera import Camera
+    from sentinel_message_bot import MessageBot
+    from sentinel_motion import Motion
+
+    scenario = SCENARIOS[name]
+    events = scenario["events"]
+    folder = tempfile.mkdtemp(prefix="sentinel-bench-")
+    fake = FakeTelegram(
+        latency=scenario.get("latency", 0.05),
+        bandwidth_kbps=scenario.get("bandwidth_kbps", 0),
+        rate_limit_every=scenario.get("rate_limit_every", 0),
+    )
+    config = build_config(base_config, folder, fake.start(), events)
+
+    my_bot = MessageBot(config)
+    camera = Camera(config)
+    motion = Motion(config)
+    threading.Thread(target=camera.run, name="camera", daemon=True).start()
+    threading.Thread(target=motion.run, name="motion", daemon=True).start()
+    bot_task = asyncio.create_task(my_bot.run())
+
+    # wait for the camera and for the hello message of the bot
+    await asyncio.to_thread(camera.camera_ready.wait, timeout)
+    while fake.stats()["messages"] < 1 and not bot_task.done():
+        await asyncio.sleep(0.05)
+    if bot_task.done():
+        # raises what stopped the bot, e.g. a missing python-telegram-bot
+        bot_task.result()
+    await asyncio.sleep(scenario["period"])
+
+    edges = []
+    for idx in range(0, events):
+        edges.append((idx * scenario["period"], True))
+        edges.append((idx * scenario["period"] + PULSE, False))
+    start = time.time()
+    fake_hardware.play_pir(config["motion"]["pir_pin"], edges)
+
+    deadline = start + events * scenario["period"] + timeout
+    while fake.stats()["photos"] < events and time.time() < deadline:
+        await asyncio.sleep(0.1)
+
+    delivered = fake.stats()["photos"]
+    last_delivery = max((at_time for at_time, _ in fake.deliveries), default=start)
+    totals = list(my_bot.metrics.recent["total"])
+    result = {
+        "scenario": name,
+        "events": events,
+        "delivered": delivered,
+        "events_per_s": delivered / max(1e-6, last_delivery - start),
+        "p50_ms": 1000 * (percentile(totals, 0.5) or 0),
+        "p95_ms": 1000 * (percentile(totals, 0.95) or 0),
+        "p99_ms": 1000 * (percentile(totals, 0.99) or 0),
+        "dropped": events - delivered,
+        "queue_dropped": my_bot.dropped,
+        "rss_mb": fake_hardware.rss_kb() / 1024,
+        "telegram": fake.stats(),
+        "stages": {
+            stage: [round(values["p50"] * 1000, 1), round(values["p95"] * 1000, 1)]
+            for stage, values in my_bot.metrics.percentiles().items()
+            if stage != "total"
+        },
+    }
+
+    bot_task.cancel()
+    camera.picam2.stop()
+    fake.stop()
+    shutil.rmtree(folder, ignore_errors=True)
+    return result
+
+
+def print_result(result):
+    """Prints the results of a scenario."""
+    print(
+        f"{result['scenario']:<13} {result['delivered']:>3}/{result['events']:<3} "
+        f"{result['events_per_s']:6.2f} ev/s  "
+        f"p50={result['p50_ms']:.0f} p95={result['p95_ms']:.0f} "
+        f"p99={result['p99_ms']:.0f} ms  dropped={result['dropped']} "
+        f"(queue {result['queue_dropped']})  RSS={result['rss_mb']:.1f} MiB  "
+        f"429s={result['telegram']['rate_limited']}"
+    )
+    for stage, (p50, p95) in result["stages"].items():
+        print(f"    {stage:<9} p50={p50} p95={p95} ms")
+
+
+def main():
+    """Main function"""
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "-c",
+        "--conf",
+        default=os.path.join(ROOT, "config.json"),
+        help="path to the JSON configuration file",
+    )
+    ap.add_argument(
+        "-s", "--scenarios", nargs="+", default=list(SCENARIOS), help="scenarios"
+    )
+    ap.add_argument("-t", "--timeout", type=float, default=30, help="seconds")
+    ap.add_argument("--run", help=argparse.SUPPRESS)
+    args = vars(ap.parse_args())
+
+    if args["run"]:
+        with open(args["conf"], "r", encoding="utf-8") as read_file:
+            config = json.load(read_file)
+        result = asyncio.run(run_scenario(args["run"], config, args["timeout"]))
+        print(json.dumps(result))
+        return
+
+    # every scenario starts from a fresh process
+    for name in args["scenarios"]:
+        output = subprocess.run(
+            [
+                sys.executable,
+                os.path.realpath(__file__),
+                "-c",
+                args["conf"],
+                "-t",
+                str(args["timeout"]),
+                "--run",
+                name,
+            ],
+            capture_output=True,
+            text=True,
+            check=False,
+        )
+        if output.returncode != 0:
+            print(f"{name:<13} failed:\n{output.stderr}")
+            continue
+        print_result(json.loads(output.stdout.strip().splitlines()[-1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Compares the startup time and resident memory of the one-process-per-
+    service runtime with the single-process runtime. Every service reports
+    READY=1 on NOTIFY_SOCKET, like it does to systemd, and the memory is the
+    sum of VmRSS of all processes once they are ready. Run it on the Pi with
+    the services stopped, since both runtimes use the camera.
+
+    Usage: python3 benchmark/runtime_modes.py -c config.json
+"""
+
+import os
+import sys
+import argparse
+import socket
+import subprocess
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+MODES = {
+    "multi": [
+        "sentinel_message_bot.py",
+        "sentinel_camera.py",
+        "sentinel_motion.py",
+        "sentinel_telegram_handler.py",
+    ],
+    "single": ["sentinel.py"],
+}
+
+
+def rss_kb(pid):
+    """Returns the resident memory of a process in kB."""
+    with open(f"/proc/{pid}/status", "r", encoding="utf-8") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def run_mode(mode, config, timeout, settle):
+    """Starts the services of a mode and waits until all of them are ready.
+
+    Returns
+    -------
+    tuple
+        The startup time in seconds (None on timeout) and the total RSS in kB.
+    """
+    notify_path = os.path.join(tempfile.mkdtemp(), "notify.sock")
+    notify_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    notify_socket.bind(notify_path)
+    env = dict(os.environ, NOTIFY_SOCKET=notify_path)
+
+    start = time.perf_counter()
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, script), "-c", config], env=env
+        )
+        for script in MODES[mode]
+    ]
+
+    startup = None
+    ready = 0
+    deadline = start + timeout
+    try:
+        while ready < len(processes):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            notify_socket.settimeout(remaining)
+            try:
+                data = notify_socket.recv(256)
+            except socket.timeout:
+                break
+            if b"READY=1" in data.split(b"\n"):
+                ready += 1
+        else:
+            startup = time.perf_counter() - start
+
+        time.sleep(settle)
+        rss = sum(rss_kb(process.pid) for process in processes)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        notify_socket.close()
+        os.unlink(notify_path)
+    return startup, rss
+
+
+def main():
+    """Main function"""
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-c", "--conf", required=True, help="path to the config file")
+    ap.add_argument("-r", "--rounds", type=int, default=3, help="runs per mode")
+    ap.add_argument("-t", "--timeout", type=float, default=60, help="seconds")
+    ap.add_argument(
+        "-s", "--settle", type=float, default=5, help="seconds before reading RSS"
+    )
+    args = vars(ap.parse_args())
+    config = os.path.realpath(args["conf"])
+
+    for mode in MODES:
+        for idx in range(0, args["rounds"]):
+            startup, rss = run_mode(mode, config, args["timeout"], args["settle"])
+            if startup is None:
+                print(f"{mode:<6} run {idx}: not ready after {args['timeout']} s")
+                continue
+            print(
+                f"{mode:<6} run {idx}: {len(MODES[mode])} process(es)  "
+                f"ready in {startup:.2f} s  RSS {rss / 1024:.1f} MiB"
+            )
+
+
+if __name__ == "__main__":
+    main()
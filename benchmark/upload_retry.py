@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Checks that a clip retried after a 429 is uploaded whole again. The
+    fake Bot API rate limits every second request, so the first attempt
+    of each upload is answered with a retry-after and the bot has to send
+    the same file again. An MP4 goes through sendVideo, a raw H.264 clip
+    through the sendDocument fallback when ffmpeg is missing.
+
+    Usage: python3 benchmark/upload_retry.py -c config.json --kb 1000
+"""
+
+import os
+import sys
+import argparse
+import asyncio
+import copy
+import json
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+from fake_telegram import FakeTelegram
+from sentinel_message_bot import MessageBot
+
+
+async def upload(config, extension, size):
+    """Sends one clip through a rate limited fake and returns the attempts."""
+    fake = FakeTelegram(latency=0, rate_limit_every=2, retry_after=1)
+    config = copy.deepcopy(config)
+    config["bot"]["api_url"] = fake.start()
+    my_bot = MessageBot(config)
+    my_bot.bot = my_bot.create_bot()
+    my_bot.video_path.mkdir(parents=True, exist_ok=True)
+    with open(my_bot.video_path / ("clip" + extension), "wb") as clip:
+        clip.write(os.urandom(size))
+
+    async with my_bot.bot:
+        await my_bot.sendVideo(
+            {
+                "file_name": "clip",
+                "extension": extension,
+                "file_type": "H264",
+                "date": "2024-01-01",
+                "time": "00-00-00",
+            }
+        )
+    fake.stop()
+    return fake.uploads
+
+
+async def main():
+    """Main function"""
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "-c",
+        "--conf",
+        default=os.path.join(ROOT, "config.json"),
+        help="path to the JSON configuration file",
+    )
+    ap.add_argument("--kb", type=int, default=1000, help="size of the clip")
+    args = vars(ap.parse_args())
+    with open(args["conf"], "r", encoding="utf-8") as read_file:
+        config = json.load(read_file)
+
+    folder = tempfile.mkdtemp(prefix="sentinel-retry-")
+    config["photo_path"] = os.path.join(folder, "photos")
+    config["video_path"] = os.path.join(folder, "videos")
+    config["ipc"] = dict(config.get("ipc", {}), transport="inproc")
+    config["bot"]["rate_limit"] = {"rate": 100, "burst": 10, "max_retries": 3}
+
+    size = args["kb"] * 1000
+    failed = False
+    for extension in (".mp4", ".h264"):
+        uploads = await upload(config, extension, size)
+        whole = len(uploads) == 2 and all(length >= size for _, length in uploads)
+        failed = failed or not whole
+        print(
+            f"{extension}: {len(uploads)} attempts of "
+            f"{[length for _, length in uploads]} bytes for {size} bytes, "
+            + ("whole" if whole else "NOT whole")
+        )
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+import tracing
+
+
+class CommandScheduler:
+    """
+    Runs camera commands on worker lanes without blocking the receiver.
+
+    Every command is mapped to a lane, and each lane runs one command at a
+    time on its own thread, so a still can be taken while a video is being
+    recorded on another lane. A command arriving while the same command is
+    still pending in its lane is merged into the pending one. Within a lane,
+    motion-triggered commands run before manual ones.
+
+    ...
+
+    Methods
+    -------
+    start():
+        Starts one worker thread per lane.
+    submit(msg):
+        Queues a command.
+    stats():
+        Returns the queue wait time per command.
+    """
+
+    PRIORITY_MOTION = 0
+    PRIORITY_MANUAL = 1
+
+    def __init__(self, handlers, lanes):
+        """
+        Initializes the scheduler.
+
+        Parameters
+        ----------
+        handlers : dict
+            The handler of each command, called with the message.
+        lanes : dict
+            The lane of each command.
+        """
+        self.handlers = handlers
+        self.lanes = lanes
+        self.pending = {lane: [] for lane in set(lanes.values())}
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        self.waits = {cmd: deque(maxlen=100) for cmd in handlers}
+
+    def start(self):
+        """Starts one worker thread per lane."""
+        for lane in self.pending:
+            threading.Thread(
+                target=self.run_lane, args=(lane,), name="lane-" + lane, daemon=True
+            ).start()
+
+    def submit(self, msg):
+        """Queues a command.
+
+        Parameters
+        ----------
+        msg : dict
+            The command message.
+        """
+        if msg.get("cmd") not in self.handlers:
+            logging.error("Unknown camera command %s", msg.get("cmd"))
+            return
+
+        if msg.get("trigger") == "motion":
+            priority = self.PRIORITY_MOTION
+        else:
+            priority = self.PRIORITY_MANUAL
+
+        with self.condition:
+            pending = self.pending[self.lanes[msg["cmd"]]]
+            for entry in pending:
+                if entry["msg"]["cmd"] == msg["cmd"]:
+                    self.merge(entry, msg, priority)
+                    return
+
+            pending.append(
+                {
+                    "priority": priority,
+                    "seq": next(self.sequence),
+                    "received": time.time(),
+                    "merged": 0,
+                    "msg": msg,
+                }
+            )
+            self.condition.notify_all()
+
+    @staticmethod
+    def merge(entry, msg, priority):
+        """Merges a command into the same pending command.
+
+        The merged command takes the larger photo count (0 meaning the
+        maximum) and the earliest trigger time. It stays a motion trigger,
+        which is confirmed and alerted, if either command is one, and is
+        flagged `manual` when a manual command was merged in, so its photos
+        are taken even without confirmation. The trace of the merged
+        command is kept in the pending one.
+        """
+        pending_msg = entry["msg"]
+        if "count" in msg:
+            if msg["count"] == 0 or pending_msg.get("count") == 0:
+                pending_msg["count"] = 0
+            else:
+                pending_msg["count"] = max(pending_msg.get("count", 1), msg["count"])
+
+        if msg.get("timestamp") is not None:
+            pending_msg["timestamp"] = min(
+                pending_msg.get("timestamp") or msg["timestamp"], msg["timestamp"]
+            )
+
+        if msg.get("trigger") != pending_msg.get("trigger"):
+            pending_msg["trigger"] = "motion"
+            pending_msg["manual"] = True
+
+        if pending_msg.get("trace") is None:
+            pending_msg["trace"] = msg.get("trace")
+        elif msg.get("trace") is not None:
+            tracing.merge(pending_msg["trace"], msg["trace"])
+        entry["priority"] = min(entry["priority"], priority)
+        entry["merged"] += 1
+
+    def run_lane(self, lane):
+        """Runs the commands of a lane, one at a time."""
+        pending = self.pending[lane]
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: pending)
+                entry = min(pending, key=lambda item: (item["priority"], item["seq"]))
+                pending.remove(entry)
+
+            msg = entry["msg"]
+            wait = time.time() - entry["received"]
+            self.waits[msg["cmd"]].append(wait)
+            logging.info(
+                "%s waited %.3f s in the queue, %d merged",
+                msg["cmd"],
+                wait,
+                entry["merged"],
+            )
+
+            try:
+                self.handlers[msg["cmd"]](msg)
+            except Exception as exp:  # pylint: disable=broad-exception-caught
+                logging.error(exp)
+
+    def stats(self):
+        """Returns the queue wait time per command.
+
+        Returns
+        -------
+        dict
+            The number of recent commands, and their mean and maximum queue
+            wait in seconds, per command.
+        """
+        return {
+            cmd: {
+                "count": len(waits),
+                "mean_wait": sum(waits) / len(waits) if waits else 0.0,
+                "max_wait": max(waits, default=0.0),
+            }
+            for cmd, waits in self.waits.items()
+        }
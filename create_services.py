@@ -1,23 +1,40 @@
 import getpass
+import json
 import os, shutil
 import argparse
 
 ap = argparse.ArgumentParser()
 ap.add_argument("-c", "--config", required=True, help="Path to the config json file")
+ap.add_argument(
+    "-m",
+    "--mode",
+    default="multi",
+    choices=["multi", "single"],
+    help="One service per module, or a single all-in-one service",
+)
 args, unknown = ap.parse_known_args()
 
 config_file = os.path.realpath(args.config)
+with open(config_file, "r", encoding="utf-8") as read_file:
+    hub_role = json.load(read_file).get("hub", {}).get("role", "off")
 
 pwd = os.path.dirname(os.path.realpath(__file__))
 service_folder = "./service"
 user = getpass.getuser()
 
 service_files = []
-for dirpath, dirnames, files in os.walk("./"):
-    for name in files:
-        if name.lower().startswith("sentinel_"):
+if args.mode == "single":
+    service_files.append("sentinel")
+else:
+    for dirpath, dirnames, files in os.walk("./"):
+        for name in files:
+            if not name.lower().startswith("sentinel_"):
+                continue
+            # the hub handles the commands of its nodes
+            if hub_role == "node" and name == "sentinel_telegram_handler.py":
+                continue
             service_files.append(name[0:-3])
-    break
+        break
 
 
 if not os.path.exists(service_folder):
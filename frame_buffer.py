@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import threading
+
+import numpy as np
+
+
+class FrameRingBuffer:
+    """
+    A fixed-size ring buffer holding the most recent camera frames.
+
+    All slots are allocated once, so pushing a frame only copies pixels into
+    the oldest slot and never allocates memory on the capture path.
+
+    ...
+
+    Methods
+    -------
+    from_memory_cap(max_frames, max_bytes, shape, dtype):
+        Creates a buffer that fits into a memory budget.
+    push(timestamp, frame):
+        Stores a frame, overwriting the oldest one when full.
+    around(timestamp, count, window):
+        Returns copies of the frames closest to a timestamp.
+    """
+
+    def __init__(self, capacity, shape, dtype=np.uint8):
+        """
+        Initializes the ring buffer.
+
+        Parameters
+        ----------
+        capacity : int
+            The number of frames to keep.
+        shape : tuple
+            The shape of a single frame.
+        dtype : numpy.dtype, optional
+            The pixel type, by default numpy.uint8.
+        """
+        self.capacity = max(1, int(capacity))
+        self.shape = tuple(shape)
+        self.frames = np.empty((self.capacity,) + self.shape, dtype=dtype)
+        self.timestamps = np.zeros(self.capacity, dtype=np.float64)
+
+        self.head = 0
+        self.count = 0
+
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_memory_cap(cls, max_frames, max_bytes, shape, dtype=np.uint8):
+        """Creates a buffer holding at most `max_frames` within `max_bytes`.
+
+        Parameters
+        ----------
+        max_frames : int
+            The number of frames wanted.
+        max_bytes : int
+            The memory budget for the pixel data.
+        shape : tuple
+            The shape of a single frame.
+        dtype : numpy.dtype, optional
+            The pixel type, by default numpy.uint8.
+
+        Returns
+        -------
+        FrameRingBuffer
+            The new buffer, holding at least one frame.
+        """
+        frame_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        capacity = min(int(max_frames), int(max_bytes) // frame_bytes)
+        return cls(max(1, capacity), shape, dtype)
+
+    @property
+    def nbytes(self):
+        """int: The memory used by the pixel data."""
+        return self.frames.nbytes
+
+    def push(self, timestamp, frame):
+        """Stores a frame, overwriting the oldest one when full.
+
+        Parameters
+        ----------
+        timestamp : float
+            The capture time of the frame, in seconds since the epoch.
+        frame : numpy.ndarray
+            The frame, with the same shape as the buffer slots.
+        """
+        with self.lock:
+            self.frames[self.head] = frame
+            self.timestamps[self.head] = timestamp
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def _ordered(self):
+        """Returns the slot indices from the oldest to the newest frame."""
+        start = (self.head - self.count) % self.capacity
+        return [(start + idx) % self.capacity for idx in range(0, self.count)]
+
+    def around(self, timestamp, count, window):
+        """Returns copies of the frames closest to a timestamp.
+
+        Parameters
+        ----------
+        timestamp : float
+            The time of interest, usually the trigger time.
+        count : int
+            The maximum number of frames to return.
+        window : float
+            Frames older than `timestamp - window` are ignored.
+
+        Returns
+        -------
+        list of (float, numpy.ndarray)
+            Up to `count` frames in capture order.
+        """
+        with self.lock:
+            candidates = [
+                idx
+                for idx in self._ordered()
+                if self.timestamps[idx] >= timestamp - window
+            ]
+            candidates.sort(key=lambda idx: abs(self.timestamps[idx] - timestamp))
+            selected = sorted(candidates[:count], key=lambda idx: self.timestamps[idx])
+            return [
+                (float(self.timestamps[idx]), self.frames[idx].copy())
+                for idx in selected
+            ]
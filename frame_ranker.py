@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+
+class FrameRanker:
+    """
+    Picks the best frames of a burst by sharpness and motion.
+
+    Frames are scored on a downsampled luma plane, the whole burst at once.
+    The motion is the ratio of pixels that differ from the median of the
+    burst, the static scene, by more than `pixel_threshold`, so frames
+    showing whatever moved rank above empty ones. The sharpness is the
+    variance of the Laplacian within the changed pixels, which drops when
+    the subject is blurred by its motion, or within the whole frame when
+    too little changed. Both scores are scaled to the best frame of the
+    burst and weighted.
+
+    ...
+
+    Methods
+    -------
+    luma(frame):
+        Returns the downsampled luma plane of a frame.
+    rank(lumas, count):
+        Returns the indices of the best frames.
+    """
+
+    def __init__(self, config):
+        """
+        Initializes the ranker.
+
+        Parameters
+        ----------
+        config : dict
+            The `stream.select` configuration dictionary.
+        """
+        self.candidates = config.get("candidates", 8)
+        self.top_k = config.get("top_k", 3)
+        self.stride = config.get("stride", 4)
+        self.threshold = config.get("pixel_threshold", 25)
+        self.min_area = config.get("min_area", 0.002)
+        self.sharpness_weight = config.get("sharpness_weight", 1.0)
+        self.motion_weight = config.get("motion_weight", 1.0)
+
+    def luma(self, frame):
+        """Returns the downsampled luma plane of a frame.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            An RGB888 frame, or a luma plane.
+
+        Returns
+        -------
+        numpy.ndarray
+            The luma as float32, every `stride`-th pixel. The green channel
+            stands in for the luma, it carries most of it.
+        """
+        if frame.ndim == 3:
+            frame = frame[:, :, 1]
+        return frame[:: self.stride, :: self.stride].astype(np.float32)
+
+    def rank(self, lumas, count):
+        """Returns the indices of the best frames.
+
+        Parameters
+        ----------
+        lumas : list of numpy.ndarray
+            The planes returned by `luma`, in capture order.
+        count : int
+            The number of frames to keep.
+
+        Returns
+        -------
+        list of int, numpy.ndarray
+            The indices of the kept frames in capture order, and the score
+            of every frame.
+        """
+        stack = np.stack(lumas)
+
+        # 4 * center - up - down - left - right, squared
+        lap = np.multiply(stack[:, 1:-1, 1:-1], 4)
+        lap -= stack[:, :-2, 1:-1]
+        lap -= stack[:, 2:, 1:-1]
+        lap -= stack[:, 1:-1, :-2]
+        lap -= stack[:, 1:-1, 2:]
+        np.square(lap, out=lap)
+        sharpness = lap.mean(axis=(1, 2))
+
+        motion = np.zeros(len(lumas))
+        if len(lumas) > 2:
+            # the median of two frames is no background
+            changed = np.abs(stack - np.median(stack, axis=0)) > self.threshold
+            motion = np.count_nonzero(changed, axis=(1, 2)) / stack[0].size
+
+            inner = changed[:, 1:-1, 1:-1]
+            area = np.count_nonzero(inner, axis=(1, 2))
+            subject = np.einsum("ijk,ijk->i", lap, inner, dtype=np.float64)
+            sharpness = np.where(
+                area >= self.min_area * inner[0].size,
+                subject / np.maximum(area, 1),
+                sharpness,
+            )
+
+        scores = self.sharpness_weight * sharpness / max(sharpness.max(), 1e-6)
+        scores += self.motion_weight * motion / max(motion.max(), 1e-6)
+        best = np.argsort(-scores, kind="stable")[:count]
+        return sorted(best.tolist()), scores
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Many Sentinel units sharing one Telegram bot. With the "node" role the
+    bot of a unit opens no Telegram session, it forwards its alerts and
+    media to the hub over the acknowledged TCP transport of ipc.py, with
+    the photos and clips inlined into the messages. The unit with the
+    "hub" role delivers them through its single bot session and routes
+    commands back to the camera of a node, found by its `name`. Beyond the
+    loopback, the messages both ways carry a shared `secret`.
+"""
+
+import hmac
+import ipaddress
+import re
+import socket
+
+import ipc
+
+# clips are forwarded in chunks, well below ipc.MAX_FRAME
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def role(config):
+    """Returns the hub role of a unit, "off", "node" or "hub"."""
+    return config.get("hub", {}).get("role", "off")
+
+
+def address(hub_config):
+    """Returns the (host, port) TCP address of the hub."""
+    return (hub_config.get("host", "127.0.0.1"), hub_config.get("port", 6670))
+
+
+def is_loopback(host):
+    """Tells if a host name or address only listens on the local machine."""
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+def listen_address(hub_config, port):
+    """Returns the (host, port) TCP address the hub or a node listens on.
+
+    Raises
+    ------
+    ValueError
+        If `bind` is reachable from the network and there is no `secret`.
+    """
+    host = hub_config.get("bind", "127.0.0.1")
+    if not is_loopback(host) and not hub_config.get("secret"):
+        raise ValueError("hub.bind " + host + " needs a hub.secret")
+    return (host, port)
+
+
+def sign(msg, secret):
+    """Returns a copy of a message carrying the shared secret."""
+    return dict(msg, secret=secret)
+
+
+def verify(msg, secret):
+    """Removes the secret from a received message and checks it."""
+    received = str(msg.pop("secret", ""))
+    return hmac.compare_digest(received.encode(), secret.encode())
+
+
+def local_ip(remote):
+    """Returns the local address used to reach a remote (host, port)."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        # a UDP connect sends nothing, it only picks the route
+        probe.connect(remote)
+        return probe.getsockname()[0]
+
+
+def slug(name):
+    """Turns a node name into a file name prefix."""
+    return re.sub(r"\W+", "_", name).strip("_")
+
+
+class NodeRegistry:
+    """
+    The nodes known to the hub and the clients sending them commands.
+
+    Nodes introduce themselves with a `node_hello` message carrying their
+    name and command address, and repeat it, so a restarted hub learns
+    them again.
+
+    ...
+
+    Methods
+    -------
+    register(hello):
+        Adds a node, or updates its command address.
+    names():
+        Returns the names of the known nodes.
+    send(name, msg):
+        Sends a command to a node.
+    """
+
+    def __init__(self, ipc_config, secret=""):
+        """
+        Initializes the registry.
+
+        Parameters
+        ----------
+        ipc_config : dict
+            The `ipc` configuration dictionary, for the command clients.
+        secret : str, optional
+            The shared secret added to the commands.
+        """
+        self.ipc_config = ipc_config
+        self.secret = secret
+        self.nodes = {}
+
+    def register(self, hello):
+        """Adds a node, or updates its command address.
+
+        Parameters
+        ----------
+        hello : dict
+            The `node_hello` message with the `node` name and its command
+            `address` as [host, port].
+        """
+        node_address = tuple(hello["address"])
+        known = self.nodes.get(hello["node"])
+        if known is not None:
+            if known[0] == node_address:
+                return
+            # the node moved, the client of the old address goes
+            known[1].close()
+        self.nodes[hello["node"]] = (
+            node_address,
+            ipc.IpcClient(
+                node_address,
+                queue_size=self.ipc_config.get("queue_size", 256),
+                window=self.ipc_config.get("window", 32),
+                send_timeout=self.ipc_config.get("send_timeout", 1.0),
+            ),
+        )
+
+    def names(self):
+        """Returns the names of the known nodes."""
+        return list(self.nodes)
+
+    def send(self, name, msg):
+        """Sends a command to a node without blocking.
+
+        Returns
+        -------
+        bool
+            False if the node is unknown or its queue is full.
+        """
+        node = self.nodes.get(name)
+        if node is None:
+            return False
+        return node[1].send(sign(msg, self.secret), timeout=0)
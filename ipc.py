@@ -0,0 +1,695 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Messaging between the Sentinel services.
+
+    Messages are dictionaries. With the "unix" transport they are encoded
+    in a compact binary format and sent as framed, sequenced messages over
+    Unix domain sockets. Every message is acknowledged by the receiver, the
+    sender keeps a bounded queue and a window of unacknowledged messages,
+    and resends them after reconnecting to a restarted receiver. The "udp"
+    transport keeps the original fire-and-forget JSON datagrams, and the
+    "inproc" transport passes the dictionaries directly between services
+    running in one process.
+"""
+
+import os
+import asyncio
+import itertools
+import json
+import logging
+import queue
+import socket
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+
+# frame header: payload length, frame type, sequence number
+HEADER = struct.Struct("!IBI")
+
+FRAME_HELLO = 1
+FRAME_MSG = 2
+FRAME_ACK = 3
+
+MAX_FRAME = 16 * 1024 * 1024
+
+
+def _write_varint(buf, value):
+    while value > 0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _encode(buf, obj):
+    if obj is None:
+        buf += b"N"
+    elif obj is True:
+        buf += b"T"
+    elif obj is False:
+        buf += b"F"
+    elif isinstance(obj, int):
+        buf += b"i"
+        # zigzag, so small negative numbers stay short
+        _write_varint(buf, (obj << 1) if obj >= 0 else ((-obj << 1) - 1))
+    elif isinstance(obj, float):
+        buf += b"d"
+        buf += struct.pack("!d", obj)
+    elif isinstance(obj, str):
+        data = obj.encode()
+        buf += b"s"
+        _write_varint(buf, len(data))
+        buf += data
+    elif isinstance(obj, (bytes, bytearray)):
+        buf += b"b"
+        _write_varint(buf, len(obj))
+        buf += obj
+    elif isinstance(obj, (list, tuple)):
+        buf += b"l"
+        _write_varint(buf, len(obj))
+        for item in obj:
+            _encode(buf, item)
+    elif isinstance(obj, dict):
+        buf += b"m"
+        _write_varint(buf, len(obj))
+        for key, value in obj.items():
+            _encode(buf, key)
+            _encode(buf, value)
+    else:
+        raise TypeError("Cannot encode " + type(obj).__name__)
+
+
+def _decode(data, pos):
+    tag = data[pos : pos + 1]
+    pos += 1
+    if tag == b"N":
+        return None, pos
+    if tag == b"T":
+        return True, pos
+    if tag == b"F":
+        return False, pos
+    if tag == b"i":
+        value, pos = _read_varint(data, pos)
+        return (value >> 1) if not value & 1 else -((value + 1) >> 1), pos
+    if tag == b"d":
+        return struct.unpack_from("!d", data, pos)[0], pos + 8
+    if tag in (b"s", b"b"):
+        length, pos = _read_varint(data, pos)
+        value = bytes(data[pos : pos + length])
+        return (value.decode() if tag == b"s" else value), pos + length
+    if tag == b"l":
+        length, pos = _read_varint(data, pos)
+        items = []
+        for _ in range(0, length):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return items, pos
+    if tag == b"m":
+        length, pos = _read_varint(data, pos)
+        items = {}
+        for _ in range(0, length):
+            key, pos = _decode(data, pos)
+            items[key], pos = _decode(data, pos)
+        return items, pos
+    raise ValueError("Unknown tag " + repr(tag))
+
+
+def encode(msg):
+    """Encodes a message into the compact binary format.
+
+    Parameters
+    ----------
+    msg : dict
+        The message, made of None, bool, int, float, str, bytes, lists and
+        dictionaries.
+
+    Returns
+    -------
+    bytes
+        The encoded message.
+    """
+    buf = bytearray()
+    _encode(buf, msg)
+    return bytes(buf)
+
+
+def decode(data):
+    """Decodes a message encoded by `encode`.
+
+    Parameters
+    ----------
+    data : bytes
+        The encoded message.
+
+    Returns
+    -------
+    dict
+        The message.
+    """
+    return _decode(data, 0)[0]
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionResetError("Connection closed")
+        buf += chunk
+    return bytes(buf)
+
+
+def read_frame(sock):
+    """Reads one frame from a blocking socket.
+
+    Returns
+    -------
+    int, int, bytes
+        The frame type, the sequence number and the payload.
+    """
+    length, frame_type, seq = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    if length > MAX_FRAME:
+        raise ValueError("Frame too large")
+    return frame_type, seq, _recv_exactly(sock, length)
+
+
+def write_frame(sock, frame_type, seq, payload=b""):
+    """Writes one frame to a blocking socket."""
+    sock.sendall(HEADER.pack(len(payload), frame_type, seq) + payload)
+
+
+def socket_path(config, service):
+    """Returns the Unix socket path of a service.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary.
+    service : str
+        The service name, "camera", "bot" or "motion".
+    """
+    socket_dir = config.get("ipc", {}).get("socket_dir", "/tmp/sentinel")
+    return os.path.join(socket_dir, service + ".sock")
+
+
+def transport(config):
+    """Returns the configured transport, "unix", "udp" or "inproc"."""
+    return config.get("ipc", {}).get("transport", "udp")
+
+
+def notify_ready():
+    """Tells systemd, or whoever set NOTIFY_SOCKET, that a service is ready."""
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+        try:
+            notify_socket.sendto(b"READY=1", address)
+        except OSError as err:
+            logging.error(err)
+
+
+# receivers of the "inproc" transport, and messages sent before they registered
+_inproc_receivers = {}
+_inproc_pending = {}
+_inproc_lock = threading.Lock()
+
+
+def register(service, handler, loop=None):
+    """Registers the receiver of a service for the "inproc" transport.
+
+    Parameters
+    ----------
+    service : str
+        The service name.
+    handler : callable
+        Called with every message. It must not block.
+    loop : asyncio.AbstractEventLoop, optional
+        The event loop the handler has to run on, if any.
+    """
+    with _inproc_lock:
+        _inproc_receivers[service] = (handler, loop)
+        pending = _inproc_pending.pop(service, [])
+    for msg in pending:
+        _deliver(handler, loop, msg)
+
+
+def _deliver(handler, loop, msg):
+    if loop is None:
+        handler(msg)
+    else:
+        loop.call_soon_threadsafe(handler, msg)
+
+
+class InprocClient:
+    """
+    Passes messages to a service running in the same process.
+
+    Messages sent before the receiver registered are kept, up to
+    `queue_size`, and delivered on registration.
+    """
+
+    def __init__(self, service, queue_size=256):
+        self.service = service
+        self.queue_size = queue_size
+        self.dropped = 0
+
+    def send(self, msg, timeout=None):  # pylint: disable=unused-argument
+        """Delivers a message, returns False if it had to be dropped."""
+        with _inproc_lock:
+            receiver = _inproc_receivers.get(self.service)
+            if receiver is None:
+                pending = _inproc_pending.setdefault(
+                    self.service, deque(maxlen=self.queue_size)
+                )
+                if len(pending) == self.queue_size:
+                    self.dropped += 1
+                pending.append(msg)
+                return True
+        _deliver(receiver[0], receiver[1], msg)
+        return True
+
+    def stats(self):
+        """Returns the client counters."""
+        return {"dropped": self.dropped}
+
+
+class UdpClient:
+    """
+    Sends JSON datagrams to a service, the original fire-and-forget path.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.dropped = 0
+
+    def send(self, msg, timeout=None):  # pylint: disable=unused-argument
+        """Sends a message, returns True once it is handed to the kernel."""
+        payload = json.dumps(msg)
+        self.udp_socket.sendto(payload.encode(), ("127.0.0.1", self.port))
+        return True
+
+    def stats(self):
+        """Returns the client counters."""
+        return {"dropped": self.dropped}
+
+
+class IpcClient:
+    """
+    Sends acknowledged messages to a service over a stream socket.
+
+    Messages wait in a bounded queue; `send` blocks while the queue is full,
+    which slows the producer down to the pace of the receiver. A background
+    thread keeps the connection up, sends queued messages within a window
+    of unacknowledged ones, and resends the unacknowledged messages in order
+    after reconnecting.
+
+    ...
+
+    Methods
+    -------
+    send(msg, timeout=None):
+        Queues a message for sending.
+    stats():
+        Returns the client counters.
+    close():
+        Stops the connection thread.
+    """
+
+    def __init__(self, address, queue_size=256, window=32, send_timeout=1.0):
+        """
+        Initializes the client and starts its connection thread.
+
+        Parameters
+        ----------
+        address : str or tuple
+            The Unix socket path, or a (host, port) TCP address.
+        queue_size : int, optional
+            The number of messages waiting to be sent, by default 256.
+        window : int, optional
+            The number of messages in flight without an ack, by default 32.
+        send_timeout : float, optional
+            The default time `send` waits for room in the queue.
+        """
+        self.address = address
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.window = window
+        self.send_timeout = send_timeout
+
+        self.client_id = uuid.uuid4().bytes
+        self.sequence = itertools.count(1)
+        self.unacked = OrderedDict()
+        self.condition = threading.Condition()
+        self.connected = False
+        self.closed = False
+        self.sock = None
+
+        self.dropped = 0
+        self.connections = 0
+
+        threading.Thread(target=self.run, name="ipc-client", daemon=True).start()
+
+    def send(self, msg, timeout=None):
+        """Queues a message for sending.
+
+        Parameters
+        ----------
+        msg : dict
+            The message.
+        timeout : float, optional
+            The time to wait for room in the queue, by default `send_timeout`.
+            0 never blocks.
+
+        Returns
+        -------
+        bool
+            False if the queue stayed full and the message was dropped.
+        """
+        if timeout is None:
+            timeout = self.send_timeout
+        try:
+            self.queue.put(encode(msg), block=timeout > 0, timeout=timeout or None)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logging.error("IPC queue to %s is full, message dropped", self.address)
+            return False
+
+    def stats(self):
+        """Returns the client counters."""
+        return {
+            "queued": self.queue.qsize(),
+            "unacked": len(self.unacked),
+            "dropped": self.dropped,
+            "connections": self.connections,
+        }
+
+    def close(self):
+        """Stops the connection thread, the messages not sent are dropped."""
+        with self.condition:
+            self.closed = True
+            self.connected = False
+            self.condition.notify_all()
+            sock = self.sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def connect(self):
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def read_acks(self, sock):
+        try:
+            while True:
+                frame_type, seq, _ = read_frame(sock)
+                if frame_type == FRAME_ACK:
+                    with self.condition:
+                        while self.unacked and next(iter(self.unacked)) <= seq:
+                            self.unacked.popitem(last=False)
+                        self.condition.notify_all()
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self.condition:
+                self.connected = False
+                self.condition.notify_all()
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self):
+        backoff = 0.05
+        while not self.closed:
+            try:
+                sock = self.connect()
+            except OSError:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 2.0)
+                continue
+
+            backoff = 0.05
+            self.connections += 1
+            with self.condition:
+                if self.closed:
+                    sock.close()
+                    return
+                self.sock = sock
+                self.connected = True
+                pending = list(self.unacked.items())
+            threading.Thread(
+                target=self.read_acks, args=(sock,), name="ipc-acks", daemon=True
+            ).start()
+
+            try:
+                write_frame(sock, FRAME_HELLO, 0, self.client_id)
+                for seq, payload in pending:
+                    write_frame(sock, FRAME_MSG, seq, payload)
+                self.send_loop(sock)
+            except OSError:
+                pass
+            finally:
+                sock.close()
+
+    def send_loop(self, sock):
+        while True:
+            try:
+                payload = self.queue.get(timeout=1)
+            except queue.Empty:
+                if not self.connected:
+                    return
+                continue
+
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: len(self.unacked) < self.window or not self.connected
+                )
+                # keep the message even if the connection dropped meanwhile,
+                # it is resent after reconnecting
+                seq = next(self.sequence)
+                self.unacked[seq] = payload
+                if not self.connected:
+                    return
+
+            write_frame(sock, FRAME_MSG, seq, payload)
+
+
+class IpcServer:
+    """
+    Receives acknowledged messages on a stream socket, one thread per peer.
+
+    Every message is passed to the handler before it is acknowledged, so a
+    busy handler slows the senders down instead of losing messages.
+    Messages resent after a reconnect are recognized by their sequence
+    number and only acknowledged again.
+    """
+
+    def __init__(self, address, handler):
+        """
+        Initializes the server.
+
+        Parameters
+        ----------
+        address : str or tuple
+            The Unix socket path, or a (host, port) TCP address.
+        handler : callable
+            Called with every received message.
+        """
+        self.address = address
+        self.handler = handler
+        self.last_seq = {}
+        self.lock = threading.Lock()
+
+    def bind(self):
+        if isinstance(self.address, str):
+            os.makedirs(os.path.dirname(self.address), mode=0o700, exist_ok=True)
+            try:
+                os.remove(self.address)
+            except FileNotFoundError:
+                pass
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(self.address)
+        server.listen()
+        return server
+
+    def serve_forever(self):
+        """Binds the socket and accepts peers until the process ends."""
+        self.accept_loop(self.bind())
+
+    def start(self):
+        """Binds the socket and accepts peers on a background thread."""
+        threading.Thread(
+            target=self.accept_loop, args=(self.bind(),), name="ipc-server", daemon=True
+        ).start()
+
+    def accept_loop(self, server):
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(
+                target=self.serve_peer, args=(conn,), name="ipc-peer", daemon=True
+            ).start()
+
+    def serve_peer(self, conn):
+        client_id = b""
+        try:
+            while True:
+                frame_type, seq, payload = read_frame(conn)
+                if frame_type == FRAME_HELLO:
+                    client_id = payload
+                    continue
+                if frame_type != FRAME_MSG:
+                    continue
+
+                with self.lock:
+                    duplicate = seq <= self.last_seq.get(client_id, 0)
+                if not duplicate:
+                    try:
+                        self.handler(decode(payload))
+                    except Exception as exp:  # pylint: disable=broad-exception-caught
+                        logging.error(exp)
+                    with self.lock:
+                        self.last_seq[client_id] = seq
+                write_frame(conn, FRAME_ACK, seq)
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+
+class AsyncIpcServer:
+    """
+    The asyncio counterpart of `IpcServer`, with a coroutine handler.
+    """
+
+    def __init__(self, address, handler):
+        """
+        Initializes the server.
+
+        Parameters
+        ----------
+        address : str or tuple
+            The Unix socket path, or a (host, port) TCP address.
+        handler : coroutine function
+            Awaited with every received message.
+        """
+        self.address = address
+        self.handler = handler
+        self.last_seq = {}
+
+    async def start(self):
+        """Binds the socket and returns the asyncio server."""
+        if isinstance(self.address, str):
+            os.makedirs(os.path.dirname(self.address), mode=0o700, exist_ok=True)
+            try:
+                os.remove(self.address)
+            except FileNotFoundError:
+                pass
+            return await asyncio.start_unix_server(self.serve_peer, path=self.address)
+        return await asyncio.start_server(
+            self.serve_peer, host=self.address[0], port=self.address[1]
+        )
+
+    async def serve_peer(self, reader, writer):
+        client_id = b""
+        try:
+            while True:
+                length, frame_type, seq = HEADER.unpack(
+                    await reader.readexactly(HEADER.size)
+                )
+                if length > MAX_FRAME:
+                    raise ValueError("Frame too large")
+                payload = await reader.readexactly(length)
+                if frame_type == FRAME_HELLO:
+                    client_id = payload
+                    continue
+                if frame_type != FRAME_MSG:
+                    continue
+
+                if seq > self.last_seq.get(client_id, 0):
+                    try:
+                        await self.handler(decode(payload))
+                    except Exception as exp:  # pylint: disable=broad-exception-caught
+                        logging.error(exp)
+                    self.last_seq[client_id] = seq
+                writer.write(HEADER.pack(0, FRAME_ACK, seq))
+                await writer.drain()
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def connect(config, service):
+    """Returns a client sending messages to a Sentinel service.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary.
+    service : str
+        The service name, "camera", "bot" or "motion".
+
+    Returns
+    -------
+    IpcClient, UdpClient or InprocClient
+        The client for the configured transport.
+    """
+    ipc_config = config.get("ipc", {})
+    if transport(config) == "inproc":
+        return InprocClient(service, queue_size=ipc_config.get("queue_size", 256))
+    if transport(config) == "unix":
+        return IpcClient(
+            socket_path(config, service),
+            queue_size=ipc_config.get("queue_size", 256),
+            window=ipc_config.get("window", 32),
+            send_timeout=ipc_config.get("send_timeout", 1.0),
+        )
+    return UdpClient(config[service]["listen_port"])
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    A live view of the low-res stream over local HTTP. The hardware encoder
+    compresses each frame once, and the broadcaster hands the same buffer
+    to every viewer. Each viewer has a short queue that drops its oldest
+    frames when the viewer falls behind, so a slow viewer only sees a lower
+    frame rate and never holds back the camera. The H.264 segments of the
+    optional HLS stream are written by ffmpeg and served from the same
+    server.
+"""
+
+import os
+import hmac
+import logging
+import socket
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import hub
+
+BOUNDARY = b"FRAME"
+
+# a few frames at most wait in the kernel, the rest is dropped by the queue
+SEND_BUFFER = 64 * 1024
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta name="viewport" content="width=device-width">
+<title>Sentinel</title></head>
+<body style="margin:0;background:#000">
+<img src="stream.mjpg{query}" style="width:100%">
+</body></html>
+"""
+
+CONTENT_TYPES = {".m3u8": "application/vnd.apple.mpegurl", ".ts": "video/mp2t"}
+
+
+def url(config):
+    """Returns the address of the live view page.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary.
+
+    Returns
+    -------
+    str
+        The configured `url`, or the page on the address the view listens
+        on, the local address of the unit when it listens on all of them.
+    """
+    live_config = config["camera"].get("stream", {}).get("live", {})
+    if live_config.get("url"):
+        return live_config["url"]
+    host = live_config.get("listen", "127.0.0.1")
+    if host in ("", "0.0.0.0", "::"):
+        try:
+            host = hub.local_ip(("8.8.8.8", 53))
+        except OSError:
+            host = socket.gethostname()
+    if ":" in host:
+        host = "[" + host + "]"
+    page = f"http://{host}:{live_config.get('port', 8080)}/"
+    if live_config.get("token"):
+        page += "?token=" + live_config["token"]
+    return page
+
+
+class Viewer:
+    """The frames waiting for one viewer."""
+
+    def __init__(self, queue_size):
+        self.frames = deque(maxlen=queue_size)
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+
+
+class FrameBroadcaster:
+    """
+    Fans encoded frames out to the viewers without copying them.
+
+    It is used as a Picamera2 output: the encoder calls `outputframe` with
+    every frame, which is appended by reference to the queue of each
+    viewer. The encoder only runs while someone is watching, `on_active` is
+    called when the first viewer arrives and after the last one leaves.
+
+    ...
+
+    Methods
+    -------
+    outputframe(frame, keyframe=True, timestamp=None, packet=None, audio=False):
+        Hands an encoded frame to every viewer.
+    subscribe():
+        Adds a viewer, None if there are too many.
+    unsubscribe(viewer):
+        Removes a viewer.
+    get(viewer, timeout):
+        Waits for the next frame of a viewer.
+    snapshot(timeout):
+        Returns a current frame.
+    stats():
+        Returns the frame and viewer counters.
+    """
+
+    def __init__(self, queue_size=2, max_viewers=8, on_active=None):
+        """
+        Initializes the broadcaster.
+
+        Parameters
+        ----------
+        queue_size : int, optional
+            The frames kept per viewer, older frames are dropped.
+        max_viewers : int, optional
+            The number of viewers served at once.
+        on_active : callable, optional
+            Called with True when the first viewer arrives and with False
+            when the last one leaves.
+        """
+        self.queue_size = max(1, queue_size)
+        self.max_viewers = max_viewers
+        self.on_active = on_active
+
+        self.condition = threading.Condition()
+        self.viewers = []
+        self.latest = None
+        self.frames = 0
+        self.dropped = 0
+
+    def start(self):
+        """Called by the encoder when it starts."""
+
+    def stop(self):
+        """Called by the encoder when it stops."""
+
+    def outputframe(
+        self, frame, keyframe=True, timestamp=None, packet=None, audio=False
+    ):
+        """Hands an encoded frame to every viewer.
+
+        Runs on the encoder thread and never blocks on a viewer.
+
+        Parameters
+        ----------
+        frame : bytes
+            The encoded frame, shared by all viewers.
+        keyframe : bool, optional
+            Unused, every JPEG is a key frame.
+        timestamp : int, optional
+            Unused.
+        packet, audio : optional
+            Unused, for the outputs muxing audio.
+        """
+        # pylint: disable=unused-argument
+        with self.condition:
+            self.latest = frame
+            self.frames += 1
+            for viewer in self.viewers:
+                if len(viewer.frames) == viewer.frames.maxlen:
+                    # the append pushes out the oldest frame
+                    viewer.dropped += 1
+                    self.dropped += 1
+                viewer.frames.append(frame)
+            self.condition.notify_all()
+
+    def subscribe(self):
+        """Adds a viewer.
+
+        Returns
+        -------
+        Viewer or None
+            The viewer, None if `max_viewers` are already watching.
+        """
+        with self.condition:
+            if len(self.viewers) >= self.max_viewers:
+                return None
+            viewer = Viewer(self.queue_size)
+            self.viewers.append(viewer)
+            first = len(self.viewers) == 1
+        if first and self.on_active is not None:
+            self.on_active(True)
+        return viewer
+
+    def unsubscribe(self, viewer):
+        """Removes a viewer."""
+        with self.condition:
+            if viewer not in self.viewers:
+                return
+            self.viewers.remove(viewer)
+            viewer.closed = True
+            last = not self.viewers
+            if last:
+                self.latest = None
+            self.condition.notify_all()
+        if last and self.on_active is not None:
+            self.on_active(False)
+
+    def get(self, viewer, timeout):
+        """Waits for the next frame of a viewer.
+
+        Returns
+        -------
+        bytes or None
+            The frame, None on timeout or when the viewer was removed.
+        """
+        with self.condition:
+            if not self.condition.wait_for(
+                lambda: viewer.frames or viewer.closed, timeout
+            ):
+                return None
+            if viewer.closed:
+                return None
+            viewer.sent += 1
+            return viewer.frames.popleft()
+
+    def snapshot(self, timeout):
+        """Returns the latest frame, waiting for one while the encoder starts."""
+        viewer = self.subscribe()
+        if viewer is None:
+            return self.latest
+        try:
+            return self.get(viewer, timeout)
+        finally:
+            self.unsubscribe(viewer)
+
+    def stats(self):
+        """Returns the frame and viewer counters."""
+        with self.condition:
+            return {
+                "frames": self.frames,
+                "dropped": self.dropped,
+                "viewers": [
+                    {"sent": viewer.sent, "dropped": viewer.dropped}
+                    for viewer in self.viewers
+                ],
+            }
+
+
+class LiveViewHandler(BaseHTTPRequestHandler):
+    """Serves the page, the MJPEG stream, a snapshot and the HLS files."""
+
+    # a stalled viewer is let go instead of holding a thread forever
+    timeout = 10
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        logging.debug("Live view %s: " + format, self.client_address[0], *args)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        request = urlparse(self.path)
+        live_config = self.server.live_config
+        token = live_config.get("token", "")
+        if token and not hmac.compare_digest(
+            parse_qs(request.query).get("token", [""])[0].encode(), token.encode()
+        ):
+            self.send_error(403)
+            return
+
+        query = "?" + request.query if request.query else ""
+        if request.path in ("/", "/index.html"):
+            self.send_body(PAGE.format(query=query).encode(), "text/html")
+        elif request.path == "/stream.mjpg":
+            self.stream()
+        elif request.path == "/snapshot.jpg":
+            frame = self.server.broadcaster.snapshot(self.timeout)
+            if frame is None:
+                self.send_error(503)
+            else:
+                self.send_body(frame, "image/jpeg")
+        elif request.path.startswith("/hls/") and live_config.get("hls", {}).get(
+            "enabled", False
+        ):
+            self.send_segment(os.path.basename(request.path))
+        else:
+            self.send_error(404)
+
+    def send_body(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_segment(self, name):
+        content_type = CONTENT_TYPES.get(os.path.splitext(name)[1])
+        folder = self.server.live_config["hls"].get("path", "/dev/shm/sentinel/live")
+        if content_type is None:
+            self.send_error(404)
+            return
+        try:
+            with open(os.path.join(folder, name), "rb") as segment:
+                body = segment.read()
+        except OSError:
+            self.send_error(404)
+            return
+        self.send_body(body, content_type)
+
+    def stream(self):
+        broadcaster = self.server.broadcaster
+        viewer = broadcaster.subscribe()
+        if viewer is None:
+            self.send_error(503, "Too many viewers")
+            return
+
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+        self.send_response(200)
+        self.send_header("Cache-Control", "no-cache, private")
+        self.send_header(
+            "Content-Type",
+            "multipart/x-mixed-replace; boundary=" + BOUNDARY.decode(),
+        )
+        self.end_headers()
+        try:
+            while True:
+                frame = broadcaster.get(viewer, self.timeout)
+                if frame is None:
+                    break
+                # the shared buffer goes to the socket as is, not joined
+                self.wfile.write(
+                    b"--%s\r\nContent-Type: image/jpeg\r\n"
+                    b"Content-Length: %d\r\n\r\n" % (BOUNDARY, len(frame))
+                )
+                self.wfile.write(frame)
+                self.wfile.write(b"\r\n")
+        except OSError:
+            # the viewer went away
+            pass
+        finally:
+            broadcaster.unsubscribe(viewer)
+
+
+class LiveViewServer:
+    """
+    The HTTP server of the live view.
+
+    ...
+
+    Methods
+    -------
+    start():
+        Serves on a background thread.
+    stop():
+        Stops serving and lets the viewers go.
+    """
+
+    def __init__(self, live_config, broadcaster):
+        """
+        Initializes the server.
+
+        Parameters
+        ----------
+        live_config : dict
+            The `stream.live` configuration dictionary.
+        broadcaster : FrameBroadcaster
+            The source of the frames.
+
+        Raises
+        ------
+        ValueError
+            If `listen` is reachable from the network and there is no `token`.
+        """
+        listen = live_config.get("listen", "127.0.0.1")
+        if not hub.is_loopback(listen) and not live_config.get("token"):
+            raise ValueError("camera.stream.live.listen " + listen + " needs a token")
+        self.server = ThreadingHTTPServer(
+            (listen, live_config.get("port", 8080)), LiveViewHandler
+        )
+        self.server.daemon_threads = True
+        self.server.live_config = live_config
+        self.server.broadcaster = broadcaster
+        self.broadcaster = broadcaster
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="live-view", daemon=True
+        )
+
+    @property
+    def port(self):
+        """The bound port, useful when port 0 picked a free one."""
+        return self.server.server_address[1]
+
+    def start(self):
+        """Serves on a background thread."""
+        self.thread.start()
+        logging.info("Live view on port %d", self.port)
+
+    def stop(self):
+        """Stops serving and lets the viewers go."""
+        self.server.shutdown()
+        self.server.server_close()
+        with self.broadcaster.condition:
+            viewers = list(self.broadcaster.viewers)
+        for viewer in viewers:
+            self.broadcaster.unsubscribe(viewer)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import logging
+import sqlite3
+import threading
+import time
+
+# the databases next to the photos are not media
+SKIP_SUFFIXES = (".db", ".db-wal", ".db-shm", ".tmp")
+
+# media still waiting for delivery are evicted last
+WAITING = ("pending", "queued")
+
+
+def _path(file):
+    return os.path.abspath(str(file))
+
+
+class MediaStore:
+    """
+    An index of the events and a retention policy for their media on disk.
+
+    Every alert, photo and clip is an event with its time, kind, unit, size
+    and delivery status, and the files it leaves on the disk are tracked
+    with it. A sweep forgets files that were deleted after delivery,
+    deletes files older than `max_days`, and evicts the least recently used
+    files while the total is over `max_mb`, keeping media that still wait
+    for delivery for last. The index is an SQLite database in WAL mode, so
+    the history is answered without scanning the media folders.
+
+    ...
+
+    Methods
+    -------
+    configure(config):
+        Applies the retention limits.
+    add(kind, key, node, files=()):
+        Records an event and its files, returns the event id.
+    track(event_id, files):
+        Adds files produced later for an event.
+    touch(file):
+        Marks a file as recently used.
+    set_status(event_ids, status):
+        Updates the delivery status of events.
+    adopt(folders):
+        Indexes the media left in folders by earlier runs.
+    sweep():
+        Applies the retention policy.
+    history(since):
+        Returns the events since a time.
+    """
+
+    def __init__(self, config, default_path):
+        """
+        Initializes the store.
+
+        Parameters
+        ----------
+        config : dict
+            The `media_store` configuration dictionary.
+        default_path : str or Path
+            The database file used when the configuration has no `path`.
+        """
+        self.path = config.get("path", str(default_path))
+        self.configure(config)
+
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        # the sweep runs on a worker thread
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " key TEXT NOT NULL,"
+            " kind TEXT NOT NULL,"
+            " node TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " size INTEGER NOT NULL DEFAULT 0,"
+            " status TEXT NOT NULL DEFAULT 'pending')"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS events_created ON events (created)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " path TEXT PRIMARY KEY,"
+            " event_id INTEGER NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_accessed ON files (accessed)")
+
+    def configure(self, config):
+        """Applies the retention limits of the `media_store` configuration."""
+        self.max_bytes = config.get("max_mb", 2048) * 1024 * 1024
+        self.max_age = config.get("max_days", 30) * 86400
+        self.history_age = config.get("history_days", 90) * 86400
+
+    def add(self, kind, key, node, files=()):
+        """Records an event and its files.
+
+        Parameters
+        ----------
+        kind : str
+            "alert", "photo" or "video".
+        key : str
+            The event the media belongs to, e.g. its date and time.
+        node : str
+            The name of the unit.
+        files : list, optional
+            The media files of the event on the disk.
+
+        Returns
+        -------
+        int
+            The event id, to update its status.
+        """
+        now = time.time()
+        sizes = self.stat(files)
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            event_id = self.db.execute(
+                "INSERT INTO events (key, kind, node, created, size) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, kind, node, now, sum(size for _, size in sizes)),
+            ).lastrowid
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files (path, event_id, size, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(path, event_id, size, now, now) for path, size in sizes],
+            )
+        return event_id
+
+    @staticmethod
+    def stat(files):
+        sizes = []
+        for file in files:
+            try:
+                sizes.append((_path(file), os.path.getsize(file)))
+            except OSError:
+                # shared memory slabs never reach the disk
+                pass
+        return sizes
+
+    def track(self, event_id, files):
+        """Adds files produced later for an event, e.g. a remuxed clip."""
+        now = time.time()
+        sizes = self.stat(files)
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files (path, event_id, size, created, accessed)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(path, event_id, size, now, now) for path, size in sizes],
+            )
+
+    def touch(self, file):
+        """Marks a file as recently used, so it is evicted later."""
+        with self.lock:
+            self.db.execute(
+                "UPDATE files SET accessed = ? WHERE path = ?",
+                (time.time(), _path(file)),
+            )
+
+    def set_status(self, event_ids, status):
+        """Updates the delivery status of events.
+
+        Parameters
+        ----------
+        event_ids : list
+            The ids returned by `add`.
+        status : str
+            "queued", "delivered" or "failed".
+        """
+        with self.lock:
+            self.db.executemany(
+                "UPDATE events SET status = ? WHERE id = ?",
+                [(status, event_id) for event_id in event_ids],
+            )
+
+    def adopt(self, folders):
+        """Indexes the media left in folders by earlier runs.
+
+        Parameters
+        ----------
+        folders : list
+            The photo and video folders.
+
+        Returns
+        -------
+        int
+            The number of files that were not indexed yet.
+        """
+        with self.lock:
+            known = {row[0] for row in self.db.execute("SELECT path FROM files")}
+        adopted = []
+        for folder in folders:
+            try:
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+            for entry in entries:
+                path = _path(entry.path)
+                if (
+                    path in known
+                    or entry.name.endswith(SKIP_SUFFIXES)
+                    or not entry.is_file()
+                ):
+                    continue
+                stat = entry.stat()
+                adopted.append((path, entry.name, stat.st_size, stat.st_mtime))
+
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            for path, name, size, mtime in adopted:
+                kind = "photo" if name.lower().endswith(".jpg") else "video"
+                event_id = self.db.execute(
+                    "INSERT INTO events (key, kind, node, created, size, status) "
+                    "VALUES (?, ?, '', ?, ?, 'unknown')",
+                    (os.path.splitext(name)[0], kind, mtime, size),
+                ).lastrowid
+                self.db.execute(
+                    "INSERT INTO files (path, event_id, size, created, accessed) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (path, event_id, size, mtime, mtime),
+                )
+        if adopted:
+            logging.warning("Media store adopted %d untracked files", len(adopted))
+        return len(adopted)
+
+    def sweep(self):
+        """Applies the retention policy.
+
+        Returns
+        -------
+        int
+            The number of deleted files.
+        """
+        now = time.time()
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT files.path, files.size, files.created FROM files "
+                "LEFT JOIN events ON events.id = files.event_id "
+                "ORDER BY COALESCE(events.status IN (?, ?), 0), files.accessed",
+                WAITING,
+            ).fetchall()
+
+        # files deleted after delivery are only forgotten
+        present = []
+        forget = []
+        for path, size, created in rows:
+            try:
+                present.append((path, os.path.getsize(path), created))
+            except OSError:
+                forget.append(path)
+
+        total = sum(size for _, size, _ in present)
+        evict = []
+        for path, size, created in present:
+            if now - created > self.max_age or total > self.max_bytes:
+                evict.append(path)
+                total -= size
+
+        for path in evict:
+            try:
+                os.remove(path)
+            except OSError as err:
+                logging.error(err)
+
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany(
+                "DELETE FROM files WHERE path = ?", [(path,) for path in forget + evict]
+            )
+            self.db.execute(
+                "DELETE FROM events WHERE created < ?", (now - self.history_age,)
+            )
+
+        if evict:
+            logging.warning("Media store evicted %d files", len(evict))
+        return len(evict)
+
+    def history(self, since):
+        """Returns the events since a time, oldest first.
+
+        Parameters
+        ----------
+        since : float
+            The time in seconds since the epoch.
+
+        Returns
+        -------
+        list
+            One dictionary per event and kind, with the `kind`, `node`,
+            `key`, `created` time, `count` of media, total `size` and
+            `status`.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT kind, node, key, MIN(created), COUNT(*), SUM(size),"
+                " GROUP_CONCAT(DISTINCT status) FROM events WHERE created >= ?"
+                " GROUP BY kind, node, key ORDER BY MIN(created)",
+                (since,),
+            ).fetchall()
+        return [
+            {
+                "kind": row[0],
+                "node": row[1],
+                "key": row[2],
+                "created": row[3],
+                "count": row[4],
+                "size": row[5],
+                "status": row[6],
+            }
+            for row in rows
+        ]
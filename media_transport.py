@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import fcntl
+import itertools
+import struct
+import logging
+
+from pathlib import Path
+
+
+class ShmTransport:
+    """
+    Hands media between processes through reference counted tmpfs slabs.
+
+    Every slab is a file under a tmpfs directory (``/dev/shm`` by default)
+    with a small header holding the reference count. The producer publishes
+    the bytes and passes the handle on, each consumer reads the bytes and
+    releases its reference, and the last release frees the slab. Nothing
+    touches the SD card.
+
+    ...
+
+    Methods
+    -------
+    publish(name, data, refs=1):
+        Stores bytes in a new slab and returns its handle.
+    read(handle):
+        Returns the bytes of a slab.
+    acquire(handle):
+        Adds a reference to a slab.
+    release(handle):
+        Drops a reference, freeing the slab with the last one.
+    """
+
+    HEADER = struct.Struct("<I")
+
+    def __init__(self, config):
+        """
+        Initializes the transport.
+
+        Parameters
+        ----------
+        config : dict
+            The `media_transport` configuration dictionary.
+        """
+        self.path = Path(config.get("path", "/dev/shm/sentinel"))
+        self.max_bytes = config.get("max_mb", 32) * 1024 * 1024
+        self.sequence = itertools.count()
+
+        try:
+            os.makedirs(self.path)
+        except FileExistsError:
+            pass
+
+    def usage(self):
+        """Returns the number of bytes held by all slabs."""
+        return sum(entry.stat().st_size for entry in os.scandir(self.path))
+
+    def publish(self, name, data, refs=1):
+        """Stores bytes in a new slab and returns its handle.
+
+        Parameters
+        ----------
+        name : str
+            The name of the media. The process id and a counter are added
+            before the extension, as events within a second share a name.
+        data : bytes
+            The media content.
+        refs : int, optional
+            The number of consumers that will release the slab, by default 1.
+
+        Returns
+        -------
+        str or None
+            The handle of the slab, or None if the slabs are over capacity
+            and the caller has to fall back to the disk.
+        """
+        if self.usage() + len(data) > self.max_bytes:
+            logging.error("Shared media transport is full, falling back to disk")
+            return None
+
+        stem, extension = os.path.splitext(name)
+        handle = f"{stem}_{os.getpid()}_{next(self.sequence)}{extension}"
+        tmp_file = self.path / (handle + ".tmp")
+        with open(tmp_file, "wb") as slab:
+            slab.write(self.HEADER.pack(refs))
+            slab.write(data)
+        os.rename(tmp_file, self.path / handle)
+        return handle
+
+    def read(self, handle):
+        """Returns the bytes of a slab.
+
+        Parameters
+        ----------
+        handle : str
+            The handle returned by `publish`.
+
+        Returns
+        -------
+        bytes
+            The media content.
+        """
+        with open(self.path / handle, "rb") as slab:
+            slab.seek(self.HEADER.size)
+            return slab.read()
+
+    def _update_refs(self, handle, delta):
+        """Changes the reference count of a slab under an exclusive lock."""
+        with open(self.path / handle, "r+b") as slab:
+            fcntl.flock(slab, fcntl.LOCK_EX)
+            (refs,) = self.HEADER.unpack(slab.read(self.HEADER.size))
+            refs = max(0, refs + delta)
+            if refs == 0:
+                os.remove(self.path / handle)
+            else:
+                slab.seek(0)
+                slab.write(self.HEADER.pack(refs))
+            return refs
+
+    def acquire(self, handle):
+        """Adds a reference to a slab.
+
+        Parameters
+        ----------
+        handle : str
+            The handle returned by `publish`.
+        """
+        self._update_refs(handle, 1)
+
+    def release(self, handle):
+        """Drops a reference, freeing the slab with the last one.
+
+        Parameters
+        ----------
+        handle : str
+            The handle returned by `publish`.
+        """
+        try:
+            self._update_refs(handle, -1)
+        except FileNotFoundError:
+            logging.error("Media slab %s is already released", handle)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class FrameDiffDetector:
+    """
+    Confirms PIR triggers with frame differencing on the low-res luma.
+
+    Every analysed frame is compared with a running-average background
+    model. A pixel has changed when it differs from the background by more
+    than `pixel_threshold`, and a frame shows motion when the changed pixels
+    outside the exclusion masks exceed `area_ratio` of the image.
+
+    The analysis rate adapts to its own cost, so the detector never uses
+    more than `cpu_budget` of one core.
+
+    ...
+
+    Methods
+    -------
+    due(now):
+        Returns whether the next frame should be analysed.
+    update(timestamp, luma):
+        Analyses a frame and updates the background model.
+    confirm(trigger_time, timeout):
+        Waits for pixel motion around a trigger.
+    """
+
+    def __init__(self, config, shape):
+        """
+        Initializes the detector.
+
+        Parameters
+        ----------
+        config : dict
+            The `motion_confirm` configuration dictionary.
+        shape : tuple
+            The (height, width) of the luma plane.
+        """
+        self.stride = config.get("stride", 2)
+        self.threshold = config.get("pixel_threshold", 25)
+        self.area_ratio = config.get("area_ratio", 0.01)
+        self.alpha = config.get("learning_rate", 0.05)
+        self.cpu_budget = config.get("cpu_budget", 0.1)
+        self.min_interval = 1.0 / config.get("max_fps", 10)
+        self.window = config.get("window", 1.0)
+
+        height = math.ceil(shape[0] / self.stride)
+        width = math.ceil(shape[1] / self.stride)
+
+        # exclusion masks are rectangles in relative [x0, y0, x1, y1]
+        self.mask = np.ones((height, width), dtype=bool)
+        for x_0, y_0, x_1, y_1 in config.get("exclude", []):
+            self.mask[
+                int(y_0 * height) : int(y_1 * height),
+                int(x_0 * width) : int(x_1 * width),
+            ] = False
+        self.mask_pixels = max(1, int(np.count_nonzero(self.mask)))
+
+        self.background = None
+        self.diff = np.empty((height, width), dtype=np.float32)
+        self.changed = np.empty((height, width), dtype=bool)
+
+        self.next_analysis = 0.0
+        self.cost = 0.0
+        self.history = deque(maxlen=config.get("history", 50))
+        self.updated = threading.Condition()
+
+    def due(self, now):
+        """Returns whether the next frame should be analysed.
+
+        Parameters
+        ----------
+        now : float
+            The current time, in seconds since the epoch.
+        """
+        return now >= self.next_analysis
+
+    def update(self, timestamp, luma):
+        """Analyses a frame and updates the background model.
+
+        Parameters
+        ----------
+        timestamp : float
+            The capture time, in seconds since the epoch.
+        luma : numpy.ndarray
+            The luma plane of the low-res stream.
+
+        Returns
+        -------
+        float
+            The ratio of changed pixels.
+        """
+        start = time.perf_counter()
+
+        small = luma[:: self.stride, :: self.stride]
+        if self.background is None:
+            self.background = small.astype(np.float32)
+            ratio = 0.0
+        else:
+            np.subtract(small, self.background, out=self.diff)
+            np.abs(self.diff, out=self.diff)
+            np.greater(self.diff, self.threshold, out=self.changed)
+            np.logical_and(self.changed, self.mask, out=self.changed)
+            ratio = np.count_nonzero(self.changed) / self.mask_pixels
+
+            # background += alpha * (small - background), without allocations
+            self.background *= 1 - self.alpha
+            np.multiply(small, self.alpha, out=self.diff)
+            self.background += self.diff
+
+        self.cost = time.perf_counter() - start
+        self.next_analysis = timestamp + max(
+            self.min_interval, self.cost / self.cpu_budget
+        )
+
+        with self.updated:
+            self.history.append((timestamp, ratio))
+            self.updated.notify_all()
+        return ratio
+
+    def confirm(self, trigger_time, timeout):
+        """Waits for pixel motion around a trigger.
+
+        Parameters
+        ----------
+        trigger_time : float
+            The time of the PIR trigger, in seconds since the epoch. Frames
+            up to `window` seconds before it are considered.
+        timeout : float
+            The maximum time to wait for motion, in seconds.
+
+        Returns
+        -------
+        bool
+            True if the frames confirm the trigger.
+        """
+        deadline = time.time() + timeout
+        with self.updated:
+            while True:
+                if any(
+                    timestamp >= trigger_time - self.window
+                    and ratio >= self.area_ratio
+                    for timestamp, ratio in self.history
+                ):
+                    return True
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.updated.wait(remaining)
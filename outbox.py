@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import logging
+import sqlite3
+import time
+
+
+class Outbox:
+    """
+    A durable first-in first-out store for messages that could not be sent.
+
+    Messages are rows of an SQLite database in WAL mode, so they survive a
+    restart or a power cut, and are replayed strictly in the order they
+    were stored. Only the oldest message is retried, with an exponential
+    backoff between attempts. Each message records the size of the media
+    it references, and the oldest messages are evicted when the total goes
+    over the size cap.
+
+    ...
+
+    Methods
+    -------
+    add(kind, payload, size=0):
+        Stores a message and returns the evicted ones.
+    head():
+        Returns the oldest message.
+    remove(entry_id):
+        Deletes a delivered message.
+    defer(entry_id):
+        Schedules the next attempt of a message after a failure.
+    retry_now():
+        Makes the oldest message due immediately.
+    """
+
+    def __init__(self, config, default_path):
+        """
+        Initializes the outbox.
+
+        Parameters
+        ----------
+        config : dict
+            The `bot.outbox` configuration dictionary.
+        default_path : str or Path
+            The database file used when the configuration has no `path`.
+        """
+        self.path = config.get("path", str(default_path))
+        self.max_bytes = config.get("max_mb", 64) * 1024 * 1024
+        self.backoff_min = config.get("backoff_min", 5)
+        self.backoff_max = config.get("backoff_max", 600)
+
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # a power cut may lose the last commit, but never corrupts the file
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " kind TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt REAL NOT NULL DEFAULT 0)"
+        )
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def total_size(self):
+        """Returns the bytes held by the stored messages and their media."""
+        row = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM outbox").fetchone()
+        return row[0]
+
+    def add(self, kind, payload, size=0):
+        """Stores a message and returns the evicted ones.
+
+        Parameters
+        ----------
+        kind : str
+            The kind of message, used to replay it.
+        payload : dict or list
+            The JSON serializable message.
+        size : int, optional
+            The bytes of media referenced by the message, by default 0.
+
+        Returns
+        -------
+        list
+            The (kind, payload) of the oldest messages evicted to stay under
+            the size cap. Their media have to be deleted by the caller.
+        """
+        data = json.dumps(payload)
+        size += len(data)
+        evicted = []
+        # the message and the evictions it causes are committed together
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute(
+                "INSERT INTO outbox (kind, payload, size, created) VALUES (?, ?, ?, ?)",
+                (kind, data, size, time.time()),
+            )
+            while self.total_size() > self.max_bytes:
+                row = self.db.execute(
+                    "SELECT id, kind, payload FROM outbox ORDER BY id LIMIT 1"
+                ).fetchone()
+                self.db.execute("DELETE FROM outbox WHERE id = ?", (row[0],))
+                evicted.append((row[1], json.loads(row[2])))
+
+        if evicted:
+            logging.error("Outbox is full, evicted %d oldest messages", len(evicted))
+        return evicted
+
+    def head(self):
+        """Returns the oldest message.
+
+        Returns
+        -------
+        dict or None
+            The `id`, `kind`, `payload`, `attempts` and `next_attempt` (in
+            seconds since the epoch) of the oldest message, or None if the
+            outbox is empty.
+        """
+        row = self.db.execute(
+            "SELECT id, kind, payload, attempts, next_attempt FROM outbox "
+            "ORDER BY id LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "kind": row[1],
+            "payload": json.loads(row[2]),
+            "attempts": row[3],
+            "next_attempt": row[4],
+        }
+
+    def remove(self, entry_id):
+        """Deletes a delivered message.
+
+        Parameters
+        ----------
+        entry_id : int
+            The `id` returned by `head`.
+        """
+        self.db.execute("DELETE FROM outbox WHERE id = ?", (entry_id,))
+
+    def defer(self, entry_id):
+        """Schedules the next attempt of a message after a failure.
+
+        The delay doubles with every attempt, from `backoff_min` up to
+        `backoff_max` seconds.
+
+        Parameters
+        ----------
+        entry_id : int
+            The `id` returned by `head`.
+
+        Returns
+        -------
+        float
+            The delay until the next attempt, in seconds.
+        """
+        (attempts,) = self.db.execute(
+            "SELECT attempts FROM outbox WHERE id = ?", (entry_id,)
+        ).fetchone()
+        delay = min(self.backoff_max, self.backoff_min * 2**attempts)
+        self.db.execute(
+            "UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+            (attempts + 1, time.time() + delay, entry_id),
+        )
+        return delay
+
+    def retry_now(self):
+        """Makes the oldest message due immediately, e.g. after a reconnect."""
+        self.db.execute(
+            "UPDATE outbox SET next_attempt = 0 WHERE id = (SELECT MIN(id) FROM outbox)"
+        )
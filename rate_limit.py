@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    An asyncio token bucket limiting the rate of Telegram API calls.
+
+    Callers are served in arrival order. A retry-after response from
+    Telegram pauses the whole bucket, so no other call is wasted on a
+    limit that is known to be active.
+
+    ...
+
+    Methods
+    -------
+    acquire():
+        Waits until a call is allowed.
+    pause(seconds):
+        Blocks all calls for a number of seconds.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        Initializes the bucket.
+
+        Parameters
+        ----------
+        rate : float
+            The sustained number of calls per second.
+        capacity : int
+            The number of calls allowed in a burst.
+        """
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Waits until a call is allowed and takes a token for it."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Blocks all calls for a number of seconds.
+
+        Parameters
+        ----------
+        seconds : float
+            The time to wait, usually the retry-after value from Telegram.
+        """
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+        self.updated = time.monotonic()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    All-in-one runtime: runs Motion, Camera, MessageBot and the Telegram
+    command handler in a single process, passing messages through memory.
+"""
+
+import os
+import argparse
+import asyncio
+import copy
+import json
+import threading
+
+import async_log
+
+# set up before the service modules, whose own setup is then a no-op
+async_log.setup(
+    "sentinel",
+    "sentinel.log",
+    "%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s",
+)
+
+# pylint: disable=wrong-import-position
+import hub
+import ipc
+import settings
+import startup_profile
+from sentinel_camera import Camera
+from sentinel_message_bot import MessageBot
+from sentinel_motion import Motion
+from sentinel_telegram_handler import build_application, update_options
+
+
+async def run(config, conf_path=None, file_config=None):
+    """Runs all services until one of them fails.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary, using the "inproc" transport.
+    conf_path : str, optional
+        The configuration file, reloaded into the services when it changes.
+    file_config : dict, optional
+        The configuration as read from the file, before the runtime changes.
+    """
+    # only report readiness once every service is up
+    notify_socket = os.environ.pop("NOTIFY_SOCKET", None)
+
+    with startup_profile.phase("sentinel", "init"):
+        my_bot = MessageBot(config)
+        camera = Camera(config)
+        motion = Motion(config)
+
+    if conf_path is not None:
+        loop = asyncio.get_running_loop()
+        settings.watch(
+            conf_path,
+            file_config,
+            [
+                motion.apply_settings,
+                camera.apply_settings,
+                lambda reloaded: loop.call_soon_threadsafe(
+                    my_bot.apply_settings, reloaded
+                ),
+            ],
+        )
+
+    # the camera and the PIR sensor are opened while telegram is imported
+    threading.Thread(target=camera.run, name="camera", daemon=True).start()
+    threading.Thread(target=motion.run, name="motion", daemon=True).start()
+
+    bot_task = asyncio.create_task(my_bot.run())
+    await asyncio.wait(
+        [bot_task, asyncio.create_task(my_bot.ready.wait())],
+        return_when=asyncio.FIRST_COMPLETED,
+    )
+
+    if hub.role(config) == "node":
+        # the hub polls for the commands of every unit
+        startup_profile.mark("sentinel", "ready for commands")
+        if notify_socket is not None:
+            os.environ["NOTIFY_SOCKET"] = notify_socket
+            ipc.notify_ready()
+        startup_profile.report("sentinel")
+        await bot_task
+        return
+
+    application = build_application(config)
+    async with application:
+        await application.start()
+        mode, options = update_options(config)
+        if mode == "webhook":
+            await application.updater.start_webhook(**options)
+        else:
+            await application.updater.start_polling(**options)
+
+        startup_profile.mark("sentinel", "ready for commands")
+        if notify_socket is not None:
+            os.environ["NOTIFY_SOCKET"] = notify_socket
+            ipc.notify_ready()
+        startup_profile.report("telegram")
+        startup_profile.report("sentinel")
+
+        try:
+            await bot_task
+        finally:
+            await application.updater.stop()
+            await application.stop()
+
+
+def main():
+    """Main function"""
+    startup_profile.mark("sentinel", "interpreter and imports")
+    # argument parser
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "-c", "--conf", required=True, help="path to the JSON configuration file"
+    )
+    args = vars(ap.parse_args())
+    with open(args["conf"], "r", encoding="utf-8") as read_file:
+        config = json.load(read_file)
+    startup_profile.configure(config)
+    async_log.configure(config)
+
+    file_config = copy.deepcopy(config)
+    config["ipc"] = dict(config.get("ipc", {}), transport="inproc")
+    asyncio.run(run(config, args["conf"], file_config))
+
+
+if __name__ == "__main__":
+    main()
@@ -20,28 +20,33 @@
 import os
 
 import copy
+import io
 import logging
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import json
+import math
 import socket
+import threading
+import time
 
 from pathlib import Path
 import datetime
 
-from picamera2 import Picamera2, Preview
+import async_log
+import ipc
+import settings
+import startup_profile
+import tracing
+from command_scheduler import CommandScheduler
+from media_transport import ShmTransport
 
+# picamera2, PIL and numpy are imported when the camera is opened, off the
+# path to accepting commands
 
-pwd = os.path.dirname(os.path.realpath(__file__))
-log_folder = os.path.join(pwd, "log")
-if not os.path.exists(log_folder):
-    os.makedirs(log_folder)
 
-logging.basicConfig(
-    filename=os.path.join(log_folder, "camera.log"),
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.ERROR,
-)
+async_log.setup("camera", "camera.log")
 
 
 class Camera:
@@ -52,10 +57,19 @@ class Camera:
 
     Methods
     -------
-    take_photo(counts):
+    open_camera():
+        Imports the camera libraries and starts the camera.
+    start_stream():
+        Keeps the camera running and buffers the most recent frames.
+    start_live_view(live_config):
+        Serves the low-res stream to local viewers over HTTP.
+    apply_settings(reloaded):
+        Swaps in reloaded settings and restarts only the parts they change.
+    take_photo(counts, trigger_time=None, trace=None):
         Takes a specified number of photos.
-    take_video(init_photo=False):
-        Records a video.
+    take_video():
+        Records a video, starting before the trigger with the circular
+        video buffer.
     run():
         Starts the camera module.
     message_handling_loop():
@@ -85,11 +99,48 @@ class Camera:
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_socket.settimeout(3)
 
-        self.bot_port = config["bot"]["listen_port"]
-
-        self.picam2 = Picamera2()
-        self.picam2.configure(self.picam2.create_still_configuration())
-        self.picam2.start_preview(Preview.NULL)
+        self.ipc_transport = ipc.transport(config)
+        self.ipc_path = ipc.socket_path(config, "camera")
+        self.bot_client = ipc.connect(config, "bot")
+
+        self.transport = None
+        if config.get("media_transport", {}).get("type", "disk") == "shm":
+            self.transport = ShmTransport(config["media_transport"])
+
+        self.stream_config = self.camera_config.get("stream", {})
+        # the options that follow config.json, swapped by apply_settings()
+        self.settings = settings.CameraSettings.from_config(config)
+        self.frame_buffer = None
+        self.encoder_pool = None
+        self.detector = None
+        self.ranker = None
+        self.video_output = None
+        self.last_buffered = 0.0
+
+        # the live view and the clips share the camera's encoders
+        self.encoder_lock = threading.Lock()
+        self.live_server = None
+        self.live_broadcaster = None
+        self.live_encoder = None
+        self.live_running = False
+        self.hls_output = None
+
+        # opened in the background by run(), commands wait for it
+        self.picam2 = None
+        self.camera_ready = threading.Event()
+
+        # stills need the persistent stream to be taken while recording
+        if self.stream_config.get("enabled", False):
+            lanes = {"take_photo": "still", "take_video": "video"}
+        else:
+            lanes = {"take_photo": "camera", "take_video": "camera"}
+        self.scheduler = CommandScheduler(
+            {
+                "take_photo": self.handle_take_photo,
+                "take_video": self.handle_take_video,
+            },
+            lanes,
+        )
 
         try:
             os.makedirs(self.video_path)
@@ -120,16 +171,410 @@ class Camera:
             "server": "",
         }
 
-    def take_photo(self, counts):
+    def open_camera(self):
+        """Imports the camera libraries and starts the camera.
+
+        Runs on its own thread, so commands are accepted and queued while
+        the camera is still starting. A camera that fails to start ends the
+        process, so the service manager restarts it.
+        """
+        # pylint: disable=import-outside-toplevel
+        try:
+            with startup_profile.phase("camera", "import picamera2"):
+                from picamera2 import Picamera2, Preview
+
+            with startup_profile.phase("camera", "open camera"):
+                self.picam2 = Picamera2()
+                if self.stream_config.get("enabled", False):
+                    self.start_stream()
+                else:
+                    self.picam2.configure(self.picam2.create_still_configuration())
+                    self.picam2.start_preview(Preview.NULL)
+        except Exception as exp:  # pylint: disable=broad-exception-caught
+            logging.error("Camera failed to start: %s", exp)
+            async_log.flush()
+            os._exit(1)
+
+        self.camera_ready.set()
+
+        if self.frame_buffer is not None:
+            # warm up the encoder import before the first trigger
+            with startup_profile.phase("camera", "import PIL"):
+                import PIL.Image  # pylint: disable=unused-import
+        startup_profile.report("camera")
+
+    def start_stream(self):
+        """Keeps the camera running and buffers the most recent frames.
+
+        The camera is configured with a full-size main stream and a low-res
+        stream. Main frames are sampled at `buffer_fps` into a ring buffer
+        holding `pre_roll` seconds, limited to `buffer_memory_mb`.
+        """
+        main_size = tuple(self.stream_config.get("main_size", [1280, 720]))
+        self.lores_size = tuple(self.stream_config.get("lores_size", [320, 240]))
+        buffer_fps = self.stream_config.get("buffer_fps", 5)
+        pre_roll = self.stream_config.get("pre_roll", 2)
+        memory_cap = self.stream_config.get("buffer_memory_mb", 48) * 1024 * 1024
+
+        video_config = self.stream_config.get("video", {})
+        video_fps = video_config.get("fps", 30)
+
+        # pylint: disable-next=import-outside-toplevel
+        from frame_buffer import FrameRingBuffer
+
+        self.picam2.configure(
+            self.picam2.create_video_configuration(
+                main={"size": main_size, "format": "RGB888"},
+                lores={"size": self.lores_size, "format": "YUV420"},
+                controls={"FrameRate": video_fps},
+            )
+        )
+
+        self.buffer_interval = 1.0 / buffer_fps
+        self.frame_buffer = FrameRingBuffer.from_memory_cap(
+            math.ceil(pre_roll * buffer_fps),
+            memory_cap,
+            (main_size[1], main_size[0], 3),
+        )
+        logging.info(
+            "Frame buffer holds %d frames (%d bytes)",
+            self.frame_buffer.capacity,
+            self.frame_buffer.nbytes,
+        )
+
+        current = self.settings
+        self.detector = self.create_detector(current.motion_confirm)
+        self.ranker = self.create_ranker(current.select)
+
+        # PIL releases the GIL while encoding, so threads use all cores
+        self.encoder_pool = ThreadPoolExecutor(
+            max_workers=self.stream_config.get("encode_workers") or os.cpu_count()
+        )
+
+        live_config = current.live
+        hls_config = live_config.get("hls", {})
+        if live_config.get("enabled", False) and hls_config.get("enabled", False):
+            self.hls_output = self.create_hls_output(hls_config)
+
+        if video_config.get("circular", False):
+            self.start_circular_video(video_config, video_fps)
+        elif self.hls_output is not None:
+            # pylint: disable-next=import-outside-toplevel
+            from picamera2.encoders import H264Encoder
+
+            self.picam2.start_encoder(
+                H264Encoder(
+                    bitrate=hls_config.get("bitrate", 1000000),
+                    repeat=True,
+                    iperiod=video_fps,
+                ),
+                self.hls_output,
+                name="lores",
+            )
+
+        self.picam2.post_callback = self.on_frame
+        self.picam2.start()
+
+        if live_config.get("enabled", False):
+            self.start_live_view(live_config)
+
+    def create_detector(self, confirm_config):
+        """Returns the pixel motion detector, None if it is disabled.
+
+        Parameters
+        ----------
+        confirm_config : dict
+            The `motion_confirm` configuration dictionary.
+        """
+        if not confirm_config.get("enabled", False):
+            return None
+        # pylint: disable-next=import-outside-toplevel
+        from motion_detector import FrameDiffDetector
+
+        return FrameDiffDetector(
+            confirm_config, (self.lores_size[1], self.lores_size[0])
+        )
+
+    @staticmethod
+    def create_ranker(select_config):
+        """Returns the burst frame ranker, None if selection is disabled.
+
+        Parameters
+        ----------
+        select_config : dict
+            The `stream.select` configuration dictionary.
+        """
+        if not select_config.get("enabled", False):
+            return None
+        # pylint: disable-next=import-outside-toplevel
+        from frame_ranker import FrameRanker
+
+        return FrameRanker(select_config)
+
+    def start_circular_video(self, video_config, fps):
+        """Keeps encoding H.264 into an in-memory circular buffer.
+
+        The buffer holds `pre_roll` seconds of encoded frames, limited to
+        `memory_mb` assuming the average frame size of the configured
+        bitrate. SPS/PPS headers are repeated on every key frame, so a clip
+        can start at any key frame in the buffer.
+
+        Parameters
+        ----------
+        video_config : dict
+            The `stream.video` configuration dictionary.
+        fps : int
+            The frame rate of the stream.
+        """
+        bitrate = video_config.get("bitrate", 2000000)
+        memory_cap = video_config.get("memory_mb", 16) * 1024 * 1024
+        frame_bytes = bitrate / 8 / fps
+
+        buffer_size = max(
+            1,
+            min(
+                math.ceil(video_config.get("pre_roll", 5) * fps),
+                int(memory_cap / frame_bytes),
+            ),
+        )
+        logging.info("Circular video buffer holds %d frames", buffer_size)
+
+        # pylint: disable=import-outside-toplevel
+        from picamera2.encoders import H264Encoder
+        from picamera2.outputs import CircularOutput
+
+        self.video_output = CircularOutput(buffersize=buffer_size)
+        outputs = [self.video_output]
+        if self.hls_output is not None:
+            # the HLS segments reuse the encoded frames
+            outputs.append(self.hls_output)
+        self.picam2.start_encoder(
+            H264Encoder(bitrate=bitrate, repeat=True, iperiod=fps), outputs
+        )
+
+    @staticmethod
+    def create_hls_output(hls_config):
+        """Creates the ffmpeg output cutting H.264 into HLS segments.
+
+        Parameters
+        ----------
+        hls_config : dict
+            The `stream.live.hls` configuration dictionary.
+
+        Returns
+        -------
+        picamera2.outputs.FfmpegOutput
+            The output, copying the H.264 without re-encoding.
+        """
+        # pylint: disable-next=import-outside-toplevel
+        from picamera2.outputs import FfmpegOutput
+
+        folder = hls_config.get("path", "/dev/shm/sentinel/live")
+        os.makedirs(folder, exist_ok=True)
+        return FfmpegOutput(
+            f"-f hls -hls_time {hls_config.get('segment', 1)}"
+            f" -hls_list_size {hls_config.get('segments', 4)}"
+            f" -hls_flags delete_segments {os.path.join(folder, 'index.m3u8')}"
+        )
+
+    def start_live_view(self, live_config):
+        """Serves the low-res stream to local viewers over HTTP.
+
+        The low-res stream is JPEG encoded by the hardware only while
+        someone watches, and every frame is shared by all viewers.
+
+        Parameters
+        ----------
+        live_config : dict
+            The `stream.live` configuration dictionary.
+        """
+        # pylint: disable=import-outside-toplevel
+        from picamera2.encoders import MJPEGEncoder
+
+        from live_view import FrameBroadcaster, LiveViewServer
+
+        self.live_encoder = MJPEGEncoder(bitrate=live_config.get("bitrate", 4000000))
+        self.live_broadcaster = FrameBroadcaster(
+            queue_size=live_config.get("queue_size", 2),
+            max_viewers=live_config.get("max_viewers", 8),
+            on_active=self.toggle_live_encoder,
+        )
+        try:
+            self.live_server = LiveViewServer(live_config, self.live_broadcaster)
+        except (OSError, ValueError) as err:
+            logging.error("Live view failed to start: %s", err)
+            return
+        self.live_server.start()
+
+    def stop_live_view(self):
+        """Stops serving the live view, letting the viewers go."""
+        if self.live_server is not None:
+            self.live_server.stop()
+            self.live_server = None
+
+    def apply_settings(self, reloaded):
+        """Swaps in reloaded settings and restarts only the parts they change.
+
+        The options read per photo or clip apply with the swap. The frame
+        ranker, the motion detector and the live view are recreated when
+        their own options changed, the stream itself is left alone.
+
+        Parameters
+        ----------
+        reloaded : settings.Settings
+            The reloaded settings.
+        """
+        old = self.settings
+        new = reloaded.camera
+        self.settings = new
+        if self.frame_buffer is None:
+            # without the stream, the parts below do not exist
+            return
+
+        if new.select != old.select:
+            self.ranker = self.create_ranker(new.select)
+        if new.motion_confirm != old.motion_confirm:
+            # a new background model is learnt within a few frames
+            self.detector = self.create_detector(new.motion_confirm)
+        # the HLS output is only created at startup, see settings.RESTART_OPTIONS
+        old_live = {key: value for key, value in old.live.items() if key != "hls"}
+        new_live = {key: value for key, value in new.live.items() if key != "hls"}
+        if new_live != old_live:
+            self.stop_live_view()
+            if new.live.get("enabled", False):
+                self.start_live_view(new.live)
+        if new.stream != old.stream:
+            logging.warning("Stream changes apply when the camera restarts")
+
+    def toggle_live_encoder(self, active):  # pylint: disable=unused-argument
+        """Starts the live encoder for the first viewer, stops it after the last.
+
+        Parameters
+        ----------
+        active : bool
+            True when a viewer arrived. The viewers are counted again under
+            the lock, as calls from two viewers may arrive out of order.
+        """
+        with self.encoder_lock:
+            running = bool(self.live_broadcaster.viewers)
+            if running == self.live_running:
+                return
+            if running:
+                self.picam2.start_encoder(
+                    self.live_encoder, self.live_broadcaster, name="lores"
+                )
+            else:
+                self.picam2.stop_encoder(self.live_encoder)
+            self.live_running = running
+
+    def on_frame(self, request):
+        """Copies every `buffer_fps`-th main frame into the ring buffer.
+
+        The low-res luma is passed to the motion detector whenever its CPU
+        budget allows.
+
+        Parameters
+        ----------
+        request : picamera2.request.CompletedRequest
+            The request delivered by the camera thread.
+        """
+        from picamera2 import MappedArray  # pylint: disable=import-outside-toplevel
+
+        now = time.time()
+        detector = self.detector
+        if detector is not None and detector.due(now):
+            with MappedArray(request, "lores") as mapped:
+                detector.update(
+                    now, mapped.array[0 : self.lores_size[1], 0 : self.lores_size[0]]
+                )
+
+        if now - self.last_buffered < self.buffer_interval:
+            return
+        self.last_buffered = now
+
+        height, width = self.frame_buffer.shape[0:2]
+        with MappedArray(request, "main") as mapped:
+            self.frame_buffer.push(now, mapped.array[0:height, 0:width])
+
+    def encode_jpeg(self, frame):
+        """Encodes a buffered RGB888 frame as JPEG.
+
+        Parameters
+        ----------
+        frame : numpy.ndarray
+            The frame, [B, G, R] ordered as delivered by Picamera2.
+
+        Returns
+        -------
+        bytes, bytes or None
+            The full size JPEG, and the low quality preview JPEG if previews
+            are enabled.
+        """
+        from PIL import Image  # pylint: disable=import-outside-toplevel
+
+        height, width = frame.shape[0:2]
+        img = Image.frombuffer("RGB", (width, height), frame, "raw", "BGR", 0, 1)
+
+        jpeg = io.BytesIO()
+        current = self.settings
+        img.save(jpeg, format="JPEG", quality=current.quality)
+
+        preview_config = current.preview
+        if not preview_config.get("enabled", False):
+            return jpeg.getvalue(), None
+
+        img.thumbnail(tuple(preview_config.get("size", [480, 270])))
+        preview = io.BytesIO()
+        img.save(preview, format="JPEG", quality=preview_config.get("quality", 50))
+        return jpeg.getvalue(), preview.getvalue()
+
+    def store_jpeg(self, name, jpeg):
+        """Stores a JPEG in shared memory, or on the disk as the fallback.
+
+        Parameters
+        ----------
+        name : str
+            The file name without extension.
+        jpeg : bytes
+            The encoded photo.
+
+        Returns
+        -------
+        dict
+            The reference to put into a `send_photo` message, either a slab
+            `handle` or a `file_name`.
+        """
+        extension = self.cmd_send_jpg["extension"]
+        if self.transport is not None:
+            handle = self.transport.publish(name + extension, jpeg)
+            if handle is not None:
+                return {"handle": handle, "extension": extension}
+
+        with open(self.photo_path / (name + extension), "wb") as photo:
+            photo.write(jpeg)
+        return {"file_name": name, "extension": extension}
+
+    def take_photo(self, counts, trigger_time=None, trace=None):
         """Takes a specified number of photos.
 
         Parameters
         ----------
         counts : int
             The number of photos to take.
+        trigger_time : float, optional
+            The time of the trigger, in seconds since the epoch. With the
+            persistent stream, the photos closest to it are returned.
+        trace : dict, optional
+            The trace of the event, copied into every photo message with
+            the capture, encode and write stages added.
         """
-        if counts == 0 or counts > self.camera_config["max_photo_count"]:
-            counts = self.camera_config["max_photo_count"]
+        max_photo_count = self.settings.max_photo_count
+        if counts == 0 or counts > max_photo_count:
+            counts = max_photo_count
+
+        if self.frame_buffer is not None:
+            self.take_buffered_photo(counts, trigger_time or time.time(), trace)
+            return
 
         for photo_idx in range(0, counts):
             date_str = datetime.datetime.now().strftime("%Y-%m-%d")
@@ -151,70 +596,380 @@ class Camera:
                 show_preview=False,
             )
 
-            self.send_bot(copy.deepcopy(self.cmd_send_jpg))
+            msg = copy.deepcopy(self.cmd_send_jpg)
+            if trace is not None:
+                # the still pipeline captures, encodes and writes in one call
+                msg["trace"] = copy.deepcopy(trace)
+                tracing.add_stage(msg["trace"], "capture", tracing.since_sent(trace))
+                msg["trace"]["sent"] = time.time()
+            self.send_bot(msg)
 
-    def take_video(self):
-        """Records a video.
+    def take_buffered_photo(self, counts, trigger_time, trace=None):
+        """Takes a burst of photos from the persistent stream.
+
+        Buffered frames around the trigger time are used first, the rest are
+        grabbed live at `burst_fps`. Capturing never waits for encoding: every
+        frame is handed to the encoder pool, which writes the JPEG and
+        notifies the bot as soon as that frame is done.
+
+        With frame selection, at least `candidates` frames are captured and
+        only the `top_k` best of them, at most `counts`, are encoded and
+        sent, once the burst is complete.
+
+        Parameters
+        ----------
+        counts : int
+            The number of photos to take.
+        trigger_time : float
+            The time of the trigger, in seconds since the epoch.
+        trace : dict, optional
+            The trace of the event.
+
+        Returns
+        -------
+        dict
+            The captured and sent frames, the achieved capture rate, and the
+            mean encode and scoring times per frame.
+        """
+        event_time = datetime.datetime.fromtimestamp(trigger_time)
+        date_str = event_time.strftime("%Y-%m-%d")
+        time_str = event_time.strftime("%H-%M-%S")
+
+        ranker = self.ranker
+        burst_start = time.perf_counter()
+        futures = []
+        candidates = []
+        if ranker is None:
+            # every frame is encoded as soon as it is captured
+            for frame in self.burst_frames(counts, trigger_time):
+                futures.append(
+                    self.encoder_pool.submit(
+                        self.encode_photo,
+                        len(futures),
+                        frame,
+                        date_str,
+                        time_str,
+                        trace,
+                        time.time(),
+                    )
+                )
+        else:
+            for frame in self.burst_frames(
+                max(counts, ranker.candidates), trigger_time
+            ):
+                candidates.append((frame, ranker.luma(frame)))
+        capture_duration = time.perf_counter() - burst_start
+
+        score_time = 0.0
+        if candidates:
+            score_start = time.perf_counter()
+            selected, _ = ranker.rank(
+                [luma for _, luma in candidates], min(counts, ranker.top_k)
+            )
+            score_time = time.perf_counter() - score_start
+            captured = time.time()
+            for idx in selected:
+                futures.append(
+                    self.encoder_pool.submit(
+                        self.encode_photo,
+                        len(futures),
+                        candidates[idx][0],
+                        date_str,
+                        time_str,
+                        trace,
+                        captured,
+                    )
+                )
+
+        captured_count = len(candidates) or len(futures)
+        encode_times = [future.result() for future in futures]
+        stats = {
+            "count": captured_count,
+            "sent": len(futures),
+            "fps": captured_count / capture_duration if capture_duration > 0 else 0.0,
+            "encode_ms": 1000 * sum(encode_times) / max(1, len(encode_times)),
+            "score_ms": 1000 * score_time / max(1, len(candidates)),
+        }
+        logging.info(
+            "Burst of %d photos at %.1f fps, %d sent, %.1f ms encode and "
+            "%.1f ms scoring per frame",
+            stats["count"],
+            stats["fps"],
+            stats["sent"],
+            stats["encode_ms"],
+            stats["score_ms"],
+        )
+        return stats
+
+    def burst_frames(self, counts, trigger_time):
+        """Yields the frames of a burst as they are captured.
+
+        Parameters
+        ----------
+        counts : int
+            The number of frames.
+        trigger_time : float
+            The time of the trigger, in seconds since the epoch.
+
+        Yields
+        ------
+        numpy.ndarray
+            The RGB888 frames, buffered ones first.
+        """
+        buffered = self.frame_buffer.around(
+            trigger_time, counts, self.stream_config.get("pre_roll", 2)
+        )
+        for _, frame in buffered:
+            yield frame
+
+        interval = 1.0 / self.settings.burst_fps
+        next_shot = time.perf_counter()
+        for _ in range(len(buffered), counts):
+            time.sleep(max(0.0, next_shot - time.perf_counter()))
+            next_shot = max(next_shot + interval, time.perf_counter())
+            yield self.picam2.capture_array("main")
+
+    def encode_photo(
+        self, photo_idx, frame, date_str, time_str, trace=None, captured=None
+    ):
+        """Encodes and publishes one burst frame, then notifies the bot.
+
+        Runs on the encoder pool. With the shared memory transport the
+        message carries a slab `handle` instead of a `file_name`, the disk is
+        only used when the slabs are full. With previews enabled, the message
+        also carries a reference to the low quality `preview`.
 
         Parameters
         ----------
-        init_photo : bool, optional
-            Whether to take a photo before recording the video, by default False.
+        photo_idx : int
+            The index of the photo within the burst.
+        frame : numpy.ndarray
+            The RGB888 frame.
+        date_str : str
+            The date of the event.
+        time_str : str
+            The time of the event.
+        trace : dict, optional
+            The trace of the event, copied into the message.
+        captured : float, optional
+            The time the frame was available, in seconds since the epoch.
+
+        Returns
+        -------
+        float
+            The time spent encoding and writing the frame, in seconds.
+        """
+        encode_start = time.perf_counter()
+
+        msg = copy.deepcopy(self.cmd_send_jpg)
+        msg["date"] = date_str
+        msg["time"] = time_str
+        msg["file_name"] = date_str + "_" + time_str + "_" + "photo" + str(photo_idx)
+        msg["server"] = "telegram"
+
+        jpeg, preview = self.encode_jpeg(frame)
+        write_start = time.perf_counter()
+        name = msg.pop("file_name")
+        msg.update(self.store_jpeg(name, jpeg))
+        if preview is not None:
+            msg["preview"] = self.store_jpeg(name + "_preview", preview)
+        encode_time = time.perf_counter() - encode_start
+
+        if trace is not None:
+            msg["trace"] = copy.deepcopy(trace)
+            tracing.add_stage(msg["trace"], "capture", captured - trace["sent"])
+            tracing.add_stage(msg["trace"], "encode", write_start - encode_start)
+            tracing.add_stage(
+                msg["trace"], "write", encode_start + encode_time - write_start
+            )
+            msg["trace"]["sent"] = time.time()
+
+        self.send_bot(msg)
+        return encode_time
+
+    def take_video(self):
+        """Records a video.
+
+        With the circular video buffer, the clip holds the buffered seconds
+        before the command and `video_length` seconds after it, written out
+        without re-encoding. The bot is then asked to upload the clip.
         """
         self.take_photo(1)
+        video_length = self.settings.video_length
 
         date_str = datetime.datetime.now().strftime("%Y-%m-%d")
         time_str = datetime.datetime.now().strftime("%H-%M-%S")
-        self.cmd_upload_h264["file_name"] = time_str + "_" + "video"
+        self.cmd_upload_h264["file_name"] = date_str + "_" + time_str + "_" + "video"
         self.cmd_upload_h264["date"] = date_str
         self.cmd_upload_h264["time"] = time_str
+        if self.frame_buffer is not None:
+            # the stream is recorded as raw H.264, without a container
+            self.cmd_upload_h264["extension"] = ".h264"
+            self.cmd_upload_h264["fps"] = self.stream_config.get("video", {}).get(
+                "fps", 30
+            )
 
-        self.picam2.start_and_record_video(
-            str(
-                self.video_path
-                / (
-                    self.cmd_upload_h264["file_name"]
-                    + self.cmd_upload_h264["extension"]
-                )
-            ),
-            duration=self.camera_config["video_length"],
+        video_file = str(
+            self.video_path
+            / (self.cmd_upload_h264["file_name"] + self.cmd_upload_h264["extension"])
         )
 
+        if self.video_output is not None:
+            # flush the pre-trigger frames and keep appending for video_length
+            self.video_output.fileoutput = video_file
+            self.video_output.start()
+            time.sleep(video_length)
+            self.video_output.stop()
+        elif self.frame_buffer is not None:
+            # keep the stream running, only attach an encoder for the clip
+            # pylint: disable=import-outside-toplevel
+            from picamera2.encoders import H264Encoder
+            from picamera2.outputs import FileOutput
+
+            encoder = H264Encoder()
+            with self.encoder_lock:
+                self.picam2.start_encoder(encoder, FileOutput(video_file))
+            time.sleep(video_length)
+            with self.encoder_lock:
+                # only this encoder, the live view keeps running
+                self.picam2.stop_encoder(encoder)
+        else:
+            self.picam2.start_and_record_video(
+                video_file,
+                duration=video_length,
+            )
+
+        self.send_bot(copy.deepcopy(self.cmd_upload_h264))
+
     def run(self):
-        """Starts the camera module."""
+        """Starts the camera module.
+
+        The camera is opened in the background while the command intake
+        starts, so the service reports ready before the camera is.
+        """
         logging.info("Camera thread started")
+        threading.Thread(
+            target=self.open_camera, name="camera-open", daemon=True
+        ).start()
+
+        if self.ipc_transport == "inproc":
+            # commands arrive on the caller's threads, nothing to wait for
+            self.scheduler.start()
+            ipc.register("camera", self.scheduler.submit)
+            startup_profile.mark("camera", "ready for commands")
+            return
+
+        if self.ipc_transport == "unix":
+            self.scheduler.start()
+            server = ipc.IpcServer(self.ipc_path, self.scheduler.submit)
+            server_socket = server.bind()
+            startup_profile.mark("camera", "ready for commands")
+            ipc.notify_ready()
+            server.accept_loop(server_socket)
+            return
+
         try:
             self.udp_socket.bind((self.ip, self.camera_config["listen_port"]))
         except OSError as err:
             logging.error(err)
         else:
+            startup_profile.mark("camera", "ready for commands")
+            ipc.notify_ready()
             self.message_handling_loop()
         finally:
             logging.info("camera UDP stopped")
 
     def message_handling_loop(self):
-        """Handles incoming messages."""
+        """Handles incoming messages.
+
+        Commands are only parsed here and handed to the scheduler, so the
+        socket keeps being drained while photos and videos are taken.
+        """
+        self.scheduler.start()
         while True:
             try:
                 data, _ = self.udp_socket.recvfrom(4096)
-            except socket.timeout as t_out:
-                logging.info(t_out)
+            except socket.timeout:
+                # idle, nothing worth a log line
+                continue
             else:
                 if data:
                     try:
-                        msg = json.loads(data.decode())
-                        # logging.info(data.decode())
-                        if msg["cmd"] == "take_photo":
-                            self.take_photo(msg["count"])
-                            logging.info("Start to capture photos")
-                        elif msg["cmd"] == "take_video":
-                            self.take_video()
-                            logging.info("Start to record videos")
+                        self.scheduler.submit(json.loads(data.decode()))
                     except Exception as exp:  # pylint: disable=broad-exception-caught
                         logging.error(exp)
                 else:
                     continue
 
+    def handle_take_photo(self, msg):
+        """Handles a take_photo command from the scheduler.
+
+        Parameters
+        ----------
+        msg : dict
+            The command message.
+        """
+        trace = msg.get("trace")
+        if trace is not None:
+            # from here on the trace times the capture
+            for dispatched in [trace] + trace.get("merged", []):
+                tracing.add_stage(
+                    dispatched, "dispatch", tracing.since_sent(dispatched)
+                )
+                dispatched["sent"] = time.time()
+
+        self.camera_ready.wait()
+        confirmed = msg.get("trigger") != "motion" or self.confirm(msg["timestamp"])
+        if not confirmed and not msg.get("manual", False):
+            # a merged manual request is served without motion
+            return
+        logging.info("Start to capture photos")
+        self.take_photo(msg["count"], msg.get("timestamp"), trace)
+
+    def handle_take_video(self, msg):  # pylint: disable=unused-argument
+        """Handles a take_video command from the scheduler.
+
+        Parameters
+        ----------
+        msg : dict
+            The command message.
+        """
+        self.camera_ready.wait()
+        logging.info("Start to record videos")
+        self.take_video()
+
+    def confirm(self, trigger_time):
+        """Confirms a PIR trigger with pixel motion before any alert goes out.
+
+        Parameters
+        ----------
+        trigger_time : float
+            The time of the PIR trigger, in seconds since the epoch.
+
+        Returns
+        -------
+        bool
+            True if the trigger is confirmed, or confirmation is disabled.
+        """
+        detector = self.detector
+        if detector is None:
+            return True
+
+        timeout = self.settings.motion_confirm.get("timeout", 2)
+        if not detector.confirm(trigger_time, timeout):
+            logging.info("PIR trigger not confirmed by the camera")
+            return False
+
+        trigger = datetime.datetime.fromtimestamp(trigger_time)
+        self.send_bot(
+            {
+                "cmd": "send_msg",
+                "date": trigger.strftime("%Y-%m-%d"),
+                "time": trigger.strftime("%H-%M-%S"),
+            }
+        )
+        return True
+
     def send_bot(self, msg):
         """Sends a message to the bot.
 
@@ -223,12 +978,12 @@ class Camera:
         msg : dict
             The message to send.
         """
-        payload = json.dumps(msg)
-        self.udp_socket.sendto(payload.encode(), ("127.0.0.1", self.bot_port))
+        self.bot_client.send(msg)
 
 
 def main():
     """Main function"""
+    startup_profile.mark("camera", "interpreter and imports")
     # argument parser
     ap = argparse.ArgumentParser()
     ap.add_argument(
@@ -237,8 +992,12 @@ def main():
     args = vars(ap.parse_args())
     with open(args["conf"], "r", encoding="utf-8") as read_file:
         config = json.load(read_file)
+    startup_profile.configure(config)
+    async_log.configure(config)
 
-    camera = Camera(config)
+    with startup_profile.phase("camera", "init"):
+        camera = Camera(config)
+    settings.watch(args["conf"], config, [camera.apply_settings])
     camera.run()
 
 
@@ -19,25 +19,47 @@
 
 import os
 import asyncio
+import itertools
+import time
+from collections import OrderedDict, deque
 from pathlib import Path
 import argparse
 import json
 import socket
 import logging
 
-from telegram import Bot
+import async_log
+import hub
+import ipc
+import settings
+import startup_profile
+import tracing
+import video_remux
+from media_store import MediaStore
+from media_transport import ShmTransport
+from outbox import Outbox
+from rate_limit import TokenBucket
 
+# telegram is imported once the intake is running, see MessageBot.run
 
-pwd = os.path.dirname(os.path.realpath(__file__))
-log_folder = os.path.join(pwd, "log")
-if not os.path.exists(log_folder):
-    os.makedirs(log_folder)
+# the arguments carrying a file, an upload that timed out may have arrived
+UPLOAD_ARGS = ("photo", "video", "document", "media")
 
-logging.basicConfig(
-    filename=os.path.join(log_folder, "message_bot.log"),
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.ERROR,
-)
+
+async_log.setup("bot", "message_bot.log")
+
+
+class DatagramIntake(asyncio.DatagramProtocol):
+    """Feeds UDP datagrams into the message queue of a MessageBot."""
+
+    def __init__(self, message_bot):
+        self.message_bot = message_bot
+
+    def datagram_received(self, data, addr):
+        self.message_bot.enqueue(data)
+
+    def error_received(self, exc):
+        logging.error(exc)
 
 
 class MessageBot:
@@ -50,9 +72,15 @@ class MessageBot:
     SIG_STOP = 1
     SIG_DISCONNECT = 2
 
+    # text alerts are served before media uploads
+    PRIORITY_TEXT = 0
+    PRIORITY_MEDIA = 1
+
     def __init__(self, config):
         self.location = config["name"]
         self.photo_path = Path(config["photo_path"])
+        self.video_path = Path(config["video_path"])
+        self.transport = ShmTransport(config.get("media_transport", {}))
 
         # telegram bot
         self.bot_config = config["bot"]
@@ -60,90 +88,1117 @@ class MessageBot:
         self.token = self.bot_config["bot_token"]
         self.chat_id = self.bot_config["chat_id"]
 
-        self.bot = Bot(self.token)
+        self.session_config = self.bot_config.get("session", {})
+        # created by run() once the intake is running
+        self.bot = None
+        # one worker rebuilds a stale session, the others wait for it
+        self.reconnect_lock = asyncio.Lock()
+        self.session_generation = 0
+        self.last_call = 0.0
+        self.latency = deque(maxlen=self.session_config.get("latency_history", 100))
+
+        # the rate limit, album, progressive, alert and retention options
+        # follow config.json, see apply_settings()
+        self.settings = None
+        self.limiter = None
+        self.media_store = None
+
+        # pending photo albums, keyed by event
+        self.albums = {}
+        self.background_tasks = set()
+
+        # full resolution photos waiting for the user, keyed by event
+        self.full_cache = OrderedDict()
+
+        # messages that failed while the network was down, kept on the disk
+        outbox_config = self.bot_config.get("outbox", {})
+        self.outbox = None
+        if outbox_config.get("enabled", False):
+            self.outbox = Outbox(outbox_config, self.photo_path / "outbox.db")
+        self.outbox_ready = asyncio.Event()
+
+        # videos are uploaded one at a time, next to the photo workers
+        video_config = self.bot_config.get("video", {})
+        self.video_max_bytes = video_config.get("max_mb", 48) * 1024 * 1024
+        self.video_write_timeout = video_config.get("write_timeout", 300)
+        self.video_queue = asyncio.Queue()
+
+        # stage timings of the delivered events, served to Prometheus
+        self.metrics_config = self.bot_config.get("metrics", {})
+        self.metrics = tracing.StageMetrics(
+            self.metrics_config.get("window", 200), self.queue_stats
+        )
+
+        # the index of the events and the retention of the media on the disk
+        store_config = config.get("media_store", {})
+        if store_config.get("enabled", False) and hub.role(config) != "node":
+            self.media_store = MediaStore(store_config, self.photo_path / "media.db")
+
+        # units sharing one bot session through a hub, see hub.py
+        self.hub_config = config.get("hub", {})
+        self.hub_role = hub.role(config)
+        self.hub_secret = self.hub_config.get("secret", "")
+        self.hub_client = None
+        self.nodes = hub.NodeRegistry(config.get("ipc", {}), self.hub_secret)
+        self.camera_client = None
+        if self.hub_role != "off":
+            # commands routed by the hub go straight to the camera
+            self.camera_client = ipc.connect(config, "camera")
+        self.alert_batch = None
+        self.alert_seen = {}
 
         self.emoji_robot = "\U0001F916"
 
+        self.ipc_transport = ipc.transport(config)
+        self.ipc_path = ipc.socket_path(config, "bot")
         self.ip = "127.0.0.1"
         self.port = self.bot_config["listen_port"]
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.udp_socket.settimeout(1)
+        self.udp_socket.setsockopt(
+            socket.SOL_SOCKET,
+            socket.SO_RCVBUF,
+            self.bot_config.get("receive_buffer_kb", 256) * 1024,
+        )
+        self.udp_socket.setblocking(False)
+
+        self.upload_workers = self.bot_config.get("upload_workers", 2)
+        self.queue = asyncio.PriorityQueue(
+            maxsize=self.bot_config.get("queue_size", 100)
+        )
+        self.sequence = itertools.count()
+        self.dropped = 0
+        self.ready = asyncio.Event()
+
+        self.apply_settings(settings.Settings.from_config(config))
+
+    def apply_settings(self, reloaded):
+        """Swaps in reloaded settings.
+
+        Runs on the event loop, so no coroutine sees half of them. The rate
+        limiter is only replaced when its own options changed, and the
+        media store keeps its index with the new retention limits.
+
+        Parameters
+        ----------
+        reloaded : settings.Settings
+            The reloaded settings.
+        """
+        old = self.settings
+        new = reloaded.bot
+        self.settings = new
+        if old is None or (new.rate, new.burst) != (old.rate, old.burst):
+            self.limiter = TokenBucket(new.rate, new.burst)
+        self.max_retries = new.max_retries
+        self.album_size = new.album_size
+        self.album_delay = new.album_delay
+        self.full_cache_size = new.full_cache_size
+        self.full_idle_delay = new.full_idle_delay
+        self.alert_delay = new.alert_delay
+        self.dedupe_window = new.dedupe_window
+        self.sweep_interval = new.sweep_interval
+        if self.media_store is not None and old is not None:
+            self.media_store.configure(new.media_store)
+
+    def priority(self, msg):
+        if msg.get("cmd") == "send_msg":
+            return self.PRIORITY_TEXT
+        return self.PRIORITY_MEDIA
+
+    async def receive(self, msg):
+        # waiting for room in the queue delays the ack, so senders slow down
+        await self.queue.put((self.priority(msg), next(self.sequence), msg))
+
+    def enqueue(self, data):
+        try:
+            msg = json.loads(data.decode())
+        except ValueError as err:
+            logging.error(err)
+            return
+        self.submit(msg)
+
+    def submit(self, msg):
+        try:
+            self.queue.put_nowait((self.priority(msg), next(self.sequence), msg))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logging.error(
+                "Message queue full, dropped %s (%d dropped in total)",
+                msg.get("cmd"),
+                self.dropped,
+            )
+            self.release_media(msg)
+
+    def create_bot(self):
+        """Imports telegram and creates the bot on the shared session."""
+        from telegram import Bot  # pylint: disable=import-outside-toplevel
+
+        # a local Bot API server, or a stand-in for benchmarks
+        api_url = self.bot_config.get("api_url")
+        if api_url:
+            return Bot(self.token, base_url=api_url, request=self.make_request())
+        return Bot(self.token, request=self.make_request())
+
+    def make_request(self):
+        """Creates a pooled HTTP client that keeps its connections alive."""
+        # pylint: disable-next=import-outside-toplevel
+        from telegram.request import HTTPXRequest
+
+        pool_size = self.session_config.get("pool_size", 4)
+        request_kwargs = {
+            "connection_pool_size": pool_size,
+            "connect_timeout": self.session_config.get("connect_timeout", 10),
+            "read_timeout": self.session_config.get("read_timeout", 30),
+            "write_timeout": self.session_config.get("write_timeout", 60),
+            "pool_timeout": self.session_config.get("pool_timeout", 10),
+        }
+        try:
+            import httpx  # pylint: disable=import-outside-toplevel
+
+            return HTTPXRequest(
+                httpx_kwargs={
+                    "limits": httpx.Limits(
+                        max_connections=pool_size,
+                        max_keepalive_connections=pool_size,
+                        keepalive_expiry=self.session_config.get(
+                            "keepalive_expiry", 120
+                        ),
+                    )
+                },
+                **request_kwargs,
+            )
+        except TypeError:
+            # python-telegram-bot before 21.6 has no httpx_kwargs
+            return HTTPXRequest(**request_kwargs)
+
+    async def reconnect(self, generation):
+        async with self.reconnect_lock:
+            if generation != self.session_generation:
+                # another worker rebuilt the session after this call failed
+                return
+            logging.error("Bot session is stale, reconnecting")
+            try:
+                await self.bot.shutdown()
+            except Exception as exp:  # pylint: disable=broad-exception-caught
+                logging.error(exp)
+            await self.bot.initialize()
+            self.session_generation += 1
+
+    async def call(self, method, **kwargs):
+        """Calls a Bot API method on the shared session.
+
+        Every call waits for the rate limiter. A retry-after response pauses
+        the limiter and the call is repeated, a stale session is reconnected
+        and the call retried. A bad request fails at once, and so does an
+        upload that timed out, Telegram may have received the file. Open
+        files are rewound before every attempt, so a retry sends them whole.
+        The latency of every call is kept in `self.latency`.
+        """
+        # pylint: disable-next=import-outside-toplevel
+        from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+
+        upload = any(key in kwargs for key in UPLOAD_ARGS)
+        start = time.perf_counter()
+        attempts = 0
+        while True:
+            await self.limiter.acquire()
+            generation = self.session_generation
+            for value in kwargs.values():
+                if hasattr(value, "seek"):
+                    # a failed attempt may have read the file to the end
+                    value.seek(0)
+            try:
+                result = await method(**kwargs)
+            except BadRequest:
+                # a deterministic failure, a retry would fail the same way
+                raise
+            except RetryAfter as err:
+                retry_after = getattr(
+                    err.retry_after, "total_seconds", lambda: err.retry_after
+                )()
+                logging.warning("Rate limited, retrying in %s s", retry_after)
+                self.limiter.pause(retry_after)
+                error = err
+            except NetworkError as err:
+                if upload and isinstance(err, TimedOut):
+                    raise
+                logging.error(err)
+                await self.reconnect(generation)
+                error = err
+            else:
+                break
+
+            attempts += 1
+            if attempts > self.max_retries:
+                raise error
+        elapsed = time.perf_counter() - start
+
+        self.last_call = time.monotonic()
+        self.latency.append(elapsed)
+        logging.info("%s took %.0f ms", method.__name__, elapsed * 1000)
+        return result
+
+    async def keep_alive(self):
+        """Keeps the session warm with a cheap request when the link is idle."""
+        interval = self.session_config.get("keepalive_interval", 60)
+        if interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(interval)
+            if time.monotonic() - self.last_call < interval:
+                continue
+            try:
+                await self.call(self.bot.get_me)
+            except Exception as exp:  # pylint: disable=broad-exception-caught
+                logging.error(exp)
+            else:
+                if self.outbox is not None and len(self.outbox) > 0:
+                    # the link is back, replay without waiting for the backoff
+                    self.outbox.retry_now()
+                    self.outbox_ready.set()
+
+    def queue_stats(self):
+        return {"depth": self.queue.qsize(), "dropped": self.dropped}
+
+    def read_photo(self, ref):
+        if "handle" in ref:
+            return self.transport.read(ref["handle"])
+        file = self.photo_path / (ref["file_name"] + ref["extension"])
+        with open(file, "rb") as photo:
+            data = photo.read()
+        if self.media_store is not None:
+            self.media_store.touch(file)
+        return data
+
+    def discard_photo(self, ref):
+        if "handle" in ref:
+            self.transport.release(ref["handle"])
+            logging.info("Release photo")
+        else:
+            os.remove(self.photo_path / (ref["file_name"] + ref["extension"]))
+            logging.info("Delete photo")
+
+    def media_files(self, msg):
+        if msg.get("file_type") == "H264":
+            names = [msg["file_name"] + msg["extension"]] + msg.get("parts", [])
+            return [self.video_path / name for name in names]
+        return [
+            self.photo_path / (ref["file_name"] + ref["extension"])
+            for ref in (msg, msg.get("preview", {}))
+            if "file_name" in ref
+        ]
+
+    def release_media(self, msg):
+        # media that will never be sent are not left behind
+        for ref in (msg, msg.get("preview", {})):
+            if "handle" in ref:
+                self.transport.release(ref["handle"])
+        for file in self.media_files(msg):
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+
+    def spill_photo(self, ref):
+        # slabs do not survive a reboot, stored messages keep photos on the disk
+        if "handle" not in ref:
+            return ref
+        spilled = dict(ref)
+        handle = spilled.pop("handle")
+        spilled["file_name"] = handle[: -len(ref["extension"])]
+        with open(self.photo_path / handle, "wb") as photo:
+            photo.write(self.transport.read(handle))
+        self.transport.release(handle)
+        return spilled
+
+    def media_size(self, msg):
+        size = 0
+        for file in self.media_files(msg):
+            try:
+                size += os.path.getsize(file)
+            except FileNotFoundError:
+                pass
+        return size
+
+    @staticmethod
+    def transient(err):
+        """Tells if a failed call may succeed later, once the network is back."""
+        # pylint: disable-next=import-outside-toplevel
+        from telegram.error import BadRequest, NetworkError, RetryAfter
+
+        if isinstance(err, RetryAfter):
+            return True
+        return isinstance(err, NetworkError) and not isinstance(err, BadRequest)
+
+    @staticmethod
+    def messages(kind, payload):
+        return payload if kind == "album" else [payload]
+
+    async def index_event(self, msg):
+        kind = {"send_msg": "alert", "send_photo": "photo", "upload_file": "video"}
+        if self.media_store is None or msg.get("cmd") not in kind:
+            return
+        # the store writes wait while the sweep holds the database, off the loop
+        msg["event_id"] = await asyncio.to_thread(
+            self.media_store.add,
+            kind[msg["cmd"]],
+            self.event_key(msg),
+            msg.get("node", self.location),
+            self.media_files(msg),
+        )
+
+    async def mark(self, kind, payload, status):
+        if self.media_store is None:
+            return
+        event_ids = [
+            alert["event_id"]
+            for msg in self.messages(kind, payload)
+            for alert in msg.get("alerts", [msg])
+            if "event_id" in alert
+        ]
+        await asyncio.to_thread(self.media_store.set_status, event_ids, status)
+
+    async def sweep_media(self):
+        await asyncio.to_thread(
+            self.media_store.adopt, [self.photo_path, self.video_path]
+        )
+        while True:
+            try:
+                await asyncio.to_thread(self.media_store.sweep)
+            except Exception as exp:  # pylint: disable=broad-exception-caught
+                logging.error(exp)
+            await asyncio.sleep(self.sweep_interval)
+
+    async def deliver(self, kind, payload):
+        if kind == "album":
+            await self.sendAlbum(payload)
+        elif kind == "msg":
+            await self.sendMsg(payload)
+        elif kind == "video":
+            await self.sendVideo(payload)
+
+    async def dispatch(self, kind, payload):
+        """Delivers a message, or stores it in the outbox when that fails.
+
+        While the outbox holds messages, new ones are stored behind them,
+        so everything is delivered in order once the network is back.
+        """
+        if self.outbox is not None and len(self.outbox) > 0:
+            await self.store(kind, payload)
+            return
+
+        try:
+            await self.deliver(kind, payload)
+        except Exception as exp:
+            if self.outbox is None or not self.transient(exp):
+                await self.mark(kind, payload, "failed")
+                for msg in self.messages(kind, payload):
+                    self.release_media(msg)
+                raise
+            logging.error("%s, keeping the message in the outbox", exp)
+            await self.store(kind, payload)
+        else:
+            await self.mark(kind, payload, "delivered")
+
+    async def store(self, kind, payload):
+        await self.mark(kind, payload, "queued")
+        stored = []
+        for msg in self.messages(kind, payload):
+            msg = self.spill_photo(msg)
+            if "preview" in msg:
+                msg["preview"] = self.spill_photo(msg["preview"])
+            stored.append(msg)
+
+        size = sum(self.media_size(msg) for msg in stored)
+        if kind != "album":
+            stored = stored[0]
+        for evicted_kind, evicted in self.outbox.add(kind, stored, size):
+            await self.mark(evicted_kind, evicted, "failed")
+            for msg in self.messages(evicted_kind, evicted):
+                self.release_media(msg)
+        self.outbox_ready.set()
+
+    async def drain_outbox(self):
+        """Replays the stored messages in order, backing off after failures."""
+        while True:
+            entry = self.outbox.head()
+            delay = None if entry is None else entry["next_attempt"] - time.time()
+            if delay is None or delay > 0:
+                # new messages and reconnects wake the drain up early
+                self.outbox_ready.clear()
+                try:
+                    await asyncio.wait_for(self.outbox_ready.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await self.deliver(entry["kind"], entry["payload"])
+            except Exception as exp:  # pylint: disable=broad-exception-caught
+                if self.transient(exp):
+                    delay = self.outbox.defer(entry["id"])
+                    logging.error("%s, retrying the outbox in %.0f s", exp, delay)
+                    continue
+                logging.error(exp)
+                await self.mark(entry["kind"], entry["payload"], "failed")
+                for msg in self.messages(entry["kind"], entry["payload"]):
+                    self.release_media(msg)
+            else:
+                await self.mark(entry["kind"], entry["payload"], "delivered")
+            self.outbox.remove(entry["id"])
+            logging.info("Outbox message %d delivered", entry["id"])
+
+    @staticmethod
+    def event_key(msg):
+        # photos of one event share the date/time prefix of their file name
+        key = msg["date"] + "_" + msg["time"]
+        if "node" in msg:
+            key = hub.slug(msg["node"]) + "_" + key
+        return key
 
     async def sendImage(self, msg):
-        file = self.photo_path / (msg["file_name"] + msg["extension"])
-        if msg["server"] == "telegram":
-            async with self.bot:
-                await self.bot.sendPhoto(
+        await self.sendAlbum([msg])
+
+    async def sendAlbum(self, batch):
+        # pylint: disable-next=import-outside-toplevel
+        from telegram import (
+            InlineKeyboardButton,
+            InlineKeyboardMarkup,
+            InputMediaPhoto,
+        )
+
+        # with progressive delivery only the previews are sent right away
+        key = self.event_key(batch[0])
+        progressive = "preview" in batch[0]
+        refs = [msg["preview"] if progressive else msg for msg in batch]
+        upload_start = time.time()
+        if batch[0]["server"] == "telegram":
+            caption = (
+                "A photo has been taken from your ["
+                + batch[0].get("node", self.location)
+                + "] at "
+                + batch[0]["date"]
+                + " "
+                + batch[0]["time"]
+            )
+            markup = None
+            if progressive:
+                markup = InlineKeyboardMarkup(
+                    [
+                        [
+                            InlineKeyboardButton(
+                                "Full resolution", callback_data="full:" + key
+                            )
+                        ]
+                    ]
+                )
+
+            if len(batch) == 1:
+                await self.call(
+                    self.bot.sendPhoto,
+                    chat_id=self.chat_id,
+                    photo=await asyncio.to_thread(self.read_photo, refs[0]),
+                    caption=caption,
+                    reply_markup=markup,
+                )
+            else:
+                await self.call(
+                    self.bot.sendMediaGroup,
                     chat_id=self.chat_id,
-                    photo=open(file, "rb"),
-                    caption="A photo has been taken from your ["
-                    + self.location
-                    + "] at "
-                    + msg["date"]
-                    + " "
-                    + msg["time"],
+                    media=[
+                        InputMediaPhoto(
+                            await asyncio.to_thread(self.read_photo, ref),
+                            caption=caption if idx == 0 else None,
+                        )
+                        for idx, ref in enumerate(refs)
+                    ],
                 )
+                if markup is not None:
+                    # albums cannot carry buttons
+                    await self.call(
+                        self.bot.sendMessage,
+                        chat_id=self.chat_id,
+                        text=str(len(batch)) + " photos in full resolution",
+                        reply_markup=markup,
+                    )
+        logging.info("Send %d photos", len(batch))
 
-        logging.info("Send photo")
-        os.remove(file)
-        logging.info("Delete photo")
+        upload_end = time.time()
+        for msg in batch:
+            if "trace" in msg:
+                # queue covers the message queue, the album delay and retries
+                trace = msg["trace"]
+                tracing.add_stage(trace, "queue", upload_start - trace["sent"])
+                tracing.add_stage(trace, "upload", upload_end - upload_start)
+                self.metrics.record(trace, upload_end)
 
-    async def sendMsg(self, msg):
-        async with self.bot:
-            await self.bot.sendMessage(
+        for ref in refs:
+            self.discard_photo(ref)
+        if progressive:
+            self.cacheFullPhotos(key, batch)
+
+    def cacheFullPhotos(self, key, batch):
+        if key not in self.full_cache and self.full_idle_delay > 0:
+            self.start_task(self.autoSendFull(key))
+
+        self.full_cache.setdefault(key, []).extend(batch)
+        self.full_cache.move_to_end(key)
+        while len(self.full_cache) > self.full_cache_size:
+            _, evicted = self.full_cache.popitem(last=False)
+            for msg in evicted:
+                self.discard_photo(msg)
+
+    async def sendFull(self, msg):
+        # pylint: disable-next=import-outside-toplevel
+        from telegram import InputMediaDocument
+
+        batch = self.full_cache.pop(msg["event"], None)
+        if batch is None:
+            await self.call(
+                self.bot.sendMessage,
                 chat_id=self.chat_id,
-                text="Motion detected in ["
-                + self.location
+                text="The full resolution photos are no longer available.",
+            )
+            return
+
+        try:
+            for idx in range(0, len(batch), 10):
+                chunk = batch[idx : idx + 10]
+                if len(chunk) == 1:
+                    await self.call(
+                        self.bot.sendDocument,
+                        chat_id=self.chat_id,
+                        document=await asyncio.to_thread(self.read_photo, chunk[0]),
+                        filename=msg["event"] + chunk[0]["extension"],
+                    )
+                else:
+                    await self.call(
+                        self.bot.sendMediaGroup,
+                        chat_id=self.chat_id,
+                        media=[
+                            InputMediaDocument(
+                                await asyncio.to_thread(self.read_photo, ref),
+                                filename=msg["event"]
+                                + "_"
+                                + str(idx + ref_idx)
+                                + ref["extension"],
+                            )
+                            for ref_idx, ref in enumerate(chunk)
+                        ],
+                    )
+        except Exception:
+            # keep the photos, the user can ask again
+            self.full_cache[msg["event"]] = batch
+            raise
+
+        for ref in batch:
+            self.discard_photo(ref)
+
+    async def autoSendFull(self, key):
+        await asyncio.sleep(self.full_idle_delay)
+        while self.queue.qsize() > 0 or self.albums:
+            await asyncio.sleep(1)
+        if key in self.full_cache:
+            try:
+                await self.sendFull({"event": key})
+            except Exception as exp:  # pylint: disable=broad-exception-caught
+                logging.error(exp)
+
+    def start_task(self, coro):
+        task = asyncio.create_task(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def addToAlbum(self, msg):
+        key = self.event_key(msg)
+        batch = self.albums.setdefault(key, [])
+        batch.append(msg)
+
+        if len(batch) >= self.album_size:
+            del self.albums[key]
+            await self.dispatch("album", batch)
+        elif len(batch) == 1:
+            self.start_task(self.flushAlbum(key, batch))
+
+    async def flushAlbum(self, key, batch):
+        await asyncio.sleep(self.album_delay)
+        if self.albums.get(key) is not batch:
+            return
+        del self.albums[key]
+        try:
+            await self.dispatch("album", batch)
+        except Exception as exp:  # pylint: disable=broad-exception-caught
+            logging.error(exp)
+
+    async def sendMsg(self, msg):
+        # the hub merges the alerts of several units into one message
+        alerts = msg.get("alerts", [msg])
+        await self.call(
+            self.bot.sendMessage,
+            chat_id=self.chat_id,
+            text="Motion detected in "
+            + ", ".join(
+                "["
+                + alert.get("node", self.location)
                 + "] at "
-                + msg["date"]
+                + alert["date"]
                 + " "
-                + msg["time"],
+                + alert["time"]
+                for alert in alerts
+            ),
+        )
+
+    async def addToAlerts(self, msg):
+        node = msg.get("node", self.location)
+        now = time.monotonic()
+        if now - self.alert_seen.get(node, -self.dedupe_window) < self.dedupe_window:
+            logging.info("Alert from [%s] within the dedupe window, skipped", node)
+            await self.mark("msg", msg, "skipped")
+            return
+        self.alert_seen[node] = now
+
+        if self.alert_batch is None:
+            self.alert_batch = []
+            self.start_task(self.flushAlerts(self.alert_batch))
+        self.alert_batch.append(msg)
+
+    async def flushAlerts(self, batch):
+        await asyncio.sleep(self.alert_delay)
+        self.alert_batch = None
+        try:
+            await self.dispatch("msg", {"cmd": "send_msg", "alerts": batch})
+        except Exception as exp:  # pylint: disable=broad-exception-caught
+            logging.error(exp)
+
+    async def sendVideo(self, msg):
+        """Uploads a recorded clip as one or more playable MP4 videos.
+
+        Raw H.264 is remuxed into MP4 and clips over `max_mb` are split at
+        key frames, both without re-encoding. The message keeps track of the
+        parts still to send, so a clip stored in the outbox resumes with the
+        first part that was not delivered.
+        """
+        caption = (
+            "A video has been recorded from your ["
+            + msg.get("node", self.location)
+            + "] at "
+            + msg["date"]
+            + " "
+            + msg["time"]
+        )
+        if msg["extension"] == ".h264":
+            source = self.media_files(msg)[0]
+            try:
+                await video_remux.remux(
+                    str(source), str(source.with_suffix(".mp4")), msg.get("fps", 30)
+                )
+            except (OSError, RuntimeError) as err:
+                # without ffmpeg the raw stream can still be downloaded
+                logging.error(err)
+                with open(source, "rb") as video:
+                    await self.call(
+                        self.bot.sendDocument,
+                        chat_id=self.chat_id,
+                        document=video,
+                        caption=caption,
+                        write_timeout=self.video_write_timeout,
+                    )
+                os.remove(source)
+                return
+            os.remove(source)
+            msg["extension"] = ".mp4"
+            await self.track_media(msg)
+
+        if "parts" not in msg:
+            source = self.media_files(msg)[0]
+            parts = await video_remux.split(str(source), self.video_max_bytes)
+            if len(parts) > 1:
+                os.remove(source)
+            msg["parts"] = [os.path.basename(part) for part in parts]
+            msg["part_count"] = len(parts)
+            await self.track_media(msg)
+
+        while msg["parts"]:
+            part = self.video_path / msg["parts"][0]
+            if msg["part_count"] > 1:
+                part_idx = msg["part_count"] - len(msg["parts"]) + 1
+                part_caption = caption + f" ({part_idx}/{msg['part_count']})"
+            else:
+                part_caption = caption
+            with open(part, "rb") as video:
+                await self.call(
+                    self.bot.sendVideo,
+                    chat_id=self.chat_id,
+                    video=video,
+                    caption=part_caption,
+                    supports_streaming=True,
+                    write_timeout=self.video_write_timeout,
+                )
+            os.remove(part)
+            msg["parts"].pop(0)
+        logging.info("Send video %s", msg["file_name"])
+
+    async def track_media(self, msg):
+        # remuxed and split clips are new files of the same event
+        if self.media_store is not None and "event_id" in msg:
+            await asyncio.to_thread(
+                self.media_store.track, msg["event_id"], self.media_files(msg)
             )
 
-    async def run(self):
-        logging.info("MyBot thread started")
-        async with self.bot:
-            await self.bot.sendMessage(
+    async def video_worker(self):
+        while True:
+            msg = await self.video_queue.get()
+            try:
+                await self.dispatch("video", msg)
+            except Exception as exp:  # pylint: disable=broad-exception-caught
+                logging.error(exp)
+            finally:
+                self.video_queue.task_done()
+
+    async def sendStats(self):
+        mode = self.bot_config.get("updates", {}).get("mode", "polling")
+        lines = [
+            "Latency of the last events ["
+            + self.location
+            + "], commands by "
+            + mode
+            + ":"
+        ]
+        for stage, values in self.metrics.percentiles().items():
+            lines.append(
+                f"{stage}: p50 {values['p50'] * 1000:.0f} ms, "
+                f"p95 {values['p95'] * 1000:.0f} ms ({values['count']})"
+            )
+        if len(lines) == 1:
+            lines.append("No events yet.")
+        queue = self.queue_stats()
+        lines.append(f"Queue: {queue['depth']} waiting, {queue['dropped']} dropped")
+        await self.call(
+            self.bot.sendMessage, chat_id=self.chat_id, text="\n".join(lines)
+        )
+
+    def cameras(self):
+        names = self.nodes.names()
+        if self.hub_config.get("camera", True):
+            names.insert(0, self.location)
+        return names
+
+    async def sendCameras(self):
+        await self.call(
+            self.bot.sendMessage,
+            chat_id=self.chat_id,
+            text="Cameras: " + ", ".join(self.cameras()),
+        )
+
+    async def route(self, msg):
+        """Passes a command from the chat to the camera of one or all units."""
+        name = msg.get("node", "")
+        targets = [
+            camera
+            for camera in self.cameras()
+            if not name or camera.lower() == name.lower()
+        ]
+        if not targets:
+            await self.call(
+                self.bot.sendMessage,
                 chat_id=self.chat_id,
-                text="Hello! "
-                + self.emoji_robot
-                + self.bot_name
-                + self.emoji_robot
-                + " ["
-                + self.location
-                + "] is at your service.",
+                text="There is no camera named ["
+                + name
+                + "]. Cameras: "
+                + ", ".join(self.cameras()),
             )
+            return
+        for camera in targets:
+            if camera == self.location and self.hub_config.get("camera", True):
+                self.camera_client.send(msg["msg"], timeout=0)
+            else:
+                self.nodes.send(camera, msg["msg"])
+
+    def pack_photo(self, ref):
+        packed = dict(ref, data=self.read_photo(ref))
+        if "handle" in packed:
+            handle = packed.pop("handle")
+            packed["file_name"] = handle[: -len(ref["extension"])]
+        return packed
+
+    def unpack_photo(self, ref, node):
+        # the names of different units may collide, the node prefixes them
+        unpacked = dict(ref)
+        unpacked.pop("handle", None)
+        unpacked["file_name"] = (
+            hub.slug(node) + "_" + os.path.basename(ref["file_name"])
+        )
+        unpacked["extension"] = os.path.basename(ref["extension"])
+        file = self.photo_path / (unpacked["file_name"] + unpacked["extension"])
+        with open(file, "wb") as photo:
+            photo.write(unpacked.pop("data"))
+        return unpacked
 
+    def unpack_video(self, msg):
+        name = hub.slug(msg["node"]) + "_" + os.path.basename(msg["file_name"])
+        msg["extension"] = os.path.basename(msg["extension"])
+        # the clip arrives as one file, parts would name files of the hub
+        msg.pop("parts", None)
+        mode = "wb" if msg.pop("offset") == 0 else "ab"
+        with open(self.video_path / (name + msg["extension"]), mode) as video:
+            video.write(msg.pop("data"))
+        if not msg.pop("last"):
+            return None
+        msg["cmd"] = "upload_file"
+        msg["file_name"] = name
+        return msg
+
+    async def send_hub(self, msg):
+        # waits for room in the queue, so a slow link slows the workers down
+        sent = await asyncio.to_thread(
+            self.hub_client.send,
+            hub.sign(msg, self.hub_secret),
+            self.hub_config.get("send_timeout", 30),
+        )
+        if not sent:
+            self.dropped += 1
+
+    async def forward(self, msg):
+        """Forwards a message to the hub, with its media inlined."""
+        msg = dict(msg, node=self.location)
+        if msg["cmd"] == "send_photo":
+            forwarded = await asyncio.to_thread(self.pack_photo, msg)
+            if "preview" in msg:
+                forwarded["preview"] = await asyncio.to_thread(
+                    self.pack_photo, msg["preview"]
+                )
+            self.release_media(msg)
+            await self.send_hub(forwarded)
+        elif msg["cmd"] == "upload_file":
+            # clips are sent in chunks, the hub puts them back together
+            source = self.media_files(msg)[0]
+            size = os.path.getsize(source)
+            offset = 0
+            with open(source, "rb") as video:
+                while True:
+                    data = await asyncio.to_thread(video.read, hub.CHUNK_SIZE)
+                    last = offset + len(data) >= size
+                    await self.send_hub(
+                        dict(
+                            msg, cmd="video_chunk", data=data, offset=offset, last=last
+                        )
+                    )
+                    offset += len(data)
+                    if last:
+                        break
+            os.remove(source)
+        elif msg["cmd"] == "send_msg":
+            await self.send_hub(msg)
+
+    async def receive_node(self, msg):
+        """Takes a message forwarded by a node, storing its media locally."""
+        if not hub.verify(msg, self.hub_secret):
+            logging.error("Dropped %s with a wrong hub secret", msg.get("cmd"))
+            return
+        if msg["cmd"] == "node_hello":
+            self.nodes.register(msg)
+            return
+        if msg["cmd"] == "send_photo":
+            msg = await asyncio.to_thread(self.unpack_photo, msg, msg["node"])
+            if "preview" in msg:
+                msg["preview"] = await asyncio.to_thread(
+                    self.unpack_photo, msg["preview"], msg["node"]
+                )
+        elif msg["cmd"] == "video_chunk":
+            msg = await asyncio.to_thread(self.unpack_video, msg)
+            if msg is None:
+                return
+        await self.receive(msg)
+
+    async def take_command(self, msg):
+        if not hub.verify(msg, self.hub_secret):
+            logging.error("Dropped %s with a wrong hub secret", msg.get("cmd"))
+            return
+        self.camera_client.send(msg, timeout=0)
+
+    async def hello_hub(self, port):
+        hub_address = hub.address(self.hub_config)
+        while True:
+            try:
+                host = self.hub_config.get("node_host") or hub.local_ip(hub_address)
+            except OSError as err:
+                # no route to the hub yet
+                logging.error(err)
+            else:
+                hello = {"cmd": "node_hello", "node": self.location}
+                self.hub_client.send(
+                    hub.sign(dict(hello, address=[host, port]), self.hub_secret),
+                    timeout=0,
+                )
+            await asyncio.sleep(self.hub_config.get("hello_interval", 60))
+
+    async def run_node(self):
+        """Forwards everything to the hub and takes commands from it."""
+        self.hub_client = ipc.IpcClient(
+            hub.address(self.hub_config),
+            queue_size=self.hub_config.get("queue_size", 32),
+            window=self.hub_config.get("window", 8),
+        )
+        port = self.hub_config.get("command_port", 6671)
+        commands = await ipc.AsyncIpcServer(
+            hub.listen_address(self.hub_config, port), self.take_command
+        ).start()
+        startup_profile.mark("bot", "connect hub")
+        startup_profile.report("bot")
+
+        tasks = [
+            asyncio.create_task(self.upload_worker())
+            for _ in range(0, self.upload_workers)
+        ]
+        tasks.append(asyncio.create_task(self.hello_hub(port)))
         try:
-            self.udp_socket.bind((self.ip, self.port))
-        except OSError as err:
-            logging.error(err)
+            await asyncio.gather(*tasks)
+        finally:
+            commands.close()
+
+    async def sendHistory(self, msg):
+        hours = msg.get("hours", 12)
+        if self.media_store is None:
+            lines = ["The event history is disabled."]
         else:
-            while True:
+            events = await asyncio.to_thread(
+                self.media_store.history, time.time() - hours * 3600
+            )
+            lines = [f"{len(events)} events in the last {hours:g} h:"]
+            for event in events[-40:]:
+                count = f" x{event['count']}" if event["count"] > 1 else ""
+                lines.append(
+                    time.strftime("%a %H:%M", time.localtime(event["created"]))
+                    + f" [{event['node']}] {event['kind']}{count}, {event['status']}"
+                )
+        await self.call(
+            self.bot.sendMessage, chat_id=self.chat_id, text="\n".join(lines)
+        )
+
+    async def upload_worker(self):
+        while True:
+            _, _, msg = await self.queue.get()
+            try:
+                await self.index_event(msg)
+                if self.hub_role == "node":
+                    # the hub holds the bot session
+                    await self.forward(msg)
+                elif msg["cmd"] == "send_photo":
+                    await self.addToAlbum(msg)
+                elif msg["cmd"] == "send_msg" and self.hub_role == "hub":
+                    await self.addToAlerts(msg)
+                elif msg["cmd"] == "send_msg":
+                    await self.dispatch("msg", msg)
+                elif msg["cmd"] == "send_full":
+                    await self.sendFull(msg)
+                elif msg["cmd"] == "send_stats":
+                    await self.sendStats()
+                elif msg["cmd"] == "upload_file":
+                    # long uploads must not hold up the photo workers
+                    self.video_queue.put_nowait(msg)
+                elif msg["cmd"] == "route":
+                    await self.route(msg)
+                elif msg["cmd"] == "send_cameras":
+                    await self.sendCameras()
+                elif msg["cmd"] == "send_history":
+                    await self.sendHistory(msg)
+            except Exception as exp:  # pylint: disable=broad-exception-caught
+                logging.error(exp)
+            finally:
+                self.queue.task_done()
+
+    async def run(self):
+        logging.info("MyBot thread started")
+        # accept messages first, they wait in the queue for the session
+        intake = None
+        if self.ipc_transport == "inproc":
+            ipc.register("bot", self.submit, loop=asyncio.get_running_loop())
+        elif self.ipc_transport == "unix":
+            intake = await ipc.AsyncIpcServer(self.ipc_path, self.receive).start()
+        else:
+            try:
+                self.udp_socket.bind((self.ip, self.port))
+            except OSError as err:
+                logging.error(err)
+                return
+
+            loop = asyncio.get_running_loop()
+            intake, _ = await loop.create_datagram_endpoint(
+                lambda: DatagramIntake(self), sock=self.udp_socket
+            )
+        metrics_server = None
+        if self.metrics_config.get("enabled", False):
+            metrics_server = await self.metrics.serve(
+                self.metrics_config.get("host", "127.0.0.1"),
+                self.metrics_config.get("port", 9464),
+            )
+        hub_server = None
+        if self.hub_role == "hub":
+            self.photo_path.mkdir(parents=True, exist_ok=True)
+            self.video_path.mkdir(parents=True, exist_ok=True)
+            hub_address = hub.listen_address(
+                self.hub_config, self.hub_config.get("port", 6670)
+            )
+            hub_server = await ipc.AsyncIpcServer(
+                hub_address, self.receive_node
+            ).start()
+        startup_profile.mark("bot", "ready for messages")
+        self.ready.set()
+        ipc.notify_ready()
+
+        try:
+            if self.hub_role == "node":
+                # the hub holds the only bot session
+                await self.run_node()
+                return
+
+            # the import is slow, keep the intake running meanwhile
+            with startup_profile.phase("bot", "import telegram"):
+                self.bot = await asyncio.to_thread(self.create_bot)
+
+            # one long-lived bot session is shared by all upload workers
+            async with self.bot:
                 try:
-                    data, _ = self.udp_socket.recvfrom(4096)
-                except socket.timeout as t_out:
-                    logging.info(t_out)
-                else:
-                    if data:
-                        try:
-                            msg = json.loads(data.decode())
-                            if msg["cmd"] == "send_photo":
-                                await self.sendImage(msg)
-                            elif msg["cmd"] == "send_msg":
-                                await self.sendMsg(msg)
-                        except (
-                            Exception  # pylint: disable=broad-exception-caught
-                        ) as exp:
-                            logging.error(exp)
-                    else:
-                        continue
+                    await self.call(
+                        self.bot.sendMessage,
+                        chat_id=self.chat_id,
+                        text="Hello! "
+                        + self.emoji_robot
+                        + self.bot_name
+                        + self.emoji_robot
+                        + " ["
+                        + self.location
+                        + "] is at your service.",
+                    )
+                except Exception as exp:  # pylint: disable=broad-exception-caught
+                    # alerts are kept in the outbox until the network is back
+                    logging.error(exp)
+                startup_profile.mark("bot", "open session")
+                startup_profile.report("bot")
+
+                tasks = [
+                    asyncio.create_task(self.upload_worker())
+                    for _ in range(0, self.upload_workers)
+                ]
+                tasks.append(asyncio.create_task(self.keep_alive()))
+                tasks.append(asyncio.create_task(self.video_worker()))
+                if self.outbox is not None:
+                    tasks.append(asyncio.create_task(self.drain_outbox()))
+                if self.media_store is not None:
+                    tasks.append(asyncio.create_task(self.sweep_media()))
+                await asyncio.gather(*tasks)
         finally:
-            logging.info("bot UDP stopped")
+            if intake is not None:
+                intake.close()
+            if metrics_server is not None:
+                metrics_server.close()
+            if hub_server is not None:
+                hub_server.close()
+            logging.info("bot intake stopped")
 
 
 async def main():
     """Main function"""
+    startup_profile.mark("bot", "interpreter and imports")
     # argument parser
     ap = argparse.ArgumentParser()
     ap.add_argument(
@@ -152,8 +1207,17 @@ async def main():
     args = vars(ap.parse_args())
     with open(args["conf"], "r", encoding="utf-8") as read_file:
         config = json.load(read_file)
+    startup_profile.configure(config)
+    async_log.configure(config)
 
-    my_bot = MessageBot(config)
+    with startup_profile.phase("bot", "init"):
+        my_bot = MessageBot(config)
+    loop = asyncio.get_running_loop()
+    settings.watch(
+        args["conf"],
+        config,
+        [lambda reloaded: loop.call_soon_threadsafe(my_bot.apply_settings, reloaded)],
+    )
     await my_bot.run()
 
 
@@ -20,23 +20,18 @@
 import argparse
 import time
 import json
-import os
-import socket
 import datetime
 import logging
+import queue
+from collections import deque
 
-from gpiozero import MotionSensor
+import async_log
+import ipc
+import settings
+import startup_profile
+import tracing
 
-pwd = os.path.dirname(os.path.realpath(__file__))
-log_folder = os.path.join(pwd, "log")
-if not os.path.exists(log_folder):
-    os.makedirs(log_folder)
-
-logging.basicConfig(
-    filename=os.path.join(log_folder, "motion.log"),
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.ERROR,
-)
+async_log.setup("motion", "motion.log")
 
 
 class Motion:
@@ -49,74 +44,183 @@ class Motion:
     SIG_STOP = 1
     SIG_DISCONNECT = 2
 
-    def __init__(self, config):
+    # states of the PIR state machine
+    IDLE = 0
+    PENDING = 1
+    ACTIVE = 2
+    RELEASING = 3
 
-        self.camera_port = config["camera"]["listen_port"]
-        self.bot_port = config["bot"]["listen_port"]
+    def __init__(self, config):
 
-        self.ip = "127.0.0.1"
-        self.port = config["motion"]["listen_port"]
-        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.camera_client = ipc.connect(config, "camera")
+        self.bot_client = ipc.connect(config, "bot")
 
-        self.motion_pin = config["motion"]["pir_pin"]
-        self.interval = config["motion"]["interval"]
+        # a rising edge has to stay high for `debounce` seconds to count, and
+        # the sensor has to stay low for `release` seconds before it re-arms.
+        # Swapped as a whole by apply_settings() when config.json changes.
+        self.settings = settings.MotionSettings.from_config(config)
+        # the camera only opens the stream, and confirms triggers on it, at
+        # startup, so a reloaded `stream.enabled` waits for a restart
+        self.stream = self.settings.stream
 
         self.timestamp = None
-
-        self.time_start = datetime.time(
-            hour=config["motion"]["time_start"][0],
-            minute=config["motion"]["time_start"][1],
-        )
-        self.time_end = datetime.time(
-            hour=config["motion"]["time_end"][0], minute=config["motion"]["time_end"][1]
+        self.state = self.IDLE
+        self.rise_time = None
+        self.deadline = None
+        self.edges = queue.SimpleQueue()
+        self.latency = deque(maxlen=100)
+
+        # opened by run(), so the constructor does not wait for the hardware
+        self.pir = None
+
+    def open_sensor(self):
+        with startup_profile.phase("motion", "import gpiozero"):
+            # pylint: disable-next=import-outside-toplevel
+            from gpiozero import DigitalInputDevice
+
+        with startup_profile.phase("motion", "open PIR sensor"):
+            # edge interrupts, where MotionSensor samples the pin at 10 Hz
+            self.pir = DigitalInputDevice(self.settings.pir_pin)
+            self.pir.pin.when_changed = self.on_edge
+
+    def apply_settings(self, reloaded):
+        """Swaps in reloaded settings, reopening the sensor if its pin changed.
+
+        Parameters
+        ----------
+        reloaded : settings.Settings
+            The reloaded settings.
+        """
+        old = self.settings
+        self.settings = reloaded.motion
+        if reloaded.motion.pir_pin != old.pir_pin and self.pir is not None:
+            self.pir.close()
+            self.open_sensor()
+
+    def on_edge(self, ticks, state):
+        # runs on the GPIO thread: stamp the edge with the driver's tick
+        now = time.time()
+        factory = self.pir.pin_factory
+        if ticks is not None:
+            now -= factory.ticks_diff(factory.ticks(), ticks)
+        if state is None:
+            state = self.pir.pin.state
+        self.edges.put((now, bool(state)))
+
+    def step(self, now, high=None):
+        """Advances the PIR state machine.
+
+        Parameters
+        ----------
+        now : float
+            The time of the edge or of the deadline, in seconds since the
+            epoch.
+        high : bool, optional
+            The level after the edge, None when the deadline passed.
+        """
+        current = self.settings
+        if self.state == self.IDLE:
+            if high:
+                self.rise_time = now
+                self.state = self.PENDING
+                self.deadline = now + current.debounce
+        elif self.state == self.PENDING:
+            if high is None:
+                # the trigger keeps the time of the edge, not of the debounce
+                self.trigger(self.rise_time)
+                self.state = self.ACTIVE
+                self.deadline = None
+            elif not high:
+                # a glitch shorter than the debounce time
+                self.state = self.IDLE
+                self.deadline = None
+        elif self.state == self.ACTIVE:
+            if high is False:
+                self.state = self.RELEASING
+                self.deadline = now + current.release
+        elif self.state == self.RELEASING:
+            if high:
+                self.state = self.ACTIVE
+                self.deadline = None
+            elif high is None:
+                self.state = self.IDLE
+                self.deadline = None
+
+    def trigger(self, trigger_time):
+        current = self.settings
+        if self.timestamp is not None:
+            if trigger_time - self.timestamp < current.interval:
+                return
+
+        if not current.schedule.armed(trigger_time):
+            return
+
+        print("motion detected")
+        self.timestamp = trigger_time
+
+        # the edge to the decision, including the debounce time
+        trace = tracing.start(trigger_time)
+        tracing.add_stage(trace, "detect", trace["sent"] - trigger_time)
+        self.camera_client.send(
+            {
+                "cmd": "take_photo",
+                "count": 1,
+                "timestamp": trigger_time,
+                "trigger": "motion",
+                "trace": trace,
+            }
         )
 
-        self.pir = MotionSensor(self.motion_pin)
+        if not (self.stream and current.motion_confirm):
+            date_str, time_str = (
+                datetime.datetime.fromtimestamp(trigger_time)
+                .strftime("%Y-%m-%d %H-%M-%S")
+                .split()
+            )
+            self.bot_client.send(
+                {"cmd": "send_msg", "date": date_str, "time": time_str}
+            )
+
+        latency = time.time() - trigger_time
+        self.latency.append(latency)
+        logging.info(
+            "motion detected, dispatched %.1f ms after the edge", latency * 1000
+        )
 
-    def send_udp(self, msg, port):
-        payload = json.dumps(msg)
-        self.udp_socket.sendto(payload.encode(), ("127.0.0.1", port))
+    def latency_stats(self):
+        """Returns the mean and maximum trigger-to-dispatch latency in ms."""
+        return {
+            "count": len(self.latency),
+            "mean_ms": 1000 * sum(self.latency) / max(1, len(self.latency)),
+            "max_ms": 1000 * max(self.latency, default=0.0),
+        }
 
     def run(self):
         logging.info("Motion thread started")
+        self.open_sensor()
+        startup_profile.mark("motion", "watching the PIR sensor")
+        ipc.notify_ready()
+        startup_profile.report("motion")
 
         while True:
-            self.pir.wait_for_motion()
-
-            current_time = time.time()
-
-            if self.timestamp is not None:
-                if current_time - self.timestamp < self.interval:
-                    continue
-
-            now_time = datetime.datetime.now().time()
-            if self.time_start < self.time_end:
-                if now_time < self.time_start:
-                    continue
-
-                if now_time > self.time_end:
-                    continue
-            else:
-                if now_time < self.time_start and now_time > self.time_end:
-                    continue
-
-            print("motion detected")
-            self.timestamp = current_time
-
-            date_str = datetime.datetime.now().strftime("%Y-%m-%d")
-            time_str = datetime.datetime.now().strftime("%H-%M-%S")
-            self.send_udp({"cmd": "take_photo", "count": 1}, self.camera_port)
-
-            self.send_udp(
-                {"cmd": "send_msg", "date": date_str, "time": time_str}, self.bot_port
-            )
-            logging.info("motion detected")
+            timeout = None
+            if self.deadline is not None:
+                timeout = max(0.0, self.deadline - time.time())
+            try:
+                edge_time, high = self.edges.get(timeout=timeout)
+            except queue.Empty:
+                self.step(self.deadline)
+                continue
 
-            self.pir.wait_for_no_motion()
+            # an edge that arrives late may come after a deadline that passed
+            if self.deadline is not None and edge_time >= self.deadline:
+                self.step(self.deadline)
+            self.step(edge_time, high)
 
 
 def main():
     """Main function"""
+    startup_profile.mark("motion", "interpreter and imports")
     # argument parser
     ap = argparse.ArgumentParser()
     ap.add_argument(
@@ -125,8 +229,12 @@ def main():
     args = vars(ap.parse_args())
     with open(args["conf"], "r", encoding="utf-8") as read_file:
         config = json.load(read_file)
+    startup_profile.configure(config)
+    async_log.configure(config)
 
-    motion = Motion(config)
+    with startup_profile.phase("motion", "init"):
+        motion = Motion(config)
+    settings.watch(args["conf"], config, [motion.apply_settings])
     motion.run()
 
 
@@ -19,53 +19,72 @@
 
 import argparse
 import json
-import os
-import socket
 import logging
+import time
 
-from telegram import Update
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    ContextTypes,
-    MessageHandler,
-    filters,
-)
+import async_log
+import hub
+import ipc
+import live_view
+import startup_profile
+import tracing
 
 
-pwd = os.path.dirname(os.path.realpath(__file__))
-log_folder = os.path.join(pwd, "log")
-if not os.path.exists(log_folder):
-    os.makedirs(log_folder)
+async_log.setup("telegram", "telegram.log")
 
-logging.basicConfig(
-    filename=os.path.join(log_folder, "telegram.log"),
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.ERROR,
-)
 
+def build_application(config):
+    """Builds the Telegram command handler application.
 
-def main():
-    """Main function"""
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary.
 
-    # argument parser
-    ap = argparse.ArgumentParser()
-    ap.add_argument(
-        "-c", "--conf", required=True, help="path to the JSON configuration file"
-    )
-    args = vars(ap.parse_args())
-    with open(args["conf"], "r", encoding="utf-8") as read_file:
-        config = json.load(read_file)
+    Returns
+    -------
+    telegram.ext.Application
+        The application, ready to receive updates, see `update_options`.
+    """
+    # imported here, so the all-in-one runtime starts the camera meanwhile
+    with startup_profile.phase("telegram", "import telegram"):
+        # pylint: disable=import-outside-toplevel
+        from telegram import Update
+        from telegram.ext import (
+            Application,
+            CallbackQueryHandler,
+            CommandHandler,
+            ContextTypes,
+            MessageHandler,
+            filters,
+        )
 
     chat_id = config["bot"]["chat_id"]
+    hub_role = hub.role(config)
+    mode, _ = update_options(config)
 
-    camera_port = config["camera"]["listen_port"]
+    # never block the event loop on a busy service
+    camera_client = ipc.connect(config, "camera")
+    bot_client = ipc.connect(config, "bot")
 
-    udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    def command_trace(update):
+        # Telegram dates the command to the second, so "receive" covers the
+        # wait for the next poll, or the webhook delivery, within a second
+        origin = min(update.effective_message.date.timestamp(), time.time())
+        trace = tracing.start(origin)
+        tracing.add_stage(trace, "receive", trace["sent"] - origin)
+        trace["mode"] = mode
+        return trace
 
-    def send_udp(msg, port):
-        payload = json.dumps(msg)
-        udp_socket.sendto(payload.encode(), ("127.0.0.1", port))
+    def send_camera(context, msg):
+        if hub_role == "hub":
+            # "/photo Front Door" asks one unit, "/photo" all of them
+            bot_client.send(
+                {"cmd": "route", "node": " ".join(context.args or []), "msg": msg},
+                timeout=0,
+            )
+        else:
+            camera_client.send(msg, timeout=0)
 
     async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.effective_chat.id == chat_id:
@@ -81,20 +100,165 @@ def main():
 
     async def take_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.effective_chat.id == chat_id:
-            send_udp({"cmd": "take_photo", "count": 1}, camera_port)
+            send_camera(
+                context,
+                {"cmd": "take_photo", "count": 1, "trace": command_trace(update)},
+            )
 
     async def take_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.effective_chat.id == chat_id:
-            send_udp({"cmd": "take_video", "count": 1}, camera_port)
+            send_camera(context, {"cmd": "take_video", "count": 1})
 
-    application = Application.builder().token(config["bot"]["bot_token"]).build()
+    async def live(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_chat.id == chat_id:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id, text=live_view.url(config)
+            )
+
+    async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_chat.id == chat_id:
+            bot_client.send({"cmd": "send_stats"}, timeout=0)
+
+    async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_chat.id == chat_id:
+            # "/history 8" covers the last 8 hours, by default the last night
+            try:
+                hours = float(context.args[0]) if context.args else 12
+            except ValueError:
+                hours = 12
+            bot_client.send({"cmd": "send_history", "hours": hours}, timeout=0)
+
+    async def logs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_chat.id == chat_id:
+            # "/logs camera" shows more lines of one service
+            service = context.args[0] if context.args else ""
+            recent = async_log.recent(config, service, 30 if service else 10)
+            text = "\n\n".join(
+                "[" + name + "]\n" + "\n".join(lines) for name, lines in recent.items()
+            )
+            # the newest lines are kept within the message size limit
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id, text=text[-4000:] or "No logs."
+            )
+
+    async def log_level(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_chat.id == chat_id:
+            try:
+                service, level = context.args
+                async_log.set_level(config, service, level.lower())
+            except ValueError:
+                levels = "|".join(async_log.LEVELS)
+                text = "Usage: /loglevel <service|all> <" + levels + ">"
+            else:
+                text = "[" + service + "] logs at " + level.lower()
+            await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+
+    async def cameras(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_chat.id == chat_id:
+            bot_client.send({"cmd": "send_cameras"}, timeout=0)
+
+    async def send_full(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+        if update.effective_chat.id == chat_id:
+            bot_client.send({"cmd": "send_full", "event": query.data[5:]}, timeout=0)
+
+    with startup_profile.phase("telegram", "build application"):
+        builder = Application.builder().token(config["bot"]["bot_token"])
+        if config["bot"].get("api_url"):
+            builder = builder.base_url(config["bot"]["api_url"])
+        application = builder.build()
 
     application.add_handler(CommandHandler("hello", hello))
     application.add_handler(CommandHandler("photo", take_photo))
     application.add_handler(CommandHandler("video", take_video))
+    application.add_handler(CommandHandler("stats", stats))
+    if config["camera"].get("stream", {}).get("live", {}).get("enabled", False):
+        application.add_handler(CommandHandler("live", live))
+    application.add_handler(CommandHandler("history", history))
+    application.add_handler(CommandHandler("logs", logs))
+    application.add_handler(CommandHandler("loglevel", log_level))
+    if hub_role == "hub":
+        application.add_handler(CommandHandler("cameras", cameras))
+    application.add_handler(CallbackQueryHandler(send_full, pattern="^full:"))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
 
-    application.run_polling()
+    return application
+
+
+def update_options(config):
+    """Returns how the application receives updates.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary.
+
+    Returns
+    -------
+    str, dict
+        "webhook" or "polling", and the keyword arguments of the matching
+        `run_webhook`/`start_webhook` or `run_polling`/`start_polling`.
+
+    Raises
+    ------
+    ValueError
+        If the webhook mode has no `webhook_url`.
+    """
+    updates_config = config["bot"].get("updates", {})
+    if updates_config.get("mode", "polling") == "webhook":
+        if not updates_config.get("webhook_url"):
+            # without it, Telegram would not know where to push the updates
+            raise ValueError("bot.updates.webhook_url is needed in webhook mode")
+        # Telegram pushes every update to the embedded server, usually
+        # through a reverse proxy terminating TLS at webhook_url
+        return "webhook", {
+            "listen": updates_config.get("listen", "127.0.0.1"),
+            "port": updates_config.get("port", 8443),
+            "url_path": updates_config.get("url_path", "sentinel"),
+            "webhook_url": updates_config["webhook_url"],
+            "secret_token": updates_config.get("secret_token") or None,
+        }
+    # a long poll timeout keeps the radio quiet while nothing happens
+    return "polling", {
+        "poll_interval": updates_config.get("poll_interval", 0.0),
+        "timeout": updates_config.get("poll_timeout", 10),
+    }
+
+
+def main():
+    """Main function"""
+    startup_profile.mark("telegram", "interpreter and imports")
+
+    # argument parser
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        "-c", "--conf", required=True, help="path to the JSON configuration file"
+    )
+    args = vars(ap.parse_args())
+    with open(args["conf"], "r", encoding="utf-8") as read_file:
+        config = json.load(read_file)
+    startup_profile.configure(config)
+    async_log.configure(config)
+
+    if hub.role(config) == "node":
+        # the hub polls for the commands of every unit
+        logging.error("Hub node, commands are handled by the hub")
+        return
+
+    application = build_application(config)
+
+    async def post_init(application):  # pylint: disable=unused-argument
+        startup_profile.mark("telegram", "ready for commands")
+        ipc.notify_ready()
+        startup_profile.report("telegram")
+
+    application.post_init = post_init
+    mode, options = update_options(config)
+    if mode == "webhook":
+        application.run_webhook(**options)
+    else:
+        application.run_polling(**options)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    The options a running service can pick up from an edited config.json.
+    They are validated and compiled into frozen dataclasses, one per
+    service, which the service swaps in with a single assignment before it
+    restarts only the parts whose options changed. The watcher follows the
+    file with inotify, or polls it where inotify is missing, and rejects an
+    invalid file as a whole. The other options still take a restart.
+"""
+
+import os
+import ctypes
+import ctypes.util
+import json
+import logging
+import select
+import struct
+import threading
+import time
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from types import MappingProxyType
+
+import async_log
+from arm_schedule import DAYS, ArmSchedule
+
+# options that apply without a restart, as dotted paths
+HOT_OPTIONS = (
+    "motion",
+    "camera.max_photo_count",
+    "camera.video_length",
+    "camera.motion_confirm",
+    "camera.stream.burst_fps",
+    "camera.stream.quality",
+    "camera.stream.preview",
+    "camera.stream.select",
+    "camera.stream.live",
+    "bot.rate_limit",
+    "bot.album",
+    "bot.progressive",
+    "hub.alert_delay",
+    "hub.dedupe_window",
+    "media_store.max_mb",
+    "media_store.max_days",
+    "media_store.history_days",
+    "media_store.sweep_interval",
+    "logging",
+    "reload",
+)
+
+# within the hot options, the ffmpeg output is only created at startup and
+# the watcher itself is only started then
+RESTART_OPTIONS = ("camera.stream.live.hls", "reload.enabled")
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+EVENT_HEADER = struct.Struct("iIII")
+
+REQUIRED = object()
+
+
+class ConfigError(ValueError):
+    """An option of the configuration has a wrong type or value."""
+
+
+def freeze(value):
+    """Returns a read-only copy of a JSON value, with tuples for lists."""
+    if isinstance(value, Mapping):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def option(section, key, kind, default, path, minimum=None):
+    """Returns a validated option of a configuration section.
+
+    Parameters
+    ----------
+    section : dict
+        The configuration section.
+    key : str
+        The option name.
+    kind : type
+        int, float, bool or Mapping. Integers are accepted as floats.
+    default
+        The value of a missing option, REQUIRED if it must be set.
+    path : str
+        The dotted path of the section, for the error message.
+    minimum : float, optional
+        The smallest valid value.
+
+    Raises
+    ------
+    ConfigError
+        If the option is missing, of the wrong type or too small.
+    """
+    value = section.get(key, default)
+    if value is REQUIRED:
+        raise ConfigError(f"{path}.{key} is missing")
+    if kind is float and isinstance(value, int) and not isinstance(value, bool):
+        value = float(value)
+    if not isinstance(value, kind) or (kind is not bool and isinstance(value, bool)):
+        raise ConfigError(f"{path}.{key} must be {kind.__name__}, not {value!r}")
+    if minimum is not None and value < minimum:
+        raise ConfigError(f"{path}.{key} must be at least {minimum}, not {value!r}")
+    return freeze(value)
+
+
+def windows(motion_config):
+    """Returns the validated windows of the arming schedule."""
+    schedule = motion_config.get("schedule")
+    if not schedule:
+        schedule = [
+            {
+                "start": motion_config.get("time_start"),
+                "end": motion_config.get("time_end"),
+            }
+        ]
+    for idx, window in enumerate(schedule):
+        path = f"motion.schedule[{idx}]"
+        for key in ("start", "end"):
+            value = window.get(key)
+            if not (
+                isinstance(value, (list, tuple))
+                and len(value) == 2
+                and all(isinstance(part, int) for part in value)
+                and 0 <= value[0] < 24
+                and 0 <= value[1] < 60
+            ):
+                raise ConfigError(f"{path}.{key} must be [hour, minute], not {value!r}")
+        unknown = set(window.get("days", DAYS)) - set(DAYS)
+        if unknown:
+            raise ConfigError(f"{path}.days has unknown days {sorted(unknown)}")
+    return freeze(schedule)
+
+
+@dataclass(frozen=True)
+class MotionSettings:
+    """The options of the Motion service, with the compiled schedule."""
+
+    pir_pin: int
+    interval: float
+    debounce: float
+    release: float
+    windows: tuple
+    stream: bool
+    motion_confirm: bool
+    schedule: ArmSchedule = field(compare=False, repr=False)
+
+    @classmethod
+    def from_config(cls, config):
+        """Validates and compiles the options from a configuration dictionary."""
+        motion_config = config["motion"]
+        schedule = windows(motion_config)
+        camera_config = config["camera"]
+        return cls(
+            pir_pin=option(motion_config, "pir_pin", int, REQUIRED, "motion", 0),
+            interval=option(motion_config, "interval", float, REQUIRED, "motion", 0),
+            debounce=option(motion_config, "debounce", float, 0.05, "motion", 0),
+            release=option(motion_config, "release", float, 1.0, "motion", 0),
+            windows=schedule,
+            # with both, the camera sends the alert itself once pixel motion
+            # confirms it
+            stream=camera_config.get("stream", {}).get("enabled", False),
+            motion_confirm=camera_config.get("motion_confirm", {}).get(
+                "enabled", False
+            ),
+            schedule=ArmSchedule({"schedule": schedule}),
+        )
+
+
+@dataclass(frozen=True)
+class CameraSettings:
+    """The options of the Camera service.
+
+    `stream` holds the rest of the `stream` section, which only applies
+    when the camera is opened.
+    """
+
+    max_photo_count: int
+    video_length: float
+    burst_fps: float
+    quality: int
+    preview: Mapping
+    select: Mapping
+    motion_confirm: Mapping
+    live: Mapping
+    stream: Mapping
+
+    @classmethod
+    def from_config(cls, config):
+        """Validates and compiles the options from a configuration dictionary."""
+        camera_config = config["camera"]
+        stream_config = camera_config.get("stream", {})
+        hot = ("burst_fps", "quality", "preview", "select", "live")
+        return cls(
+            max_photo_count=option(
+                camera_config, "max_photo_count", int, REQUIRED, "camera", 1
+            ),
+            video_length=option(
+                camera_config, "video_length", float, REQUIRED, "camera", 0
+            ),
+            burst_fps=option(
+                stream_config, "burst_fps", float, 5, "camera.stream", 0.1
+            ),
+            quality=option(stream_config, "quality", int, 90, "camera.stream", 1),
+            preview=option(stream_config, "preview", Mapping, {}, "camera.stream"),
+            select=option(stream_config, "select", Mapping, {}, "camera.stream"),
+            motion_confirm=option(
+                camera_config, "motion_confirm", Mapping, {}, "camera"
+            ),
+            live=option(stream_config, "live", Mapping, {}, "camera.stream"),
+            stream=freeze(
+                {key: value for key, value in stream_config.items() if key not in hot}
+            ),
+        )
+
+
+@dataclass(frozen=True)
+class BotSettings:
+    """The options of the MessageBot service."""
+
+    rate: float
+    burst: int
+    max_retries: int
+    album_size: int
+    album_delay: float
+    full_cache_size: int
+    full_idle_delay: float
+    alert_delay: float
+    dedupe_window: float
+    sweep_interval: float
+    media_store: Mapping
+
+    @classmethod
+    def from_config(cls, config):
+        """Validates and compiles the options from a configuration dictionary."""
+        bot_config = config["bot"]
+        rate_config = option(bot_config, "rate_limit", Mapping, {}, "bot")
+        album_config = option(bot_config, "album", Mapping, {}, "bot")
+        progressive_config = option(bot_config, "progressive", Mapping, {}, "bot")
+        hub_config = option(config, "hub", Mapping, {}, "config")
+        store_config = option(config, "media_store", Mapping, {}, "config")
+        for key in ("max_mb", "max_days", "history_days"):
+            option(store_config, key, float, 1, "media_store", 0)
+        return cls(
+            rate=option(rate_config, "rate", float, 1, "bot.rate_limit", 0.01),
+            burst=option(rate_config, "burst", int, 3, "bot.rate_limit", 1),
+            max_retries=option(rate_config, "max_retries", int, 5, "bot.rate_limit", 0),
+            album_size=min(
+                10, option(album_config, "max_size", int, 10, "bot.album", 1)
+            ),
+            album_delay=option(album_config, "flush_delay", float, 2, "bot.album", 0),
+            full_cache_size=option(
+                progressive_config, "cache_size", int, 20, "bot.progressive", 0
+            ),
+            full_idle_delay=option(
+                progressive_config, "idle_delay", float, 0, "bot.progressive", 0
+            ),
+            alert_delay=option(hub_config, "alert_delay", float, 1, "hub", 0),
+            dedupe_window=option(hub_config, "dedupe_window", float, 10, "hub", 0),
+            sweep_interval=option(
+                store_config, "sweep_interval", float, 300, "media_store", 1
+            ),
+            media_store=store_config,
+        )
+
+
+@dataclass(frozen=True)
+class Settings:
+    """The compiled options of every service and the whole configuration."""
+
+    motion: MotionSettings
+    camera: CameraSettings
+    bot: BotSettings
+    config: Mapping
+
+    @classmethod
+    def from_config(cls, config):
+        """Validates and compiles a configuration dictionary.
+
+        Raises
+        ------
+        ConfigError
+            If an option is invalid.
+        """
+        try:
+            return cls(
+                motion=MotionSettings.from_config(config),
+                camera=CameraSettings.from_config(config),
+                bot=BotSettings.from_config(config),
+                config=freeze(config),
+            )
+        except (KeyError, AttributeError, TypeError) as err:
+            raise ConfigError(f"Invalid configuration: {err!r}") from err
+
+
+def load(path):
+    """Reads, validates and compiles a configuration file.
+
+    Raises
+    ------
+    OSError
+        If the file cannot be read.
+    ValueError
+        If the file is no valid JSON or an option is invalid.
+    """
+    with open(path, "r", encoding="utf-8") as read_file:
+        return Settings.from_config(json.load(read_file))
+
+
+def changes(old, new, path=""):
+    """Returns the dotted paths of the options that differ."""
+    if not (isinstance(old, Mapping) and isinstance(new, Mapping)):
+        return [] if old == new else [path]
+    changed = []
+    for key in sorted(set(old) | set(new)):
+        changed += changes(
+            old.get(key), new.get(key), f"{path}.{key}" if path else key
+        )
+    return changed
+
+
+def is_hot(path):
+    """Tells if an option applies without a restart."""
+
+    def under(prefixes):
+        return any(
+            path == prefix or path.startswith(prefix + ".") for prefix in prefixes
+        )
+
+    return under(HOT_OPTIONS) and not under(RESTART_OPTIONS)
+
+
+class ConfigWatcher:
+    """
+    Reloads the configuration file when it changes.
+
+    The folder of the file is watched, so editors replacing the file by a
+    rename are followed as well as writes in place. A burst of events is
+    handled once the file has been quiet for `debounce` seconds.
+
+    ...
+
+    Methods
+    -------
+    start():
+        Watches the file on a background thread.
+    reload():
+        Reloads the file and hands valid, changed settings to the callbacks.
+    """
+
+    def __init__(self, path, settings, callbacks):
+        """
+        Initializes the watcher.
+
+        Parameters
+        ----------
+        path : str
+            The configuration file.
+        settings : Settings
+            The settings the services are running with.
+        callbacks : list
+            Called with the new Settings after every change.
+        """
+        self.path = os.path.abspath(path)
+        self.settings = settings
+        self.callbacks = list(callbacks)
+        self.configure(settings.config)
+        self.thread = threading.Thread(
+            target=self.run, name="config-watch", daemon=True
+        )
+
+    def start(self):
+        """Watches the file on a background thread."""
+        self.thread.start()
+
+    def configure(self, config):
+        """Takes the `debounce` and `poll_interval` of the watcher."""
+        reload_config = config.get("reload", {})
+        self.debounce = reload_config.get("debounce", 0.5)
+        self.poll_interval = reload_config.get("poll_interval", 5)
+
+    def inotify(self):
+        """Returns an inotify descriptor watching the folder, None without."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            descriptor = libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if descriptor < 0:
+            return None
+        folder = os.path.dirname(self.path).encode()
+        if libc.inotify_add_watch(descriptor, folder, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(descriptor)
+            return None
+        return descriptor
+
+    def touched(self, data):
+        """Tells if inotify events name the configuration file."""
+        name = os.path.basename(self.path).encode()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            start = offset + EVENT_HEADER.size
+            if data[start : start + length].rstrip(b"\0") == name:
+                return True
+            offset = start + length
+        return False
+
+    def run(self):
+        descriptor = self.inotify()
+        if descriptor is None:
+            logging.warning("inotify unavailable, polling %s", self.path)
+            self.poll()
+            return
+
+        while True:
+            select.select([descriptor], [], [])
+            if not self.touched(os.read(descriptor, 4096)):
+                continue
+            # editors write in several steps, wait for the last one
+            while select.select([descriptor], [], [], self.debounce)[0]:
+                os.read(descriptor, 4096)
+            self.reload()
+
+    def poll(self):
+        last = None
+        while True:
+            try:
+                stat = os.stat(self.path)
+                current = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                current = None
+            if last is not None and current is not None and current != last:
+                time.sleep(self.debounce)
+                self.reload()
+            last = current
+            time.sleep(self.poll_interval)
+
+    def reload(self):
+        """Reloads the file and hands valid, changed settings to the callbacks.
+
+        Returns
+        -------
+        bool
+            True if the settings changed.
+        """
+        try:
+            settings = load(self.path)
+        except (OSError, ValueError) as err:
+            logging.error("Configuration not reloaded: %s", err)
+            return False
+
+        changed = changes(self.settings.config, settings.config)
+        if not changed:
+            return False
+        cold = [path for path in changed if not is_hot(path)]
+        if cold:
+            logging.warning("Changes to %s apply after a restart", ", ".join(cold))
+        logging.warning("Configuration reloaded: %s", ", ".join(changed))
+
+        self.settings = settings
+        self.configure(settings.config)
+        async_log.configure(settings.config)
+        for callback in self.callbacks:
+            try:
+                callback(settings)
+            except Exception as exp:  # pylint: disable=broad-exception-caught
+                logging.error(exp)
+        return True
+
+
+def watch(path, config, callbacks):
+    """Starts reloading a configuration file, if enabled by `reload`.
+
+    Parameters
+    ----------
+    path : str
+        The configuration file.
+    config : dict
+        The configuration the services were started with.
+    callbacks : list
+        Called with the new Settings after every change.
+
+    Returns
+    -------
+    ConfigWatcher or None
+        The running watcher.
+    """
+    if not config.get("reload", {}).get("enabled", False):
+        return None
+    watcher = ConfigWatcher(path, Settings.from_config(config), callbacks)
+    watcher.start()
+    return watcher
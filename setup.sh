@@ -4,10 +4,12 @@ Help()
    echo
    echo "Usages:"
    echo
-   echo "Syntax: setup.sh --config=[/path/to/config.json]"
+   echo "Syntax: setup.sh --config=[/path/to/config.json] [--mode=multi|single]"
    echo "options:"
    echo "   --help	    Show the usages of the parameters"
    echo "   --config	  Path to the config json file"
+   echo "   --mode	    multi: one service per module (default)"
+   echo "         	    single: one all-in-one service"
    echo
 }
 
@@ -25,6 +27,10 @@ for i in "$@"; do
       CONFIG="${i#*=}"
       shift # past argument
       ;;
+    --mode=*)
+      MODE="${i#*=}"
+      shift # past argument
+      ;;
     --*)
       echo "Unknown option $1, Please check --help for usage"
       exit 1
@@ -39,7 +45,17 @@ done
 echo "$CONFIG"
 
 echo "create service files"
-python3 create_services.py --config "$CONFIG"
+python3 create_services.py --config "$CONFIG" --mode "${MODE:-multi}"
+
+echo "remove services of the other mode"
+for old_service in /lib/systemd/system/sentinel.service /lib/systemd/system/sentinel_*.service
+do
+  if [ -f "$old_service" ]; then
+    old_name=$(basename "$old_service")
+    sudo systemctl disable --now "$old_name"
+    sudo rm "$old_service"
+  fi
+done
 
 echo "copy service files to /lib/systemd/system"
 service_dir=./service/
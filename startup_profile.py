@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Records how long each start-up phase of a service takes, counted from
+    the start of the process, so the time spent in the interpreter, imports
+    and hardware initialization can be told apart.
+"""
+
+import os
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _process_age():
+    """Returns the seconds since this process was started, 0 if unknown."""
+    try:
+        with open("/proc/self/stat", "r", encoding="utf-8") as stat:
+            # the command name may contain spaces, the fields follow its ")"
+            fields = stat.read().rsplit(")", 1)[1].split()
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return max(0.0, time.clock_gettime(time.CLOCK_BOOTTIME) - started)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return 0.0
+
+
+# process start on the perf_counter clock
+_origin = time.perf_counter() - _process_age()
+_phases = []
+_last_mark = {}
+_lock = threading.Lock()
+_enabled = False
+
+
+def configure(config):
+    """Enables the report with the "profile_startup" configuration option.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration dictionary.
+    """
+    global _enabled  # pylint: disable=global-statement
+    _enabled = config.get("profile_startup", False)
+
+
+def elapsed():
+    """Returns the seconds since the process was started."""
+    return time.perf_counter() - _origin
+
+
+def record(service, name, start, end):
+    """Records a phase, with start and end in seconds since process start."""
+    with _lock:
+        _phases.append((service, name, start, end))
+
+
+def mark(service, name):
+    """Records the phase from the previous mark of a service until now.
+
+    The first mark of a service starts at the start of the process, so it
+    covers the interpreter start-up and the module imports.
+    """
+    end = elapsed()
+    with _lock:
+        start = _last_mark.get(service, 0.0)
+        _last_mark[service] = end
+    record(service, name, start, end)
+
+
+@contextmanager
+def phase(service, name):
+    """Records the time spent in the body of the `with` statement."""
+    start = elapsed()
+    try:
+        yield
+    finally:
+        record(service, name, start, elapsed())
+
+
+def report(service):
+    """Prints the recorded phases of a service when profiling is enabled.
+
+    Parameters
+    ----------
+    service : str
+        The service name used when recording the phases.
+
+    Returns
+    -------
+    list
+        The phases as (name, start, end) tuples, in seconds since the
+        process was started.
+    """
+    with _lock:
+        phases = [
+            (name, start, end) for svc, name, start, end in _phases if svc == service
+        ]
+    phases.sort(key=lambda item: item[1])
+    total = max((end for _, _, end in phases), default=0.0)
+    logging.info("%s started in %.3f s", service, total)
+    if _enabled:
+        lines = [f"{service} startup profile, {total:.3f} s in total:"]
+        lines.extend(
+            f"  {start:7.3f} .. {end:7.3f} s  {end - start:7.3f} s  {name}"
+            for name, start, end in phases
+        )
+        print("\n".join(lines), flush=True)
+    return phases
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    End-to-end tracing of an event from the PIR edge, or the `/photo`
+    command, to the photo in Telegram. The trace travels inside the
+    messages as a dictionary with the trace `id`, the `origin` time of the
+    event, the time the message was `sent` by the previous service and the
+    seconds spent per `stages`. The bot, where every trace ends, collects
+    the stages into histograms.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict, deque
+
+STAGES = [
+    "detect",
+    "receive",
+    "dispatch",
+    "capture",
+    "encode",
+    "write",
+    "queue",
+    "upload",
+]
+
+# a command is captured after these stages
+COMMAND_STAGES = ["receive", "dispatch", "capture"]
+
+# the stages after the dispatch, shared by the traces of merged commands
+SHARED_STAGES = STAGES[STAGES.index("dispatch") + 1 :]
+
+# the ids of the recorded traces kept, to count every event once
+RECORDED_IDS = 1000
+
+# histogram buckets in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+def start(origin=None):
+    """Starts a trace.
+
+    Parameters
+    ----------
+    origin : float, optional
+        The time of the event in seconds since the epoch, by default now.
+
+    Returns
+    -------
+    dict
+        The trace, to be put into the message as `trace`.
+    """
+    now = time.time()
+    return {
+        "id": uuid.uuid4().hex[:12],
+        "origin": now if origin is None else origin,
+        "sent": now,
+        "stages": {},
+    }
+
+
+def add_stage(trace, stage, seconds):
+    """Adds the time spent in a stage to a trace, if there is a trace."""
+    if trace is not None:
+        trace["stages"][stage] = trace["stages"].get(stage, 0.0) + seconds
+
+
+def merge(trace, other):
+    """Carries the trace of a command merged into another one.
+
+    Both commands are dispatched by the same run, `other` keeps its own
+    stages up to the dispatch and shares the later ones with `trace`.
+    """
+    merged = trace.setdefault("merged", [])
+    merged.append(other)
+    merged.extend(other.pop("merged", []))
+
+
+def since_sent(trace, now=None):
+    """Returns the seconds since the previous service sent the trace."""
+    return (time.time() if now is None else now) - trace["sent"]
+
+
+class StageMetrics:
+    """
+    Collects the stage timings of finished traces.
+
+    Every stage, the `command` to capture latency of `/photo` and the
+    end-to-end `total` have a cumulative histogram for Prometheus and a
+    window of recent values for percentiles. Every photo of a burst carries
+    a copy of the trace of its event, only the first one delivered is
+    recorded. The depth of the message queue and the messages dropped when
+    it was full are served next to them.
+
+    ...
+
+    Methods
+    -------
+    record(trace, end=None):
+        Adds the stages of a finished trace and of the traces merged into it.
+    percentiles():
+        Returns the recent p50 and p95 per stage.
+    render():
+        Returns the histograms in the Prometheus text format.
+    serve(host, port):
+        Serves the histograms over HTTP.
+    """
+
+    def __init__(self, window=200, queue_stats=None):
+        """
+        Initializes the metrics.
+
+        Parameters
+        ----------
+        window : int, optional
+            The number of recent values per stage kept for percentiles.
+        queue_stats : callable, optional
+            Returns the `depth` and `dropped` counters of the message queue.
+        """
+        self.queue_stats = queue_stats
+        self.stages = STAGES + ["command", "total"]
+        self.counts = {stage: [0] * len(BUCKETS) for stage in self.stages}
+        self.sums = {stage: 0.0 for stage in self.stages}
+        self.totals = {stage: 0 for stage in self.stages}
+        self.recent = {stage: deque(maxlen=window) for stage in self.stages}
+        self.recorded = OrderedDict()
+
+    def observe(self, stage, seconds):
+        """Adds a value to the histogram of a stage."""
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[stage][idx] += 1
+        self.sums[stage] += seconds
+        self.totals[stage] += 1
+        self.recent[stage].append(seconds)
+
+    def record(self, trace, end=None):
+        """Adds the stages of a finished trace and of the traces merged into it.
+
+        Parameters
+        ----------
+        trace : dict
+            The trace carried by the delivered message.
+        end : float, optional
+            The time the event was delivered, by default now.
+        """
+        if trace["id"] in self.recorded:
+            # another photo of the same event
+            return
+        self.recorded[trace["id"]] = True
+        if len(self.recorded) > RECORDED_IDS:
+            self.recorded.popitem(last=False)
+
+        end = time.time() if end is None else end
+        for stage, seconds in trace["stages"].items():
+            if stage in self.counts:
+                self.observe(stage, seconds)
+        if "receive" in trace["stages"]:
+            self.observe(
+                "command",
+                sum(trace["stages"].get(stage, 0.0) for stage in COMMAND_STAGES),
+            )
+        self.observe("total", end - trace["origin"])
+        logging.info("trace %s %s", trace["id"], trace["stages"])
+
+        for merged in trace.get("merged", []):
+            stages = dict(merged["stages"])
+            stages.update(
+                (stage, seconds)
+                for stage, seconds in trace["stages"].items()
+                if stage in SHARED_STAGES
+            )
+            self.record(
+                {"id": merged["id"], "origin": merged["origin"], "stages": stages},
+                end,
+            )
+
+    def percentiles(self):
+        """Returns the recent p50 and p95 per stage.
+
+        Returns
+        -------
+        dict
+            The number of recent values and their p50 and p95 in seconds,
+            for every stage that has values.
+        """
+        result = {}
+        for stage in self.stages:
+            values = sorted(self.recent[stage])
+            if not values:
+                continue
+            result[stage] = {
+                "count": len(values),
+                "p50": values[int(0.5 * (len(values) - 1))],
+                "p95": values[int(0.95 * (len(values) - 1))],
+            }
+        return result
+
+    def render(self):
+        """Returns the histograms in the Prometheus text format."""
+        lines = [
+            "# HELP sentinel_stage_seconds Time spent per stage of an event.",
+            "# TYPE sentinel_stage_seconds histogram",
+        ]
+        for stage in self.stages:
+            for bound, count in zip(BUCKETS, self.counts[stage]):
+                lines.append(
+                    f'sentinel_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} '
+                    f"{count}"
+                )
+            lines.append(
+                f'sentinel_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} '
+                f"{self.totals[stage]}"
+            )
+            lines.append(
+                f'sentinel_stage_seconds_sum{{stage="{stage}"}} {self.sums[stage]}'
+            )
+            lines.append(
+                f'sentinel_stage_seconds_count{{stage="{stage}"}} {self.totals[stage]}'
+            )
+        if self.queue_stats is not None:
+            queue = self.queue_stats()
+            lines += [
+                "# HELP sentinel_queue_depth Messages waiting for the bot.",
+                "# TYPE sentinel_queue_depth gauge",
+                f"sentinel_queue_depth {queue['depth']}",
+                "# HELP sentinel_queue_dropped_total Messages dropped, queue full.",
+                "# TYPE sentinel_queue_dropped_total counter",
+                f"sentinel_queue_dropped_total {queue['dropped']}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host, port):
+        """Serves the histograms over HTTP on any path, e.g. /metrics.
+
+        Parameters
+        ----------
+        host : str
+            The address to listen on, keep it local.
+        port : int
+            The TCP port.
+
+        Returns
+        -------
+        asyncio.Server
+            The running server.
+        """
+
+        async def handle(reader, writer):
+            try:
+                # the request line and headers are not needed
+                await reader.readuntil(b"\r\n\r\n")
+                body = self.render().encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4\r\n"
+                    b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                    b"Connection: close\r\n\r\n" + body
+                )
+                await writer.drain()
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError) as err:
+                logging.error(err)
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
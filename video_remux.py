@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+    Project Sentinel
+    Copyright (C) 2019 - PRESENT  rookidroid.com
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+    Turns recorded clips into MP4 files Telegram can play, with ffmpeg in
+    stream copy mode: the H.264 frames are never decoded or re-encoded, so
+    this costs little more than copying the file.
+"""
+
+import os
+import asyncio
+import glob
+
+
+async def _run(*args):
+    """Runs a command without blocking the event loop, returns its stdout."""
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(args[0] + " failed: " + stderr.decode().strip())
+    return stdout.decode()
+
+
+async def remux(source, target, fps):
+    """Wraps a raw H.264 stream into an MP4 container.
+
+    Parameters
+    ----------
+    source : str
+        The raw H.264 file, as written by the encoder.
+    target : str
+        The MP4 file to write.
+    fps : float
+        The frame rate of the stream. Raw H.264 carries no timestamps.
+    """
+    await _run(
+        "ffmpeg",
+        "-y",
+        "-loglevel",
+        "error",
+        "-framerate",
+        str(fps),
+        "-i",
+        source,
+        "-c",
+        "copy",
+        "-movflags",
+        "+faststart",
+        target,
+    )
+
+
+async def duration(path):
+    """Returns the duration of a video file in seconds."""
+    output = await _run(
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration",
+        "-of",
+        "default=noprint_wrappers=1:nokey=1",
+        path,
+    )
+    return float(output.strip())
+
+
+async def split(path, max_bytes):
+    """Splits an MP4 file into parts smaller than a size limit.
+
+    The parts are cut at key frames, so their size is only approximately
+    proportional to their length and the target is kept 10 % below the
+    limit.
+
+    Parameters
+    ----------
+    path : str
+        The MP4 file.
+    max_bytes : int
+        The size limit of a part.
+
+    Returns
+    -------
+    list
+        The paths of the parts, in playback order. Just `path` if the file
+        is small enough.
+    """
+    size = os.path.getsize(path)
+    if size <= max_bytes:
+        return [path]
+
+    segment_time = max(1.0, 0.9 * await duration(path) * max_bytes / size)
+    stem = os.path.splitext(path)[0]
+    await _run(
+        "ffmpeg",
+        "-y",
+        "-loglevel",
+        "error",
+        "-i",
+        path,
+        "-c",
+        "copy",
+        "-map",
+        "0",
+        "-f",
+        "segment",
+        "-segment_time",
+        f"{segment_time:.3f}",
+        "-reset_timestamps",
+        "1",
+        stem + "_part%03d.mp4",
+    )
+    return sorted(glob.glob(glob.escape(stem) + "_part[0-9][0-9][0-9].mp4"))